@@ -1,69 +0,0 @@
-import sys
-import logging
-import traceback
-import threading
-import multiprocessing
-from logging import FileHandler
-
-# Thanks to https://mattgathu.github.io/multiprocessing-logging-in-python/
-# ============================================================================
-# Define Log Handler
-# ============================================================================
-class CustomLogHandler(logging.Handler):
-    """multiprocessing log handler
-
-    This handler makes it possible for several processes
-    to log to the same file by using a queue.
-
-    """
-    def __init__(self, fname):
-        logging.Handler.__init__(self)
-
-        self._handler = FileHandler(fname)
-        self.queue = multiprocessing.Queue(-1)
-
-        thrd = threading.Thread(target=self.receive)
-        thrd.daemon = True
-        thrd.start()
-
-    def setFormatter(self, fmt):
-        logging.Handler.setFormatter(self, fmt)
-        self._handler.setFormatter(fmt)
-
-    def receive(self):
-        while True:
-            try:
-                record = self.queue.get()
-                self._handler.emit(record)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except EOFError:
-                break
-            except:
-                traceback.print_exc(file=sys.stderr)
-
-    def send(self, s):
-        self.queue.put_nowait(s)
-
-    def _format_record(self, record):
-        if record.args:
-            record.msg = record.msg % record.args
-            record.args = None
-        if record.exc_info:
-            dummy = self.format(record)
-            record.exc_info = None
-
-        return record
-
-    def emit(self, record):
-        try:
-            s = self._format_record(record)
-            self.send(s)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
-
-    def close(self):
-        self._handler.close()
-        logging.Handler.close(self)
\ No newline at end of file
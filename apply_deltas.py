@@ -0,0 +1,39 @@
+import argparse
+import logging
+import os
+import sys
+from public_data_sync import deltas
+
+#---------------------------------------------------------
+# Applies the delta archives of sync.py -t to an extracted
+# dump, or to a dump archive to write an updated one
+#---------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Applies a chain of delta archives written by sync.py -t, in the order they were written, to an extracted dump or to a dump archive')
+    parser.add_argument('deltas', help='The delta archives to apply', nargs='+')
+    parser.add_argument('-p', '--path', help='Path of the extracted dump, the files are written to and deleted from its ORCID_public_data_files folder')
+    parser.add_argument('--base', help='A dump archive, like ORCID-API-3.0_xml_<month>_<year>.tar.gz, to write an updated copy of instead of updating an extracted dump')
+    parser.add_argument('-o', '--output', help='The updated dump archive written with --base')
+    parser.add_argument('--threads', help='The number of threads compressing the updated dump archive', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if (args.path is None) == (args.base is None):
+        parser.error('Give either -p to update an extracted dump or --base to write an updated dump archive')
+    if args.base is not None and args.output is None:
+        parser.error('--base requires -o')
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', level=logging.INFO)
+    try:
+        if args.base is not None:
+            written = deltas.apply_to_archive(args.base, args.output, args.deltas, args.threads)
+            print('%s written with %s files' % (args.output, written))
+        else:
+            path = args.path if args.path.endswith('/') else (args.path + '/')
+            written, deleted = deltas.apply_to_tree(path + 'ORCID_public_data_files/', args.deltas)
+            print('%s files written and %s deleted' % (written, deleted))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
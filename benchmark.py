@@ -0,0 +1,305 @@
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import concurrent.futures
+from datetime import datetime
+from datetime import timedelta
+import boto3
+from botocore.config import Config
+from public_data_sync import lambda_file
+from public_data_sync import partitions
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Activity types of the public data files, with how often a record has each one
+ACTIVITY_TYPES = [('works', 0.8), ('employments', 0.6), ('educations', 0.5), ('fundings', 0.1), ('peer-reviews', 0.1), ('distinctions', 0.05), ('invited-positions', 0.03), ('memberships', 0.03), ('qualifications', 0.05), ('services', 0.03), ('research-resources', 0.01)]
+
+# Median and spread of the file sizes in bytes, which are roughly log-normal
+SUMMARY_SIZE = (6000, 0.6)
+ACTIVITY_SIZE = (3000, 0.5)
+
+#---------------------------------------------------------
+# ORCID iD checksum, ISO 7064 11,2
+#---------------------------------------------------------
+def orcid_checksum(digits):
+    total = 0
+    for digit in digits:
+        total = (total + int(digit)) * 2
+    result = (12 - total % 11) % 11
+    return 'X' if result == 10 else str(result)
+
+def synthetic_orcid(rng):
+    digits = '000000' + '%09d' % rng.randrange(10 ** 9)
+    digits = digits + orcid_checksum(digits)
+    return '-'.join(digits[i:i + 4] for i in range(0, 16, 4))
+
+def file_size(rng, size):
+    median, sigma = size
+    return max(200, min(int(rng.lognormvariate(0, sigma) * median), 50 * median))
+
+def xml_body(tag, orcid, size):
+    head = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<' + tag + ' path="/' + orcid + '">\n'
+    tail = '</' + tag + '>\n'
+    return (head + ' ' * max(0, size - len(head) - len(tail)) + tail).encode('utf-8')
+
+#---------------------------------------------------------
+# Synthetic records, with their files and last modified
+# date, adding up to about the given number of objects
+#---------------------------------------------------------
+def synthetic_records(objects, days, seed, now):
+    # Generated one at a time, the same seed and now always yield the same records
+    rng = random.Random(seed)
+    total = 0
+    while total < objects:
+        orcid = synthetic_orcid(rng)
+        checksum = orcid[-3:]
+        files = [('summaries', checksum + '/' + orcid + '.xml', file_size(rng, SUMMARY_SIZE))]
+        for activity_type, frequency in ACTIVITY_TYPES:
+            if rng.random() >= frequency:
+                continue
+            # Most records have a few activities of a type, a handful have hundreds
+            for i in range(min(int(rng.paretovariate(1.2)), 500)):
+                name = orcid + '_' + activity_type + '_' + str(rng.randrange(10 ** 7)) + '.xml'
+                files.append(('activities', checksum + '/' + orcid + '/' + activity_type + '/' + name, file_size(rng, ACTIVITY_SIZE)))
+        last_modified = now - timedelta(seconds=rng.uniform(0, days * 86400))
+        yield orcid, last_modified, files
+        total += len(files)
+
+def bucket_name(args, stream, orcid):
+    if stream == 'summaries':
+        return args.summaries_bucket
+    return args.activities_bucket_base + '-' + partitions.activities_bucket_suffix(orcid)
+
+#---------------------------------------------------------
+# Uploads the files of the given records
+#---------------------------------------------------------
+def upload_records(s3client, args, records, version=0):
+    def put(item):
+        bucket, key, body = item
+        s3client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def items():
+        for orcid, last_modified, files in records:
+            for stream, key, size in files:
+                tag = 'record:record' if stream == 'summaries' else 'activity'
+                yield bucket_name(args, stream, orcid), key, xml_body(tag, orcid + '/' + str(version), size)
+
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.upload_threads) as executor:
+        # Bounded number of uploads in flight, so the bodies are never all in memory
+        pending = set()
+        for item in items():
+            pending.add(executor.submit(put, item))
+            if len(pending) >= 4 * args.upload_threads:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    count += 1
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+            count += 1
+    return count
+
+#---------------------------------------------------------
+# The lambda file, ordered by last modified date descendant
+#---------------------------------------------------------
+def lambda_file_body(records):
+    lines = ['orcid,created,profile_deactivated,last_modified']
+    # Only the dates are kept to be sorted, not the files of every record
+    for last_modified, orcid in sorted(((record[1], record[0]) for record in records), reverse=True):
+        lines.append(orcid + ',' + str(last_modified) + ',,' + str(last_modified))
+    data = ('\n'.join(lines) + '\n').encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        info = tarfile.TarInfo(lambda_file.LAMBDA_FILE_MEMBER)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def populate(s3client, args, records):
+    # records returns a new generator of the same records every time it is called
+    for bucket in [args.summaries_bucket, args.lambda_bucket] + [args.activities_bucket_base + '-' + suffix for suffix in 'abc']:
+        try:
+            s3client.create_bucket(Bucket=bucket)
+        except s3client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+    start = time.time()
+    count = upload_records(s3client, args, records())
+    s3client.put_object(Bucket=args.lambda_bucket, Key=lambda_file.LAMBDA_FILE_KEY, Body=lambda_file_body(records()))
+    print('Uploaded %s objects in %.1fs' % (count, time.time() - start))
+
+#---------------------------------------------------------
+# Local S3 stand-in
+#---------------------------------------------------------
+def start_moto_server(port):
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise RuntimeError('The benchmark requires moto to run a local S3 stand-in, please install it with pip3 install moto[server] or point it to another S3 compatible endpoint with --endpoint-url')
+    # One access log line per request would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    return server, 'http://127.0.0.1:' + str(port)
+
+#---------------------------------------------------------
+# Sums the samples of a metric in a stats file
+#---------------------------------------------------------
+def read_metric(fname, name, **labels):
+    total = 0.0
+    if not os.path.isfile(fname):
+        return total
+    wanted = ['%s="%s"' % item for item in labels.items()]
+    with open(fname) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            sample, _, value = line.rpartition(' ')
+            metric = sample.split('{')[0]
+            if metric == 'orcid_sync_' + name and all(label in sample for label in wanted):
+                total += float(value)
+    return total
+
+#---------------------------------------------------------
+# Runs one of the scripts and measures it
+#---------------------------------------------------------
+def run_script(args, endpoint_url, work_dir, name, script_args, stats_files):
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, name + '.py'), '-p', work_dir, '--endpoint-url', endpoint_url, '--metrics-dir', work_dir, '-x', args.summaries_bucket, '-y', args.activities_bucket_base] + script_args
+    print('Running ' + ' '.join(command))
+    start = time.time()
+    process = subprocess.Popen(command, cwd=work_dir)
+    # The rusage of wait4 covers the script and every process it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    stats = [os.path.join(work_dir, fname) for fname in stats_files]
+    downloaded = sum(read_metric(fname, 'objects_total', result='downloaded') for fname in stats)
+    failed = sum(read_metric(fname, 'objects_total', result='failed') for fname in stats)
+    retries = sum(read_metric(fname, 'retries_total') for fname in stats)
+    downloaded_bytes = sum(read_metric(fname, 'bytes_total') for fname in stats)
+    return {
+        'script': name,
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'seconds': round(elapsed, 3),
+        'objects_downloaded': int(downloaded),
+        'objects_skipped': int(sum(read_metric(fname, 'objects_total', result='skipped') for fname in stats)),
+        'objects_failed': int(failed),
+        'bytes_downloaded': int(downloaded_bytes),
+        'objects_per_second': round(downloaded / elapsed, 1),
+        'bytes_per_second': round(downloaded_bytes / elapsed, 1),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024.0, 1),
+        'list_requests': int(sum(read_metric(fname, 'list_requests_total') for fname in stats)),
+        'get_requests': int(downloaded + failed + retries),
+        'throttled': int(sum(read_metric(fname, 'throttled_total') for fname in stats)),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SCRIPTS_DIR, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#---------------------------------------------------------
+# Previous result of the same benchmark, to spot regressions
+#---------------------------------------------------------
+def previous_result(results_file, result):
+    previous = None
+    if os.path.isfile(results_file):
+        with open(results_file) as f:
+            for line in f:
+                entry = json.loads(line)
+                if all(entry.get(field) == result[field] for field in ('script', 'scale', 'script_args')):
+                    previous = entry
+    return previous
+
+def report(result, previous):
+    print('%s: %s objects/s, %s bytes/s, %s MB peak RSS, %s list and %s get requests in %ss' % (result['script'], result['objects_per_second'], result['bytes_per_second'], result['peak_rss_mb'], result['list_requests'], result['get_requests'], result['seconds']))
+    if previous is not None:
+        for field in ('objects_per_second', 'bytes_per_second', 'peak_rss_mb', 'list_requests', 'get_requests'):
+            if previous.get(field):
+                change = 100.0 * (result[field] - previous[field]) / previous[field]
+                print('   %s %+.1f%% compared to %s (%s)' % (field, change, previous.get('revision'), previous.get('time')))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks download.py and sync.py against a local S3 stand-in filled with synthetic ORCID public data files')
+    parser.add_argument('-o', '--objects', help='The approximate number of objects to generate, from 10000 to 10000000', type=int, default=10000)
+    parser.add_argument('--days', help='The number of days the last modified dates of the records are spread over', type=int, default=60)
+    parser.add_argument('--sync-days', help='The number of days synced by the sync.py run, the records modified in that time are uploaded again before it runs', type=int, default=7)
+    parser.add_argument('--seed', help='The seed of the synthetic data, the same seed and scale always produce the same objects', type=int, default=1)
+    parser.add_argument('--scripts', help='The scripts to run, in order', default='download,sync')
+    parser.add_argument('--download-args', help='Extra arguments for download.py', default='-max 16')
+    parser.add_argument('--sync-args', help='Extra arguments for sync.py', default='-max 16')
+    parser.add_argument('--endpoint-url', help='Use an already running S3 compatible endpoint, like MinIO for the largest scales, instead of starting a moto server')
+    parser.add_argument('--port', help='The port of the moto server', type=int, default=5055)
+    parser.add_argument('--skip-populate', help='Do not upload the objects, they are already in the endpoint from a previous run with the same scale and seed', action='store_true')
+    parser.add_argument('--upload-threads', help='The number of threads uploading the synthetic objects', type=int, default=32)
+    parser.add_argument('--work-dir', help='The directory the scripts download to, a temporary one by default. It must be empty or not exist yet, and is kept after the run')
+    parser.add_argument('--results', help='The file every result is appended to, as one JSON object per line', default='benchmark_results.jsonl')
+    parser.add_argument('--label', help='A label stored with the results, to tell versions or settings apart')
+    parser.add_argument('-x', '--summaries-bucket', default='v3.0-summaries')
+    parser.add_argument('-y', '--activities-bucket-base', default='v3.0-activities')
+    parser.add_argument('-z', '--lambda-bucket', default='orcid-lambda-file')
+    args = parser.parse_args()
+
+    # The stand-in does not check credentials, but boto3 refuses to sign without them
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='orcid-benchmark-')
+    else:
+        # Never delete files the benchmark did not write
+        work_dir = os.path.abspath(args.work_dir)
+        if os.path.isdir(work_dir) and os.listdir(work_dir):
+            parser.error('The work directory ' + work_dir + ' is not empty')
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_moto_server(args.port)
+    s3client = boto3.client('s3', endpoint_url=endpoint_url, config=Config(max_pool_connections=args.upload_threads))
+
+    now = datetime.now()
+    def records():
+        return synthetic_records(args.objects, args.days, args.seed, now)
+
+    if not args.skip_populate:
+        populate(s3client, args, records)
+
+    try:
+        for name in args.scripts.split(','):
+            if name == 'download':
+                script_args = ['-s', '-a'] + args.download_args.split()
+                stats_files = ['download_summaries.prom', 'download_activities.prom']
+            elif name == 'sync':
+                # Records modified in the synced days get new content, and new ETags
+                modified = (record for record in records() if record[1] >= datetime.now() - timedelta(days=args.sync_days))
+                upload_records(s3client, args, modified, version=1)
+                script_args = ['-s', '-a', '-z', args.lambda_bucket, '-d', str(args.sync_days), '-l', 'INFO'] + args.sync_args.split()
+                stats_files = ['sync.prom']
+            else:
+                parser.error('Unknown script ' + name)
+            result = run_script(args, endpoint_url, work_dir, name, script_args, stats_files)
+            result.update({'time': datetime.now().isoformat(), 'revision': git_revision(), 'label': args.label, 'scale': args.objects, 'seed': args.seed, 'script_args': ' '.join(script_args)})
+            report(result, previous_result(args.results, result))
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if server is not None:
+            server.stop()
+
+if __name__ == "__main__":
+    main()
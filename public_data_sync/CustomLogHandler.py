@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import traceback
+import threading
+import multiprocessing
+import multiprocessing.util
+from . import profiling
+from .processes import per_process
+
+# Thanks to https://mattgathu.github.io/multiprocessing-logging-in-python/
+# ============================================================================
+# Define Log Handler
+# ============================================================================
+class CustomLogHandler(logging.Handler):
+    """multiprocessing log handler
+
+    This handler makes it possible for several processes
+    to log to the same file by using a queue.
+
+    Records are formatted by the process that logs them and sent in
+    batches, one queue message per batch rather than one pickled record
+    per line. Each process sends its batch once it holds batch_size lines,
+    after flush_interval seconds, right away for warnings and errors, and
+    when it exits. The receiver thread writes everything waiting in the
+    queue through a large buffer and only flushes the file once the queue
+    is drained.
+
+    """
+    def __init__(self, fname, batch_size=1000, flush_interval=1, buffer_size=1024 * 1024):
+        logging.Handler.__init__(self)
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._stream = open(fname, 'a', buffering=buffer_size, encoding='utf-8')
+        self._owner = os.getpid()
+        self._pid = None
+        self._closed = False
+        self.queue = multiprocessing.Queue(-1)
+
+        self._receiver = threading.Thread(target=self.receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+        # The queue closes its reader at exit, with exitpriority 10, so drain it before that
+        multiprocessing.util.Finalize(self, self.close, exitpriority=100)
+
+    def receive(self):
+        while True:
+            try:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                # The receiver is started before the profiler, which only profiles the threads started after it
+                profiling.attach_thread()
+                with profiling.span('log_write'):
+                    self._stream.write(batch)
+                    # Write whatever else is waiting before paying for a flush
+                    while True:
+                        try:
+                            batch = self.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if batch is None:
+                            self._stream.flush()
+                            return
+                        self._stream.write(batch)
+                    self._stream.flush()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except (EOFError, OSError):
+                break
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    def _start_process(self):
+        # Every process, including the forked workers, batches on its own
+        self._pid = os.getpid()
+        self._batch = []
+        self._last_send = time.time()
+        flusher = threading.Thread(target=self._flush_periodically)
+        flusher.daemon = True
+        flusher.start()
+        per_process(self, self.flush, self._owner, exitpriority=100)
+
+    def _flush_periodically(self):
+        pid = self._pid
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            if self._batch and time.time() - self._last_send >= self.flush_interval:
+                self.flush()
+
+    def _send_batch(self):
+        # Runs with the handler lock held
+        if self._batch:
+            self.queue.put_nowait('\n'.join(self._batch) + '\n')
+            self._batch = []
+        self._last_send = time.time()
+
+    def emit(self, record):
+        try:
+            with profiling.span('log'):
+                if self._pid != os.getpid():
+                    self._start_process()
+                self._batch.append(self.format(record))
+                if record.levelno >= logging.WARNING or len(self._batch) >= self.batch_size:
+                    self._send_batch()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        if self._pid != os.getpid() or self._closed:
+            return
+        self.acquire()
+        try:
+            self._send_batch()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        if os.getpid() == self._owner and not self._closed:
+            self._closed = True
+            self.queue.put(None)
+            self._receiver.join()
+            self._stream.close()
+        logging.Handler.close(self)
+
+# ============================================================================
+# JSON lines formatter
+# ============================================================================
+class JsonFormatter(logging.Formatter):
+    """JSON lines log formatter
+
+    Formats every record as a single line JSON object, which is easier to
+    filter and aggregate than the text format. Fields given with extra are
+    added to the object.
+
+    """
+    RESERVED = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | set(['message', 'asctime'])
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# ============================================================================
+# Sampling filter
+# ============================================================================
+class SamplingFilter(logging.Filter):
+    """sampling and rate limiting filter
+
+    Meant for high volume loggers, like the one logging every downloaded
+    file: keeps one record out of every sample records and, when per_second
+    is given, at most that many records per second in each process.
+    Warnings and errors are always kept. The first record kept after some
+    were dropped says how many.
+
+    """
+    def __init__(self, sample=1, per_second=None):
+        logging.Filter.__init__(self)
+        self.sample = max(1, int(sample))
+        self.per_second = per_second
+        self._seen = 0
+        self._dropped = 0
+        self._second = 0
+        self._second_count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self._seen += 1
+        keep = self._seen % self.sample == 0
+        if keep and self.per_second is not None:
+            second = int(time.time())
+            if second != self._second:
+                self._second = second
+                self._second_count = 0
+            self._second_count += 1
+            keep = self._second_count <= self.per_second
+        if not keep:
+            self._dropped += 1
+            return False
+        if self._dropped:
+            record.msg = str(record.msg) + ' (%d similar messages dropped)' % self._dropped
+            self._dropped = 0
+        return True
+
+#---------------------------------------------------------
+# Logs logger to fname the way the scripts do, file_logger
+# is sampled and rate limited
+#---------------------------------------------------------
+def configure(logger, file_logger, fname, log_format='text', log_level='DEBUG', log_sample=1, log_rate=None):
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+    handler = CustomLogHandler(fname)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    if log_level == 'DEBUG':
+        logger.setLevel(logging.DEBUG)
+    elif log_level == 'INFO':
+        logger.setLevel(logging.INFO)
+    elif log_level == 'WARN':
+        logger.setLevel(logging.WARN)
+    else:
+        logger.setLevel(logging.ERROR)
+    if log_sample > 1 or log_rate is not None:
+        file_logger.addFilter(SamplingFilter(log_sample, log_rate))
+    return handler
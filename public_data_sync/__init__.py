@@ -0,0 +1,39 @@
+"""ORCID public data files download and sync
+
+download.py and sync.py are thin command line wrappers around download
+and sync, which can be called from a long running process instead:
+
+    from public_data_sync import Clients, download, download_config, sync, sync_config
+
+    clients = Clients()
+    download(download_config(path='/data', summaries=True), clients)
+    sync(sync_config(path='/data', summaries=True, activities=True), clients)
+
+The modules behind these names, and boto3, are only imported when first
+used.
+
+"""
+import importlib
+
+# Public name: (module, attribute)
+_EXPORTS = {
+    'Clients': ('clients', 'Clients'),
+    'DownloadResult': ('downloader', 'DownloadResult'),
+    'download': ('downloader', 'download'),
+    'download_config': ('downloader', 'config'),
+    'SyncPlan': ('syncer', 'SyncPlan'),
+    'SyncResult': ('syncer', 'SyncResult'),
+    'plan_sync': ('syncer', 'plan_sync'),
+    'sync': ('syncer', 'sync'),
+    'sync_config': ('syncer', 'config'),
+}
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
+    module_name, attribute = _EXPORTS[name]
+    value = getattr(importlib.import_module('.' + module_name, __name__), attribute)
+    globals()[name] = value
+    return value
@@ -0,0 +1,56 @@
+import os
+import threading
+import time
+
+# ============================================================================
+# Line appender
+# ============================================================================
+class LineAppender(object):
+    """append-only file of lines
+
+    The file is line buffered, so every line is a single write handed to
+    the OS right away and several processes can add to the same file, a
+    killed process loses nothing. Lines are fsynced in batches, once
+    sync_every of them are waiting or sync_interval seconds went by, to
+    survive a power loss without paying a disk flush per line.
+
+    """
+    def __init__(self, fname, sync_every=1000, sync_interval=1, mode='a'):
+        self.fname = fname
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(fname, mode, buffering=1)
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def write(self, line):
+        """Appends a line, returns whether the file was fsynced"""
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+                self._fsync()
+                return True
+            return False
+
+    def tell(self):
+        with self._lock:
+            return self._file.tell()
+
+    def sync(self):
+        with self._lock:
+            self._fsync()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            self._fsync()
+            self._file.close()
@@ -0,0 +1,214 @@
+import concurrent.futures
+import gzip
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zlib
+from .processes import per_process
+
+# A tar archive ends with two empty blocks
+TAR_EOF = b'\0' * (2 * tarfile.BLOCKSIZE)
+
+# ============================================================================
+# Sharded tar.gz writer
+# ============================================================================
+class ArchiveWriter(object):
+    """sharded tar.gz writer
+
+    Every process that adds files to the archive, the download workers and
+    the process listing the partitions, writes its own shard in parts_dir.
+    Tar entries are buffered and, once batch_size bytes are waiting,
+    compressed on a thread pool into a gzip member of their own, which is
+    appended to the shard of the process. Shards are plain sequences of
+    gzip members holding tar entries without the end of archive blocks, so
+    they compress in parallel, on as many cores as there are workers, and
+    concatenating them, followed by a member with the end of archive
+    blocks, gives a single valid tar.gz.
+
+    A shard is named .part until its process closes it. A .part shard left
+    by a killed process is cut back to its last complete member when the
+    archive is assembled, the entries still buffered in that process are
+    lost.
+
+    """
+    def __init__(self, parts_dir, resume=False, batch_size=1024 * 1024, threads=1, compresslevel=6):
+        self.parts_dir = parts_dir
+        self.batch_size = batch_size
+        self.threads = threads
+        self.compresslevel = compresslevel
+        self._owner = os.getpid()
+        self._pid = None
+        self._lock = threading.Lock()
+        if not resume and os.path.isdir(parts_dir):
+            shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir, exist_ok=True)
+
+    def _start_process(self):
+        # Runs with the lock held, forked workers start a shard of their own
+        self._pid = os.getpid()
+        # Named after the time it starts, so the shards of a resumed archive come after the older ones,
+        # a process of a resumed run with the pid of an older one never writes over its shard
+        stamp = int(time.time() * 1000)
+        while any(os.path.exists(os.path.join(self.parts_dir, '%d-%d%s' % (stamp, self._pid, extension))) for extension in ('.part', '.gz')):
+            stamp += 1
+        self._shard_name = os.path.join(self.parts_dir, '%d-%d' % (stamp, self._pid))
+        self._shard = open(self._shard_name + '.part', 'ab')
+        self._shard_lock = threading.Lock()
+        self._batch = []
+        self._batch_bytes = 0
+        self._compressing = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        per_process(self, self.close, self._owner, exitpriority=100)
+
+    def add(self, name, data, mtime=None):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime if mtime is not None else time.time())
+        info.mode = 0o644
+        entry = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape') + data
+        padding = len(data) % tarfile.BLOCKSIZE
+        if padding:
+            entry += b'\0' * (tarfile.BLOCKSIZE - padding)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start_process()
+            self._batch.append(entry)
+            self._batch_bytes += len(entry)
+            if self._batch_bytes >= self.batch_size:
+                self._submit_batch()
+
+    def add_file(self, name, file_path):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        self.add(name, data, os.path.getmtime(file_path))
+
+    def _submit_batch(self):
+        # Runs with the lock held
+        if self._batch:
+            self._compressing.append(self._executor.submit(self._write_member, b''.join(self._batch)))
+            self._compressing = [future for future in self._compressing if not future.done()]
+            self._batch = []
+            self._batch_bytes = 0
+
+    def _write_member(self, data):
+        # zlib releases the GIL, so batches compress in parallel
+        member = gzip.compress(data, self.compresslevel)
+        with self._shard_lock:
+            self._shard.write(member)
+            self._shard.flush()
+
+    def flush(self):
+        """Writes the entries buffered by this process to its shard"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._submit_batch()
+            compressing = list(self._compressing)
+        for future in compressing:
+            future.result()
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._submit_batch()
+            for future in self._compressing:
+                future.result()
+            self._executor.shutdown()
+            self._shard.close()
+            os.replace(self._shard_name + '.part', self._shard_name + '.gz')
+            self._pid = None
+
+    def is_empty(self):
+        """Closes the shard of this process and tells whether no shard holds an entry"""
+        self.close()
+        for shard in os.listdir(self.parts_dir):
+            shard_path = os.path.join(self.parts_dir, shard)
+            if complete_members_length(shard_path) if shard.endswith('.part') else os.path.getsize(shard_path):
+                return False
+        return True
+
+    def discard(self):
+        """Closes the shard of this process and deletes every shard"""
+        self.close()
+        shutil.rmtree(self.parts_dir)
+
+    def assemble(self, archive_path, end=True):
+        """Closes the shard of this process and concatenates every shard into archive_path
+
+        Only call it once every other process writing to the archive has
+        exited. Without end, the end of archive blocks are left out, so the
+        archive can itself be joined to others with join_archives.
+
+        """
+        self.close()
+        shards = sorted(os.listdir(self.parts_dir))
+        temp_path = archive_path + '.tmp'
+        with open(temp_path, 'wb') as archive:
+            for shard in shards:
+                shard_path = os.path.join(self.parts_dir, shard)
+                length = None
+                if shard.endswith('.part'):
+                    length = complete_members_length(shard_path)
+                with open(shard_path, 'rb') as f:
+                    if length is None:
+                        shutil.copyfileobj(f, archive, 1024 * 1024)
+                    else:
+                        copy_bytes(f, archive, length)
+            if end:
+                archive.write(gzip.compress(TAR_EOF))
+        os.replace(temp_path, archive_path)
+        shutil.rmtree(self.parts_dir)
+        return len(shards)
+
+#---------------------------------------------------------
+# Joins archives assembled without their end of archive
+# blocks into a single tar.gz
+#---------------------------------------------------------
+def join_archives(archive_path, pieces):
+    temp_path = archive_path + '.tmp'
+    with open(temp_path, 'wb') as archive:
+        for piece in pieces:
+            with open(piece, 'rb') as f:
+                shutil.copyfileobj(f, archive, 1024 * 1024)
+        archive.write(gzip.compress(TAR_EOF))
+    os.replace(temp_path, archive_path)
+
+#---------------------------------------------------------
+# Length of the complete gzip members at the start of a
+# shard, a killed process can leave the last one cut short
+#---------------------------------------------------------
+def complete_members_length(fname, chunk_size=1024 * 1024):
+    complete = 0
+    position = 0
+    member = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(fname, 'rb') as f:
+        pending = b''
+        while True:
+            if not pending:
+                pending = f.read(chunk_size)
+                if not pending:
+                    break
+                position += len(pending)
+            try:
+                member.decompress(pending)
+            except zlib.error:
+                break
+            if member.eof:
+                # What was read past the end of the member starts the next one
+                pending = member.unused_data
+                complete = position - len(pending)
+                member = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                pending = b''
+    return complete
+
+def copy_bytes(source, destination, length, chunk_size=1024 * 1024):
+    while length > 0:
+        chunk = source.read(min(chunk_size, length))
+        if not chunk:
+            break
+        destination.write(chunk)
+        length -= len(chunk)
@@ -0,0 +1,45 @@
+import json
+import os
+from .appender import LineAppender
+
+# Operations
+ADD = 'add'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# ============================================================================
+# Change feed
+# ============================================================================
+class ChangeFeed(LineAppender):
+    """append-only change feed
+
+    One JSON object per line for every file a run added, updated or
+    deleted: the ORCID iD, the path of the file relative to the
+    ORCID_public_data_files folder, the operation, the size and ETag of
+    the object when they are known and its last modified date. Every run
+    writes its own feed, so indexers only need to read the feeds they did
+    not process yet.
+
+    The worker processes can add to the same feed. The feed is named .part
+    until it is closed, so the feed of a run that was killed is never
+    mistaken for a complete one.
+
+    """
+    def __init__(self, fname, sync_every=1000, sync_interval=1):
+        LineAppender.__init__(self, fname + '.part', sync_every, sync_interval)
+        # The name of the complete feed
+        self.fname = fname
+
+    def add(self, orcid, path, operation, size=None, etag=None, last_modified=None):
+        self.write(json.dumps({
+            'orcid': orcid,
+            'path': path,
+            'op': operation,
+            'size': size,
+            'etag': etag.strip('"') if etag else None,
+            'last_modified': str(last_modified) if last_modified is not None else None,
+        }, separators=(',', ':')) + '\n')
+
+    def close(self):
+        LineAppender.close(self)
+        os.replace(self.fname + '.part', self.fname)
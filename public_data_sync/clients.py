@@ -0,0 +1,53 @@
+import threading
+
+# ============================================================================
+# S3 clients
+# ============================================================================
+class Clients(object):
+    """S3 clients shared by runs
+
+    Creating a boto3 session and its clients loads the botocore service
+    models, which takes longer than a small sync, so they are created on
+    first use and reused by every run given the same Clients. boto3 itself
+    is only imported then. A session can be given to use credentials other
+    than the default ones.
+
+    s3client lists the buckets and reads the lambda file with the retries
+    of botocore, download_client has them disabled, downloads retry on
+    their own with backoff so throttling is seen by the concurrency
+    limiter.
+
+    """
+    def __init__(self, endpoint_url=None, session=None):
+        self.endpoint_url = endpoint_url
+        self._session = session
+        self._s3client = None
+        self._download_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import boto3.session
+                self._session = boto3.session.Session()
+            return self._session
+
+    @property
+    def s3client(self):
+        if self._s3client is None:
+            client = self.session.client('s3', endpoint_url=self.endpoint_url)
+            with self._lock:
+                if self._s3client is None:
+                    self._s3client = client
+        return self._s3client
+
+    @property
+    def download_client(self):
+        if self._download_client is None:
+            from botocore.config import Config
+            client = self.session.client('s3', endpoint_url=self.endpoint_url, config=Config(retries={'max_attempts': 0}))
+            with self._lock:
+                if self._download_client is None:
+                    self._download_client = client
+        return self._download_client
@@ -0,0 +1,111 @@
+import threading
+import time
+
+# ============================================================================
+# Fixed concurrency limit
+# ============================================================================
+class ConcurrencyLimiter(object):
+    """fixed concurrency limit
+
+    Bounds the number of requests in flight, every acquire must be
+    followed by a release once the request completes.
+
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            self._completed(latency, throttled)
+            self._condition.notify_all()
+
+    def _completed(self, latency, throttled):
+        pass
+
+    def wait_idle(self):
+        with self._condition:
+            while self.in_flight:
+                self._condition.wait()
+
+# ============================================================================
+# Adaptive concurrency limit
+# ============================================================================
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """AIMD concurrency limit
+
+    Measures throughput and latency over windows of completed requests.
+    The limit grows by one request after every window in which throughput
+    improved, it is cut by a tenth when latency climbs well above the
+    best latency seen, and halved, at most once per window, when requests
+    are throttled or time out. Every few windows without a change the limit
+    is raised anyway, to find out whether the link has more room.
+
+    """
+    def __init__(self, logger, min_limit, max_limit, initial_limit=None, latency_tolerance=2.0, probe_windows=10):
+        ConcurrencyLimiter.__init__(self, initial_limit or min(max_limit, max(min_limit, 8)))
+        self._logger = logger
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.probe_windows = probe_windows
+        self._best_latency = None
+        self._last_throughput = 0
+        self._stable_windows = 0
+        self._new_window(time.time())
+
+    def _new_window(self, now):
+        self._window_start = now
+        self._window_count = 0
+        self._window_latency = 0.0
+        self._window_throttled = False
+
+    def _completed(self, latency, throttled):
+        if throttled:
+            # Multiplicative decrease, once per window
+            if not self._window_throttled:
+                self._set_limit(self.limit / 2, 'throttled')
+            self._window_throttled = True
+        if latency is not None:
+            self._window_count += 1
+            self._window_latency += latency
+        if self._window_count >= max(int(self.limit), 10):
+            self._end_window()
+
+    def _end_window(self):
+        now = time.time()
+        elapsed = max(now - self._window_start, 1e-6)
+        throughput = self._window_count / elapsed
+        latency = self._window_latency / self._window_count
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+
+        if self._window_throttled:
+            self._stable_windows = 0
+        elif latency > self._best_latency * self.latency_tolerance:
+            self._set_limit(self.limit * 0.9, 'latency rising to %.3fs' % latency)
+            self._stable_windows = 0
+        elif throughput > self._last_throughput * 1.02:
+            self._set_limit(self.limit + 1, '%.1f requests/s' % throughput)
+            self._stable_windows = 0
+        else:
+            self._stable_windows += 1
+            if self._stable_windows >= self.probe_windows:
+                self._set_limit(self.limit + 1, 'probing at %.1f requests/s' % throughput)
+                self._stable_windows = 0
+        self._last_throughput = throughput
+        self._new_window(now)
+
+    def _set_limit(self, limit, reason):
+        previous = int(self.limit)
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        if int(self.limit) != previous:
+            self._logger.info('Concurrency limit %s -> %s (%s)', previous, int(self.limit), reason)
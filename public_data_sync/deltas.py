@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import shutil
+import tarfile
+from collections import namedtuple
+from . import change_feed
+from . import lambda_file
+from .archive import ArchiveWriter
+
+logger = logging.getLogger('deltas')
+
+# Members of a delta archive that are not files of the tree
+METADATA_MEMBER = 'delta.json'
+DELETIONS_MEMBER = 'deletions.txt'
+
+# Name of the shards and the list of change feeds of the delta being written,
+# the same for every run so the next one carries on with a killed run's files
+# whatever date its records were modified after
+WORKSPACE = 'ORCID-API-3.0_delta'
+
+# What a delta archive holds: its metadata, the paths of the files it adds or
+# replaces and the paths of the files it deletes
+DeltaInfo = namedtuple('DeltaInfo', ['path', 'metadata', 'files', 'deletions'])
+
+#---------------------------------------------------------
+# Opens a tar.gz written by ArchiveWriter, a sequence of
+# gzip members the stream mode of tarfile stops reading
+# after the first one, the entries are still read in order
+#---------------------------------------------------------
+def open_archive(path):
+    return tarfile.open(path, 'r:gz')
+
+#---------------------------------------------------------
+# Name of the delta archive of a sync started at the
+# given time
+#---------------------------------------------------------
+def delta_name(started):
+    return 'ORCID-API-3.0_delta_' + started.strftime('%Y%m%d%H%M%S') + '.tar.gz'
+
+#---------------------------------------------------------
+# The files and the deletions of a delta, read from the
+# change feeds of the runs that wrote it, in order
+#---------------------------------------------------------
+def read_changes(feeds):
+    """Returns the number of files a delta holds and the paths it deletes
+
+    Only the last change of every path counts, a file deleted by a run
+    that was killed and synced again by the next one is not deleted. The
+    feed of a killed run is still named .part.
+
+    """
+    last = {}
+    for feed in feeds:
+        with open(feed if os.path.exists(feed) else feed + '.part') as f:
+            for line in f:
+                # A line without its newline was cut short by a killed run
+                if not line.endswith('\n'):
+                    continue
+                change = json.loads(line)
+                last.pop(change['path'], None)
+                last[change['path']] = change['op']
+    deleted = [path for path, operation in last.items() if operation == change_feed.DELETE]
+    return len(last) - len(deleted), deleted
+
+#---------------------------------------------------------
+# Metadata of a delta, the records modified after
+# modified_after are in it up to the ones the next sync
+# starts from
+#---------------------------------------------------------
+def metadata(started, modified_after, next_sync, files, deletions):
+    return {
+        'started': str(started),
+        'modified_after': str(modified_after),
+        'next_sync': str(next_sync),
+        'files': files,
+        'deletions': deletions,
+    }
+
+#---------------------------------------------------------
+# Reads the metadata, the files and the deletions of a
+# delta archive, without extracting its files
+#---------------------------------------------------------
+def read_delta(path):
+    info = None
+    files = set()
+    deletions = []
+    with open_archive(path) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name == METADATA_MEMBER:
+                info = json.loads(tar.extractfile(member).read().decode('utf-8'))
+            elif member.name == DELETIONS_MEMBER:
+                deletions = [line for line in tar.extractfile(member).read().decode('utf-8').split('\n') if line]
+            else:
+                files.add(member.name)
+    if info is None:
+        raise ValueError(path + ' is not a delta archive, it has no ' + METADATA_MEMBER)
+    return DeltaInfo(path, info, files, deletions)
+
+#---------------------------------------------------------
+# Reads the given deltas and puts them in the order they
+# were written, every one must start where the previous
+# one left off
+#---------------------------------------------------------
+def read_chain(paths):
+    chain = sorted((read_delta(path) for path in paths), key=lambda delta: lambda_file.parse_last_modified(delta.metadata['started']))
+    for previous, delta in zip(chain, chain[1:]):
+        # A sync covers the records modified after the date the previous one says the next sync starts from
+        if lambda_file.parse_last_modified(delta.metadata['modified_after']) > lambda_file.parse_last_modified(previous.metadata['next_sync']):
+            raise ValueError('The records modified between ' + previous.metadata['next_sync'] + ' and ' + delta.metadata['modified_after'] + ' are missing, ' + previous.path + ' is not followed by ' + delta.path)
+    return chain
+
+#---------------------------------------------------------
+# Applies deltas to an extracted dump, in the order they
+# were written
+#---------------------------------------------------------
+def apply_to_tree(tree, paths):
+    """Writes the files of every delta to tree and deletes the files it deleted
+
+    tree is the ORCID_public_data_files folder. Returns the number of files
+    written and deleted.
+
+    """
+    written = 0
+    deleted = 0
+    for delta in read_chain(paths):
+        logger.info('Applying %s, records modified after %s', delta.path, delta.metadata['modified_after'])
+        with open_archive(delta.path) as tar:
+            for member in tar:
+                if not member.isfile() or member.name in (METADATA_MEMBER, DELETIONS_MEMBER):
+                    continue
+                file_path = os.path.join(tree, member.name)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                # Write to a temporary file so an interrupted apply never leaves a truncated file behind
+                with open(file_path + '.part', 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                os.replace(file_path + '.part', file_path)
+                written += 1
+        for name in delta.deletions:
+            try:
+                os.remove(os.path.join(tree, name))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+    return written, deleted
+
+#---------------------------------------------------------
+# Writes a new dump, the base dump with the deltas applied
+#---------------------------------------------------------
+def apply_to_archive(base, output, paths, threads=os.cpu_count()):
+    """Writes to output the files of the base dump updated by the deltas
+
+    Only the last version of every file is written, the files of the base
+    dump that a delta replaced or deleted are left out. The base dump only
+    holds one stream, the summaries or the activities, and only the files
+    of the deltas under the same folder are added. The output is compressed
+    on threads. Returns the number of files written.
+
+    """
+    chain = read_chain(paths)
+    # The delta holding the last version of every file, None when the file ends up deleted
+    latest = {}
+    for index, delta in enumerate(chain):
+        for name in delta.files:
+            latest[name] = index
+        for name in delta.deletions:
+            latest[name] = None
+
+    writer = ArchiveWriter(output + '.parts', threads=threads)
+    written = 0
+    folders = set()
+    logger.info('Copying the files of %s that the deltas did not change', base)
+    with open_archive(base) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            folders.add(member.name.split('/', 1)[0])
+            if member.name in latest:
+                continue
+            writer.add(member.name, tar.extractfile(member).read(), member.mtime)
+            written += 1
+
+    for index, delta in enumerate(chain):
+        logger.info('Adding the files of %s', delta.path)
+        with open_archive(delta.path) as tar:
+            # A file synced twice, by a run resuming the delta or for a record listed twice by the lambda file, is in it twice, the last copy is the newest
+            members = {}
+            for member in tar:
+                if member.isfile() and latest.get(member.name) == index and member.name.split('/', 1)[0] in folders:
+                    members[member.name] = member
+            # Read in the order they are stored, the archive is only read once
+            for member in sorted(members.values(), key=lambda member: member.offset):
+                writer.add(member.name, tar.extractfile(member).read(), member.mtime)
+                written += 1
+    writer.assemble(output)
+    return written
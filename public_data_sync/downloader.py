@@ -0,0 +1,948 @@
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing import Process
+from xml.etree.ElementTree import ParseError
+from . import CustomLogHandler
+from . import change_feed
+from . import lambda_file
+from . import partitions
+from . import profiling
+from . import sharding
+from . import transfer
+from . import transform
+from . import verification
+from .archive import ArchiveWriter
+from .archive import join_archives
+from .change_feed import ChangeFeed
+from .clients import Clients
+from .concurrency import AdaptiveLimiter
+from .concurrency import ConcurrencyLimiter
+from .journal import ProgressJournal
+from .keylist import KeyList
+from .keylist import read_key_list
+from .manifest import Manifest
+from .metrics import Metrics
+from .metrics import MetricsFile
+from .packed_store import PackedStore
+from .pipeline import OrderedCheckpoint
+from .pipeline import WorkerPipeline
+
+logger = logging.getLogger('download')
+# One message per downloaded file, sampled or rate limited with --log-sample and --log-rate
+file_logger = logging.getLogger('download.files')
+
+# Outcome of a download, the number of files that failed and the change feed of the run
+DownloadResult = namedtuple('DownloadResult', ['failed', 'changes'])
+
+# The run the download workers belong to, set before they are forked
+_run = None
+
+#---------------------------------------------------------
+# Command line flags, their defaults are the defaults of
+# the configuration
+#---------------------------------------------------------
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--path', help='Path to place the public data files', default='./')
+    parser.add_argument('-s', '--summaries', help='Download summaries', action='store_true')
+    parser.add_argument('-a', '--activities', help='Download activities', action='store_true')
+    parser.add_argument('-t', '--tar', help='Compress the dump, the files are added to the archive as they are downloaded', action='store_true')
+    parser.add_argument('--no-files', help='With -t or --transform, only write the archive or the NDJSON shards, the downloaded files are not kept in the local tree', action='store_true')
+    parser.add_argument('-r', '--recovery', help='Start recovery process', action='store_true')
+    parser.add_argument('-max', '--max_threads', default=60)
+    parser.add_argument('--adaptive', help='Adapt the number of concurrent downloads to the throughput, backing off when S3 throttles, up to -max (or --connections with the async engine)', action='store_true')
+    parser.add_argument('--retries', help='The number of times a throttled or timed out download is retried', default=5)
+    parser.add_argument('-e', '--engine', help='The download engine: pool downloads with a pool of processes, async downloads from a single process with asyncio (requires aiohttp)', choices=['pool', 'async'], default='pool')
+    parser.add_argument('--connections', help='The maximum number of open connections used by the async engine', default=500)
+    parser.add_argument('-v', '--verbose', help='Print the name of the downloading files.', action='store_true')
+    parser.add_argument('-l', '--log', help='Set the logging level, DEBUG by default', default='DEBUG')
+    parser.add_argument('--log-format', help='The format of the log file: text, or json for one JSON object per line', choices=['text', 'json'], default='text')
+    parser.add_argument('--log-sample', help='Only log one out of every N downloaded files', type=int, default=1)
+    parser.add_argument('--log-rate', help='Log at most N downloaded files per second in each process', type=int)
+    parser.add_argument('-n', '--page-size', help='The number of s3 items to list in one page', default=1000)
+    parser.add_argument('--listers', help='The number of checksum partitions listed at the same time', default=8)
+    parser.add_argument('-q', '--queue-size', help='The maximum number of keys queued for download, twice the page size by default')
+    parser.add_argument('-f', '--force', help='Download every file, even the ones the manifest says are already up to date', action='store_true')
+    parser.add_argument('--manifest', help='The manifest file that keeps track of the downloaded files', default='manifest.db')
+    parser.add_argument('--metrics-dir', help='The directory where the stats files with the throughput, latency and error metrics are written', default='./')
+    parser.add_argument('--metrics-interval', help='The number of seconds between two updates of the stats files', default=10)
+    parser.add_argument('--verify', help='Check the local files against the bucket listings instead of downloading them, the missing, truncated, corrupted and orphaned files are written to the --report file', action='store_true')
+    parser.add_argument('--md5', help='When verifying, also compare the MD5 of every local file with the ETag of its object', action='store_true')
+    parser.add_argument('--report', help='The file the verify mode writes its findings to', default='verify.tsv')
+    parser.add_argument('--hash-threads', help='The number of threads hashing local files in the verify mode, one per CPU by default', type=int, default=os.cpu_count())
+    parser.add_argument('--fetch-list', help='Only download the keys listed in the given file, a verify report or a dead-letter file')
+    parser.add_argument('--dead-letter', help='The file every key that failed to download is written to, with its bucket and error', default='dead_letter.tsv')
+    parser.add_argument('--replay', help='Only download the keys of the dead-letter file, the ones that fail again are written back to it', action='store_true')
+    parser.add_argument('--store', help='Where the activities are kept: files, one file per activity in the local tree, or packed, appended to the large segment files of a packed store in activities.pack/', choices=['files', 'packed'], default='files')
+    parser.add_argument('--transform', help='Also write every downloaded file, parsed, as one JSON object per line to gzip compressed NDJSON shards in the given directory')
+    parser.add_argument('--transform-fields', help='A JSON file mapping the fields to write with --transform to their element paths, like {"family_name": "person/name/family-name"}, the whole documents are written by default')
+    parser.add_argument('--transform-shard-size', help='The size in MB at which the NDJSON shards are rotated', type=int, default=256)
+    parser.add_argument('--changes-dir', help='The directory where every run writes its change feed, one JSON object per line for every file it added or updated', default='changes')
+    parser.add_argument('--shard', help='Only download one slice of the checksum prefixes, given as <shard>/<number of shards> like 2/8, so several hosts can share a download', type=sharding.parse_shard)
+    parser.add_argument('--shard-dir', help='The directory all the shards share, each one writes a completion marker there, and its archive with -t', default='./')
+    parser.add_argument('--merge-shards', help='Check every one of the given number of shards finished, join their archives with -t and update last_ran.config', type=int)
+    parser.add_argument('--profile', help='Profile every process of the run into the given directory: CPU profiles, stack samples and the time spent listing, downloading, writing files, creating folders, cleaning up and logging, merged into profile.pstats, profile.collapsed and report.txt once the run ends')
+    parser.add_argument('--profile-memory', help='With --profile, also trace the memory allocations of every process and add the lines still holding the most memory to the report', action='store_true')
+    parser.add_argument('--endpoint-url', help='The URL of an S3 compatible endpoint to use instead of AWS S3 (to override for testing and benchmarks)')
+    parser.add_argument('-x', '--summaries-bucket', help='The name of the summaries bucket (to override for testing)', default='v3.0-summaries')
+    parser.add_argument('-y', '--activities-bucket-base', help='The base name of the activities bucket (to override for testing)', default='v3.0-activities')
+    return parser
+
+#---------------------------------------------------------
+# Configuration of a download, the defaults of the flags
+# with the given options
+#---------------------------------------------------------
+def config(**options):
+    """Returns the configuration of a download
+
+    Options are named after the long form of the command line flags, with
+    underscores, like config(path='/data', activities=True, tar=True).
+
+    """
+    values = create_parser().parse_args([])
+    for name, value in options.items():
+        if not hasattr(values, name):
+            raise TypeError('Unknown download option ' + name)
+        setattr(values, name, value)
+    return values
+
+#---------------------------------------------------------
+# Download the buckets, or the part of them the
+# configuration asks for
+#---------------------------------------------------------
+def download(config, clients=None):
+    """Runs a download and returns a DownloadResult
+
+    clients is a Clients, created from the endpoint_url of the
+    configuration when it is not given, pass the same one to every run so
+    its S3 clients are reused. Only one download runs at a time in a
+    process, the summaries and activities are downloaded by forked
+    processes. Nothing is logged unless the download logger, or the root
+    logger, has a handler.
+
+    """
+    global _run
+    _run = Download(config, clients or Clients(config.endpoint_url))
+    profiler = profiling.start(config.profile, 'main', config.profile_memory) if config.profile else None
+    try:
+        return _run.run()
+    finally:
+        _run = None
+        if profiler is not None:
+            logger.info('The profile of this run is in ' + profiler.report())
+
+#---------------------------------------------------------
+# Worker functions, they run the methods of the download
+# they were forked from
+#---------------------------------------------------------
+def download_summary(element):
+    return _run.download_summary(element)
+
+def download_activity(element):
+    return _run.download_activity(element)
+
+# ============================================================================
+# Download run
+# ============================================================================
+class Download(object):
+    """download run
+
+    Holds the configuration and the state of a single download: the
+    clients, the manifest, the metrics and, once the streams start, the
+    archive, packed store and NDJSON shards of the stream each process
+    downloads.
+
+    """
+    def __init__(self, config, clients):
+        self.config = config
+        self.s3client = clients.s3client
+        self.download_client = clients.download_client
+
+        now = datetime.now()
+        self.month = str(now.month)
+        self.year = str(now.year)
+        self.start_time = now
+
+        path = config.path if config.path.endswith('/') else (config.path + '/')
+        self.path = path + 'ORCID_public_data_files/'
+        self.download_summaries = config.summaries
+        self.download_activities = config.activities
+        self.recovery = config.recovery
+        self.tar_dump = config.tar
+        self.no_files = config.no_files
+        self.verbose = config.verbose
+        self.page_size = int(config.page_size)
+        self.summaries_bucket = config.summaries_bucket
+        self.activities_bucket_base = config.activities_bucket_base
+        self.force = config.force
+        self.verify = config.verify
+        self.verify_md5 = config.md5
+        self.fetch_list = config.fetch_list
+        self.replay = config.replay
+        if self.replay:
+            # Keys being replayed are moved aside, so the ones failing again start a new dead-letter file
+            self.fetch_list = config.dead_letter + '.replay'
+        self.projection = transform.load_projection(config.transform_fields) if config.transform_fields else None
+        self.shard = config.shard
+        self.shard_dir = config.shard_dir
+        # The checksum prefixes downloaded by this host, all of them unless it runs a shard
+        self.checksums = partitions.shard_checksums(self.shard[0], self.shard[1]) if self.shard else partitions.CHECKSUMS
+        self.shard_suffix = '-' + sharding.shard_name(*self.shard) if self.shard else ''
+        self.metrics_dir = config.metrics_dir
+        self.metrics_interval = float(config.metrics_interval)
+        self.max_threads = int(config.max_threads)
+        self.engine = config.engine
+        self.adaptive = config.adaptive
+        self.max_retries = int(config.retries)
+        self.listers = int(config.listers)
+        self.connections = int(config.connections)
+        self.queue_size = int(config.queue_size) if config.queue_size else max(2 * self.page_size, self.max_threads, 4 * self.connections if self.engine == 'async' else 0)
+
+        # ETag, size and last modified date of the files already downloaded
+        self.manifest = Manifest(config.manifest)
+
+        # Collected by the process of each stream, in the parent of the download workers
+        self.metrics = Metrics()
+
+        # Keys that failed to download, opened by the main process before the streams start
+        self.dead_letters = None
+
+        # Files added and updated by this run, opened by the main process before the streams start
+        self.changes = None
+
+        # With -t, the archive of the stream, opened by its process before the workers are forked
+        self.archive = None
+
+        # With --store packed, the store of the activities, opened by their process before the workers are forked
+        self.store = None
+
+        # With --transform, the NDJSON shards of the stream, opened by its process before the workers are forked
+        self.ndjson = None
+
+    #---------------------------------------------------------
+    # Main process
+    #---------------------------------------------------------
+    def run(self):
+        config = self.config
+        if self.download_summaries is False and self.download_activities is False:
+            logger.error('Please specify the elements you want to download using the -s or -a flag')
+            raise RuntimeError('Please specify the elements you want to download using the -s or -a flag')
+
+        if config.merge_shards:
+            self.merge_shards(config.merge_shards)
+            return DownloadResult(0, None)
+
+        if self.no_files and (not (self.tar_dump or config.transform) or self.fetch_list or self.verify):
+            logger.error('The --no-files flag only works with -t or --transform on a full download')
+            raise RuntimeError('The --no-files flag only works with -t or --transform on a full download')
+
+        # Create the path directory
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        if self.shard:
+            os.makedirs(self.shard_dir, exist_ok=True)
+
+        logger.info('About to start syncing local folder with s3 buckets')
+
+        # Both processes append to the same report
+        if self.verify:
+            open(config.report, 'w').close()
+
+        # A full run tries every key again, a replay moves the keys it replays aside
+        if self.replay:
+            # Added to the keys an interrupted replay may have left behind
+            with open(self.fetch_list, 'a') as replaying:
+                if os.path.exists(config.dead_letter):
+                    with open(config.dead_letter) as failed_keys:
+                        shutil.copyfileobj(failed_keys, replaying)
+                    os.remove(config.dead_letter)
+        elif not self.recovery and not self.fetch_list and not self.verify:
+            open(config.dead_letter, 'w').close()
+        self.dead_letters = KeyList(config.dead_letter)
+        if not self.verify:
+            os.makedirs(config.changes_dir, exist_ok=True)
+            self.changes = ChangeFeed(os.path.join(config.changes_dir, 'download-' + self.start_time.strftime('%Y%m%d%H%M%S') + self.shard_suffix + '.ndjson'))
+
+        # Define threads
+        summaries_thread = Process(target=self.process_summaries)
+        activities_thread = Process(target=self.process_activities)
+
+        # Start threads
+        summaries_thread.start()
+        activities_thread.start()
+
+        # Join threads
+        summaries_thread.join()
+        activities_thread.join()
+
+        self.dead_letters.close()
+        self.manifest.close()
+        if self.changes is not None:
+            self.changes.close()
+            logger.info('The changes of this run are in ' + self.changes.fname)
+        if self.replay:
+            os.remove(self.fetch_list)
+        with open(config.dead_letter) as f:
+            failed = sum(1 for line in f)
+        if failed:
+            logger.warning('%s files failed to download, they are listed in %s, run again with --replay to download just those', failed, config.dead_letter)
+        logger.info('Download process is done')
+
+        # keep track of the last time this process ran, only a full download moves it, a sharded one moves it once merged
+        if not self.verify and not self.fetch_list and not self.shard:
+            file = open('last_ran.config', 'w')
+            file.write(str(self.start_time))
+            file.close()
+        return DownloadResult(failed, self.changes.fname if self.changes is not None else None)
+
+    #---------------------------------------------------------
+    # Download a single summary file
+    #---------------------------------------------------------
+    def download_summary(self, element):
+        summaries_bucket = element[0]
+        file_to_download = element[1]
+        components = file_to_download.split('/')
+        # Checksum
+        checksum = components[0]
+        # File name
+        name = components[1]
+
+        if self.verbose:
+            print(name)
+
+        file_path = self.path + 'summaries/' + checksum + '/'
+        file_logger.info('Downloading %s to %s', name, file_path)
+
+        # Create the path directory
+        try:
+            with profiling.span('mkdir'):
+                if not self.no_files and not os.path.exists(file_path):
+                    os.makedirs(file_path)
+        except:
+            pass
+
+        # Downloading the file, throttled requests are retried
+        if self.fetch_in_memory():
+            result = self.fetch_download(summaries_bucket, file_to_download, 'summaries/', file_path + name)
+        else:
+            result = transfer.download(self.download_client, summaries_bucket, file_to_download, file_path + name, self.max_retries)
+        if not result.downloaded:
+            logger.error('Error fetching ' + file_to_download + ': ' + result.error)
+        return result
+
+    #---------------------------------------------------------
+    # Download a single activity file
+    #---------------------------------------------------------
+    def download_activity(self, element):
+        activities_bucket = element[0]
+        file_to_download = element[1]
+        components = file_to_download.split('/')
+        # Checksum
+        checksum = components[0]
+        # ORCID
+        orcid = components[1]
+        # Activity type
+        type = components[2]
+        # File name
+        name = components[3]
+
+        file_path = self.path + 'activities/' + checksum + '/' + orcid + '/' + type + '/'
+        file_logger.info('Downloading %s to %s', name, file_path)
+
+        # Create the path directory
+        try:
+            with profiling.span('mkdir'):
+                if not self.no_files and self.store is None and not os.path.exists(file_path):
+                    os.makedirs(file_path)
+        except:
+            pass
+
+        # Downloading the file, throttled requests are retried
+        if self.fetch_in_memory():
+            result = self.fetch_download(activities_bucket, file_to_download, 'activities/', file_path + name)
+        else:
+            result = transfer.download(self.download_client, activities_bucket, file_to_download, file_path + name, self.max_retries)
+        if not result.downloaded:
+            logger.error('Error fetching ' + file_to_download + ': ' + result.error)
+        return result
+
+    #---------------------------------------------------------
+    # Download a file into memory for the archive, the packed
+    # store or the transform stage, it is written to the local
+    # tree as well unless it is packed or --no-files is given
+    #---------------------------------------------------------
+    def fetch_in_memory(self):
+        return self.archive is not None or self.store is not None or self.ndjson is not None
+
+    def fetch_download(self, bucket, key, directory_name, file_path):
+        result, data = transfer.fetch(self.download_client, bucket, key, self.max_retries)
+        if result.downloaded:
+            self.keep(directory_name, key, data)
+            # The main process journals the file once this returns, and a resumed run skips it
+            self.flush_kept()
+            if self.store is None and not self.no_files:
+                # Write to a temporary file so a failed write never leaves a truncated file behind
+                with profiling.span('write'):
+                    with open(file_path + '.part', 'wb') as f:
+                        f.write(data)
+                    os.replace(file_path + '.part', file_path)
+        return result
+
+    #---------------------------------------------------------
+    # Add the content of a file to the archive, the packed
+    # store and the NDJSON shards
+    #---------------------------------------------------------
+    def keep(self, directory_name, key, data, stored=False):
+        if self.archive is not None:
+            self.archive.add(directory_name + key, data)
+        if self.store is not None and not stored:
+            with profiling.span('write'):
+                self.store.put(key, data)
+        if self.ndjson is not None:
+            try:
+                self.ndjson.write(transform.entry(key, data, self.projection))
+            except ParseError as e:
+                logger.error('Error transforming %s: %s', key, transfer.describe_error(e))
+                self.metrics.inc('transform_errors_total')
+
+    #---------------------------------------------------------
+    # Archive and transform an up to date file, it is not
+    # downloaded again
+    #---------------------------------------------------------
+    def keep_local_file(self, directory_name, key):
+        if self.store is not None:
+            data = self.store.get(key)
+            if data is None:
+                raise FileNotFoundError(key)
+        else:
+            with open(self.path + directory_name + key, 'rb') as f:
+                data = f.read()
+        self.keep(directory_name, key, data, True)
+
+    #---------------------------------------------------------
+    # Write out the files kept by this process
+    #---------------------------------------------------------
+    def flush_kept(self):
+        if self.archive is not None:
+            self.archive.flush()
+        if self.ndjson is not None:
+            self.ndjson.flush()
+
+    #---------------------------------------------------------
+    # Move a file the async engine downloaded to the tree into
+    # the archive, the packed store and the NDJSON shards
+    #---------------------------------------------------------
+    def keep_downloaded_file(self, directory_name, key):
+        file_path = self.engine_path(directory_name, key)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        self.keep(directory_name, key, data)
+        if self.store is not None or self.no_files:
+            with profiling.span('cleanup'):
+                os.remove(file_path)
+
+    #---------------------------------------------------------
+    # Whether the manifest says the local copy of a listed
+    # file is up to date, in the tree or in the packed store
+    #---------------------------------------------------------
+    def is_current(self, bucket, element, directory_name):
+        if self.store is not None:
+            return self.manifest.is_current(bucket, element['Key'], element['ETag'], element['Size'], element['Key'], self.store.getsize)
+        return self.manifest.is_current(bucket, element['Key'], element['ETag'], element['Size'], self.path + directory_name + element['Key'])
+
+    #---------------------------------------------------------
+    # Bucket, key and local path of the element to download
+    #---------------------------------------------------------
+    def summary_target(self, element):
+        return element[0], element[1], self.engine_path('summaries/', element[1])
+
+    def activity_target(self, element):
+        return element[0], element[1], self.engine_path('activities/', element[1])
+
+    def engine_path(self, directory_name, key):
+        # Files only downloaded to be archived or packed wait in a flat folder, the tree is never created
+        if self.store is not None or self.no_files:
+            return self.path + 'incoming/' + (directory_name + key).replace('/', '_')
+        return self.path + directory_name + key
+
+    #---------------------------------------------------------
+    # Create the pipeline that downloads the listed elements
+    #---------------------------------------------------------
+    def create_pipeline(self, stream, worker, target):
+        if self.engine == 'async':
+            # asyncio is only loaded by the runs that use it
+            from .async_engine import AsyncPipeline
+            return AsyncPipeline(file_logger, self.s3client, target, self.connections, self.queue_size, self.create_limiter(self.connections), self.max_retries)
+        return WorkerPipeline(logger, worker, self.max_threads, self.queue_size, self.create_limiter(self.max_threads), profiling.start_process, (stream + '-worker',))
+
+    #---------------------------------------------------------
+    # Limit the number of downloads in flight, either to the
+    # given maximum or adapting it to the throughput
+    #---------------------------------------------------------
+    def create_limiter(self, max_in_flight):
+        if self.adaptive:
+            return AdaptiveLimiter(logger, 1, max_in_flight)
+        return ConcurrencyLimiter(max_in_flight)
+
+    #---------------------------------------------------------
+    # Compress the given directory
+    #---------------------------------------------------------
+    def compress(self, tar_path, directory_name):
+        # Compress directory
+        logger.info('Compressing ' + tar_path + ' -C ' + self.path + ' directory_name: ' + directory_name)
+        proc = subprocess.Popen(['tar', '-czf', tar_path, '-C', self.path, directory_name])
+        proc.communicate()
+        logger.info(tar_path + ' compressed')
+
+    #---------------------------------------------------------
+    # Open the archive the downloaded files are written to,
+    # a run that only fetches some keys compresses the tree
+    #---------------------------------------------------------
+    def open_archive(self, tar_path):
+        if self.tar_dump and not self.fetch_list:
+            # Workers compress their own shard, the async engine compresses on threads
+            self.archive = ArchiveWriter(tar_path + '.parts', self.recovery, threads=os.cpu_count() if self.engine == 'async' else 1)
+
+    def close_archive(self, tar_path, directory_name):
+        if self.archive is not None:
+            if self.shard:
+                # The archive of a shard is a piece of the whole one, joined by --merge-shards
+                tar_path = os.path.join(self.shard_dir, tar_path + self.shard_suffix)
+            if self.recovery and self.archive.is_empty():
+                # The run that was resumed had downloaded every file, its archive is never replaced by an empty one
+                if os.path.exists(tar_path):
+                    logger.info('No file was left to add to ' + tar_path + ', it is kept as it is')
+                    self.archive.discard()
+                    return
+                if self.store is None and not self.no_files and not self.shard:
+                    logger.warning(tar_path + ' is missing and no file was left to add to it, it is compressed from the local tree')
+                    self.archive.discard()
+                    self.compress(tar_path, directory_name)
+                    return
+                logger.warning('No file was left to add to ' + tar_path + ', which is missing, the files of the run that was resumed are not in it')
+            logger.info('Assembling ' + tar_path)
+            shards = self.archive.assemble(tar_path, not self.shard)
+            logger.info(tar_path + ' written from ' + str(shards) + ' shards')
+        elif self.tar_dump and self.store is not None:
+            logger.warning('The packed store is only archived by a full download, ' + tar_path + ' was not written')
+        elif self.tar_dump:
+            self.compress(tar_path, directory_name)
+
+    #---------------------------------------------------------
+    # Open the packed store of the activities, it is compacted
+    # in the background while the download runs
+    #---------------------------------------------------------
+    def open_store(self):
+        if self.config.store == 'packed':
+            self.store = PackedStore(self.path + 'activities.pack').start_compactor(logger)
+
+    def close_store(self):
+        if self.store is not None:
+            self.store.close()
+
+    #---------------------------------------------------------
+    # Open the NDJSON shards of a stream, a full download
+    # replaces the shards of the previous one, a run fetching
+    # some keys writes delta shards of its own
+    #---------------------------------------------------------
+    def open_transform(self, stream):
+        if self.config.transform and self.fetch_list:
+            self.ndjson = transform.NdjsonWriter(os.path.join(self.config.transform, 'delta'), 'delta-' + self.start_time.strftime('%Y%m%d%H%M%S') + '-' + stream + self.shard_suffix, True, self.config.transform_shard_size * 1024 * 1024)
+        elif self.config.transform:
+            self.ndjson = transform.NdjsonWriter(os.path.join(self.config.transform, stream), stream + self.shard_suffix, self.recovery, self.config.transform_shard_size * 1024 * 1024)
+
+    def close_transform(self):
+        if self.ndjson is not None:
+            self.ndjson.close()
+
+    #---------------------------------------------------------
+    # Process summaries
+    #---------------------------------------------------------
+    def process_summaries(self):
+        if self.download_summaries:
+            profiling.start_process('summaries')
+            if self.verify:
+                self.verify_partitions(partitions.summaries_partitions(self.summaries_bucket, self.checksums), 'summaries/')
+                return
+            summaries_dump_name_xml = 'ORCID-API-3.0_xml_' + self.month + '_' + self.year + '.tar.gz'
+            self.open_archive(summaries_dump_name_xml)
+            self.open_transform('summaries')
+            pipeline = self.create_pipeline('summaries', download_summary, self.summary_target)
+            stats = self.start_metrics('summaries', pipeline)
+            if self.fetch_list:
+                self.fetch_keys([entry for entry in read_key_list(self.fetch_list) if self.in_stream('summaries', entry)], pipeline)
+            else:
+                self.process_partitions('summary' + self.shard_suffix, partitions.summaries_partitions(self.summaries_bucket, self.checksums), 'summaries/', pipeline)
+            self.manifest.close()
+            stats.stop()
+            self.close_archive(summaries_dump_name_xml, 'summaries')
+            self.close_transform()
+            self.mark_shard_done('summaries')
+
+    #---------------------------------------------------------
+    # Process activities
+    #---------------------------------------------------------
+    def process_activities(self):
+        if self.download_activities:
+            profiling.start_process('activities')
+            self.open_store()
+            if self.verify:
+                self.verify_partitions(partitions.activities_partitions(self.activities_bucket_base, self.checksums), 'activities/')
+                self.close_store()
+                return
+            activities_dump_name_xml = 'ORCID-API-3.0_activities_xml_' + self.month + '_' + self.year + '.tar.gz'
+            self.open_archive(activities_dump_name_xml)
+            self.open_transform('activities')
+            pipeline = self.create_pipeline('activities', download_activity, self.activity_target)
+            stats = self.start_metrics('activities', pipeline)
+            if self.fetch_list:
+                self.fetch_keys([entry for entry in read_key_list(self.fetch_list) if self.in_stream('activities', entry)], pipeline)
+            else:
+                self.process_partitions('activities' + self.shard_suffix, partitions.activities_partitions(self.activities_bucket_base, self.checksums), 'activities/', pipeline)
+            self.manifest.close()
+            stats.stop()
+            self.close_archive(activities_dump_name_xml, 'activities')
+            self.close_transform()
+            self.mark_shard_done('activities')
+            self.close_store()
+
+    #---------------------------------------------------------
+    # Whether an entry of a key list is a file of the given
+    # stream downloaded by this host
+    #---------------------------------------------------------
+    def in_stream(self, stream, entry):
+        if stream == 'summaries':
+            in_bucket = entry.bucket == self.summaries_bucket
+        else:
+            in_bucket = entry.bucket.startswith(self.activities_bucket_base + '-')
+        return in_bucket and entry.key[:3] in self.checksums
+
+    #---------------------------------------------------------
+    # Tell the other shards this one finished a stream, with
+    # the number of files that failed
+    #---------------------------------------------------------
+    def mark_shard_done(self, stream):
+        if self.shard:
+            started = self.start_time
+            if self.fetch_list:
+                # Fetching the files that failed completes the run the marker is about
+                marker = sharding.read_marker(self.shard_dir, stream, self.shard[0], self.shard[1])
+                if marker is not None:
+                    started = marker['started']
+            # The dead-letter file also holds the files that failed before a run resumed with -r
+            failed = len(set(entry.key for entry in read_key_list(self.config.dead_letter) if self.in_stream(stream, entry)))
+            sharding.write_marker(self.shard_dir, stream, self.shard[0], self.shard[1], started, failed)
+            logger.info('Shard %s/%s of the %s is done, %s files failed', self.shard[0], self.shard[1], stream, failed)
+
+    #---------------------------------------------------------
+    # Check every shard finished and join their archives
+    #---------------------------------------------------------
+    def merge_shards(self, shards):
+        streams = []
+        if self.download_summaries:
+            streams.append(('summaries', 'ORCID-API-3.0_xml_' + self.month + '_' + self.year + '.tar.gz'))
+        if self.download_activities:
+            streams.append(('activities', 'ORCID-API-3.0_activities_xml_' + self.month + '_' + self.year + '.tar.gz'))
+        incomplete = 0
+        started = []
+        for stream, tar_path in streams:
+            for i in range(1, shards + 1):
+                marker = sharding.read_marker(self.shard_dir, stream, i, shards)
+                if marker is None:
+                    logger.error('Shard %s/%s of the %s did not finish', i, shards, stream)
+                    incomplete += 1
+                elif marker['failed']:
+                    logger.error('Shard %s/%s of the %s finished with %s failed files, run it again with --replay on %s', i, shards, stream, marker['failed'], marker['host'])
+                    incomplete += 1
+                else:
+                    logger.info('Shard %s/%s of the %s finished on %s at %s', i, shards, stream, marker['host'], marker['finished'])
+                    started.append(marker['started'])
+        if incomplete:
+            raise RuntimeError(str(incomplete) + ' shards did not finish, see download.log')
+
+        if self.tar_dump:
+            for stream, tar_path in streams:
+                pieces = [os.path.join(self.shard_dir, tar_path + '-' + sharding.shard_name(i, shards)) for i in range(1, shards + 1)]
+                logger.info('Joining ' + str(len(pieces)) + ' shard archives into ' + tar_path)
+                join_archives(tar_path, pieces)
+                for piece in pieces:
+                    os.remove(piece)
+
+        # The next sync starts from the shard that started first
+        file = open('last_ran.config', 'w')
+        file.write(min(started, key=lambda_file.parse_last_modified))
+        file.close()
+        logger.info('All %s shards finished', shards)
+
+    #---------------------------------------------------------
+    # List the given partitions at the same time, all of them
+    # feeding the same download pipeline
+    #---------------------------------------------------------
+    def process_partitions(self, journal_name, partition_list, directory_name, pipeline):
+        journal = ProgressJournal(journal_name + '.journal')
+        if self.recovery:
+            journal.resume()
+        else:
+            journal.start()
+
+        pending = queue.Queue()
+        for bucket, prefix in partition_list:
+            if not journal.is_done(bucket + '/' + prefix):
+                pending.put((bucket, prefix))
+        logger.info('Listing ' + str(pending.qsize()) + ' partitions with ' + str(self.listers) + ' listers')
+
+        def lister():
+            while True:
+                try:
+                    bucket, prefix = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self.process_partition(bucket, prefix, directory_name, pipeline, journal)
+
+        threads = [threading.Thread(target=lister) for i in range(self.listers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pipeline.close()
+        journal.close()
+
+    #---------------------------------------------------------
+    # List a single partition, it keeps its own checkpoint
+    #---------------------------------------------------------
+    def process_partition(self, bucket, prefix, directory_name, pipeline, journal):
+        partition = bucket + '/' + prefix
+        continuation_token = journal.continuation_token(partition)
+        completed_keys = journal.completed_keys(partition)
+        # The manifest only knows every object of a partition listed from its first page with no file failing
+        listed_whole = continuation_token is None
+        failed_keys = set()
+
+        def advance(page_checkpoint):
+            journal.checkpoint(partition, page_checkpoint[0], page_checkpoint[1])
+            if page_checkpoint[0] is None:
+                self.manifest.record_listing(bucket, prefix, listed_whole and not failed_keys)
+        checkpoint = OrderedCheckpoint(advance)
+
+        # Create the paginator
+        paginator = self.s3client.get_paginator('list_objects_v2')
+        # Create a PageIterator from the Paginator
+        page_iterator = None
+        if continuation_token is not None:
+            logger.info('Resuming ' + partition + ' with ' + str(len(completed_keys)) + ' files already downloaded')
+            page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, ContinuationToken=continuation_token, PaginationConfig={'PageSize': self.page_size})
+        else:
+            page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': self.page_size})
+
+        page_count = 1
+        list_start = time.time()
+        for page in page_iterator:
+            self.record_listing(bucket, time.time() - list_start)
+            logger.info(partition + ' page count: ' + str(page_count))
+            page_count += 1
+            elements = []
+            kept = []
+            for element in page.get('Contents', []):
+                if element['Key'] in completed_keys:
+                    continue
+                if self.force or not self.is_current(bucket, element, directory_name):
+                    elements.append(element)
+                elif self.archive is not None or self.ndjson is not None:
+                    # Up to date files still belong in the archive and the NDJSON shards
+                    try:
+                        self.keep_local_file(directory_name, element['Key'])
+                        kept.append(element['Key'])
+                    except OSError:
+                        elements.append(element)
+            if kept:
+                # A resumed run lists this page again and skips the files journaled, so they are written out first
+                self.flush_kept()
+                for key in kept:
+                    journal.key_done(partition, key)
+            logger.debug(partition + ' files up to date in this page: ' + str(len(page.get('Contents', [])) - len(elements)))
+            self.metrics.inc('objects_total', len(page.get('Contents', [])) - len(elements), bucket=bucket, result='skipped')
+            last_key = page['Contents'][-1]['Key'] if page.get('Contents') else None
+            page_checkpoint = checkpoint.add_page(len(elements), (self.next_continuation_token(partition, page), last_key))
+            for element in elements:
+                pipeline.submit([bucket, element['Key']], page_checkpoint, checkpoint, self.record_download(partition, bucket, element, directory_name, journal, failed_keys))
+            list_start = time.time()
+
+    #---------------------------------------------------------
+    # Callback that adds a downloaded file to the manifest
+    # and to the progress journal, or its key to failed_keys
+    #---------------------------------------------------------
+    def record_download(self, partition, bucket, element, directory_name, journal, failed_keys):
+        def callback(item, result):
+            transfer.record_metrics(self.metrics, bucket, element['Size'], result)
+            if result.downloaded and self.engine == 'async' and self.fetch_in_memory():
+                # The async engine downloads to the tree, its files are archived, packed and transformed here
+                self.keep_downloaded_file(directory_name, element['Key'])
+                # Written out before the file is journaled
+                self.flush_kept()
+            if result.downloaded:
+                self.record_change(bucket, element['Key'], directory_name, element['Size'], element['ETag'], element['LastModified'])
+                self.manifest.record(bucket, element['Key'], element['ETag'], element['Size'], element['LastModified'])
+                journal.key_done(partition, element['Key'])
+            else:
+                failed_keys.add(element['Key'])
+                self.dead_letters.add(bucket, element['Key'], transfer.error_class(result.error), element)
+        return callback
+
+    #---------------------------------------------------------
+    # Add a downloaded file to the change feed, an update when
+    # the manifest already knows it, called before the
+    # manifest records the new version
+    #---------------------------------------------------------
+    def record_change(self, bucket, key, directory_name, size, etag, last_modified):
+        operation = change_feed.UPDATE if self.manifest.contains(bucket, key) else change_feed.ADD
+        self.changes.add(transform.describe_key(key)[0], directory_name + key, operation, size, etag, last_modified)
+
+    #---------------------------------------------------------
+    # Download only the keys of a verify report or dead-letter
+    # file, through the same pipeline
+    #---------------------------------------------------------
+    def fetch_keys(self, entries, pipeline):
+        # Nothing to resume, the list itself says what is left
+        checkpoint = OrderedCheckpoint(lambda page_checkpoint: None)
+        orphaned = 0
+        for entry in entries:
+            if entry.reason == verification.ORPHANED:
+                orphaned += 1
+                continue
+            page = checkpoint.add_page(1, None)
+            pipeline.submit([entry.bucket, entry.key], page, checkpoint, self.record_fetch(entry))
+        pipeline.close()
+        if orphaned:
+            logger.warning('%s orphaned files are not in S3, they were left in place', orphaned)
+
+    def record_fetch(self, entry):
+        def callback(item, result):
+            transfer.record_metrics(self.metrics, entry.bucket, entry.size or 0, result)
+            if result.downloaded:
+                directory_name = 'summaries/' if entry.bucket == self.summaries_bucket else 'activities/'
+                self.record_change(entry.bucket, entry.key, directory_name, entry.size, entry.etag, entry.last_modified)
+                if entry.etag:
+                    self.manifest.record(entry.bucket, entry.key, entry.etag, entry.size, entry.last_modified)
+                else:
+                    # Listed again by the next run
+                    self.manifest.forget(entry.bucket, entry.key)
+            else:
+                element = {'ETag': entry.etag, 'Size': entry.size, 'LastModified': entry.last_modified} if entry.etag else None
+                self.dead_letters.add(entry.bucket, entry.key, transfer.error_class(result.error), element)
+        return callback
+
+    #---------------------------------------------------------
+    # Compare the local tree with the listings of the given
+    # partitions, listed at the same time
+    #---------------------------------------------------------
+    def verify_partitions(self, partition_list, directory_name):
+        report = KeyList(self.config.report)
+        pending = queue.Queue()
+        for partition in partition_list:
+            pending.put(partition)
+        logger.info('Verifying ' + str(pending.qsize()) + ' partitions with ' + str(self.listers) + ' listers')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.hash_threads) as hasher:
+            def lister():
+                while True:
+                    try:
+                        bucket, prefix = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    self.verify_partition(bucket, prefix, directory_name, report, hasher)
+
+            threads = [threading.Thread(target=lister) for i in range(self.listers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        report.close()
+        logger.info('Verified ' + directory_name + ', ' + str(report.count) + ' files to fix')
+
+    #---------------------------------------------------------
+    # Compare the local files of a partition with its listing
+    #---------------------------------------------------------
+    def verify_partition(self, bucket, prefix, directory_name, report, hasher):
+        partition = bucket + '/' + prefix
+        directory = self.path + directory_name
+        paginator = self.s3client.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': self.page_size})
+
+        listed = set()
+        hashed = []
+        for page in page_iterator:
+            hashing = []
+            for element in page.get('Contents', []):
+                listed.add(element['Key'])
+                if self.store is not None:
+                    file_path = element['Key']
+                    reason = verification.check_size(file_path, element['Size'], self.store.getsize)
+                else:
+                    file_path = directory + element['Key']
+                    reason = verification.check_size(file_path, element['Size'])
+                md5 = verification.single_part_md5(element['ETag']) if self.verify_md5 else None
+                if reason is None and md5 is not None:
+                    hashing.append((element, hasher.submit(verification.check_md5, file_path, md5, self.stored_md5 if self.store is not None else verification.file_md5)))
+                else:
+                    self.record_verification(bucket, element['Key'], reason, element, report)
+            # One page of files is hashed while the next one is listed, its results are collected after that
+            for element, future in hashed:
+                self.record_verification(bucket, element['Key'], future.result(), element, report)
+            hashed = hashing
+        for element, future in hashed:
+            self.record_verification(bucket, element['Key'], future.result(), element, report)
+
+        # Local files that are not in the listing anymore
+        for key in (self.store.keys(prefix) if self.store is not None else verification.local_keys(directory, prefix)):
+            if key not in listed:
+                self.record_verification(bucket, key, verification.ORPHANED, None, report)
+        logger.info(partition + ' verified')
+
+    def stored_md5(self, key):
+        data = self.store.get(key)
+        if data is None:
+            raise FileNotFoundError(key)
+        return hashlib.md5(data).hexdigest()
+
+    def record_verification(self, bucket, key, reason, element, report):
+        self.metrics.inc('verified_total', bucket=bucket, result=reason or 'ok')
+        if reason is not None:
+            logger.warning('%s/%s is %s', bucket, key, reason)
+            report.add(bucket, key, reason, element)
+
+    #---------------------------------------------------------
+    # Throughput, latency and error metrics
+    #---------------------------------------------------------
+    def start_metrics(self, stream, pipeline):
+        self.metrics.gauge('queue_depth', pipeline.queued, stream=stream)
+        self.metrics.gauge('in_flight', pipeline.in_flight, stream=stream)
+        self.metrics.gauge('concurrency_limit', pipeline.limit, stream=stream)
+        for handler in logger.handlers:
+            if isinstance(handler, CustomLogHandler.CustomLogHandler):
+                self.metrics.gauge('log_queue_depth', handler.queue.qsize)
+        return MetricsFile(self.metrics, os.path.join(self.metrics_dir, 'download_' + stream + '.prom'), self.metrics_interval).start()
+
+    def record_listing(self, bucket, elapsed):
+        self.metrics.inc('list_requests_total', bucket=bucket)
+        self.metrics.inc('list_seconds_total', elapsed, bucket=bucket)
+        self.metrics.observe('request_seconds', elapsed, bucket=bucket, operation='list')
+        profiling.record('list', elapsed)
+
+    #---------------------------------------------------------
+    # Continuation token of the page following the given one
+    #---------------------------------------------------------
+    def next_continuation_token(self, partition, page):
+        continuation_token = page.get('NextContinuationToken')
+        if continuation_token is None:
+            logger.info('No more continuation tokens for ' + partition)
+        return continuation_token
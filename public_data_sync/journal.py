@@ -0,0 +1,113 @@
+import os
+import threading
+from .appender import LineAppender
+
+# Record types
+KEY = 'K'
+TOKEN = 'T'
+DONE = 'D'
+
+# ============================================================================
+# Progress journal
+# ============================================================================
+class ProgressJournal(object):
+    """append-only progress journal
+
+    Records every completed key and, per partition, the continuation token
+    of the next page once every key listed before it is done. A partition
+    listing is sorted, so a token also carries the last key of its page and
+    the completed keys up to it are forgotten.
+
+    Every record is handed to the OS as soon as it is written, so a killed
+    process loses nothing, and fsynced in batches to survive a power loss
+    without paying a disk flush per key. The file is rewritten from the
+    in-memory state once it grows too big. After a crash every partition
+    resumes from its last token and skips the keys already completed
+    after it.
+
+    """
+    def __init__(self, fname, sync_every=1000, sync_interval=1, compact_size=64 * 1024 * 1024):
+        self.fname = fname
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._file = None
+        self._tokens = {}
+        self._done = set()
+        self._keys = {}
+
+    def start(self):
+        self._file = LineAppender(self.fname, self.sync_every, self.sync_interval, 'w')
+        self._file.sync()
+
+    def resume(self):
+        if os.path.exists(self.fname):
+            with open(self.fname, 'r') as f:
+                for line in f:
+                    # A line without its newline was cut short by a crash
+                    if line.endswith('\n'):
+                        self._apply(line[:-1].split('\t'))
+        # Start from a compact copy of what was loaded
+        self._compact()
+
+    def _apply(self, record):
+        if record[0] == KEY:
+            self._keys.setdefault(record[1], set()).add(record[2])
+        elif record[0] == TOKEN:
+            self._tokens[record[1]] = record[2]
+            keys = self._keys.get(record[1])
+            if keys:
+                self._keys[record[1]] = set(key for key in keys if key > record[3])
+        elif record[0] == DONE:
+            self._done.add(record[1])
+            self._tokens.pop(record[1], None)
+            self._keys.pop(record[1], None)
+
+    def is_done(self, partition):
+        return partition in self._done
+
+    def continuation_token(self, partition):
+        return self._tokens.get(partition)
+
+    def completed_keys(self, partition):
+        return self._keys.get(partition, set())
+
+    def key_done(self, partition, key):
+        self._write([KEY, partition, key])
+
+    def checkpoint(self, partition, continuation_token, last_key):
+        if continuation_token is None:
+            self._write([DONE, partition])
+        else:
+            self._write([TOKEN, partition, continuation_token, last_key or ''])
+
+    def _write(self, record):
+        with self._lock:
+            self._apply(record)
+            if self._file.write('\t'.join(record) + '\n') and self._file.tell() >= self.compact_size:
+                self._compact()
+
+    def _compact(self):
+        # Rewrite the journal with only what is still needed to resume
+        if self._file is not None:
+            self._file.close()
+        temp_name = self.fname + '.tmp'
+        with open(temp_name, 'w') as f:
+            for partition in sorted(self._done):
+                f.write(DONE + '\t' + partition + '\n')
+            for partition, continuation_token in sorted(self._tokens.items()):
+                f.write(TOKEN + '\t' + partition + '\t' + continuation_token + '\t\n')
+            for partition, keys in sorted(self._keys.items()):
+                for key in sorted(keys):
+                    f.write(KEY + '\t' + partition + '\t' + key + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, self.fname)
+        self._file = LineAppender(self.fname, self.sync_every, self.sync_interval)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
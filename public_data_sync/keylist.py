@@ -0,0 +1,45 @@
+from collections import namedtuple
+from .appender import LineAppender
+
+# A line of a key list, the listing fields are empty when they are not known
+KeyEntry = namedtuple('KeyEntry', ['bucket', 'key', 'reason', 'etag', 'size', 'last_modified'])
+
+# ============================================================================
+# Key list
+# ============================================================================
+class KeyList(LineAppender):
+    """tab separated list of keys
+
+    One line per key: bucket, key, the reason it is listed and, when the
+    listing entry is at hand, its ETag, size and LastModified. The verify
+    report and the dead-letter file use this format, and either one can be
+    fed back to download.py to fetch just those keys. Several processes
+    can add to the same list.
+
+    """
+    def __init__(self, fname, sync_every=100, sync_interval=1):
+        LineAppender.__init__(self, fname, sync_every, sync_interval)
+
+    def add(self, bucket, key, reason, element=None):
+        fields = [bucket, key, reason]
+        if element is not None:
+            fields.extend([element['ETag'], str(element['Size']), str(element['LastModified'])])
+        # Error messages could break the format
+        self.write('\t'.join(str(field).replace('\t', ' ').replace('\n', ' ') for field in fields) + '\n')
+
+#---------------------------------------------------------
+# Reads the entries of a key list
+#---------------------------------------------------------
+def read_key_list(fname):
+    with open(fname, 'r') as f:
+        for line in f:
+            # A line without its newline was cut short by a crash
+            if not line.endswith('\n'):
+                continue
+            fields = line[:-1].split('\t')
+            if len(fields) < 3:
+                continue
+            fields = fields[:6] + [None] * (6 - len(fields))
+            if fields[4] is not None:
+                fields[4] = int(fields[4])
+            yield KeyEntry(*fields)
@@ -0,0 +1,69 @@
+import tarfile
+from datetime import datetime
+
+LAMBDA_FILE_KEY = 'last_modified.csv.tar'
+LAMBDA_FILE_MEMBER = 'last_modified.csv'
+
+date_format = '%Y-%m-%d %H:%M:%S.%f'
+date_format_no_millis = '%Y-%m-%d %H:%M:%S'
+
+#---------------------------------------------------------
+# Parses a last_modified value from the lambda file
+#---------------------------------------------------------
+def parse_last_modified(value):
+    try:
+        # fromisoformat is implemented in C and much faster than strptime
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, date_format)
+    except ValueError:
+        return datetime.strptime(value, date_format_no_millis)
+
+#---------------------------------------------------------
+# Yields the lines of a non seekable binary stream
+#---------------------------------------------------------
+def iter_lines(fileobj, chunk_size=1024 * 1024):
+    remainder = b''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
+
+#---------------------------------------------------------
+# Streams the records modified at or after last_sync
+#---------------------------------------------------------
+def iter_modified_records(s3client, bucket, last_sync, key=LAMBDA_FILE_KEY):
+    """Yields (orcid, last_modified) pairs straight from the lambda file in S3
+
+    The compressed tar is decoded while it is being downloaded and, since
+    the lambda file is ordered by last_modified date descendant, the
+    download is abandoned as soon as a record older than last_sync shows up,
+    so nothing is written to disk and only the head of the file is read.
+
+    """
+    body = s3client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        with tarfile.open(fileobj=body, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith(LAMBDA_FILE_MEMBER):
+                    continue
+                lines = iter_lines(tar.extractfile(member))
+                # Skip the header
+                next(lines, None)
+                for line in lines:
+                    elements = line.rstrip('\r').split(',')
+                    last_modified_date = parse_last_modified(elements[3])
+                    if last_modified_date < last_sync:
+                        return
+                    yield elements[0], last_modified_date
+                return
+    finally:
+        body.close()
@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import threading
+import time
+
+# ============================================================================
+# Local object manifest
+# ============================================================================
+class Manifest(object):
+    """local object manifest
+
+    Keeps the ETag, size and LastModified of every object downloaded to
+    the local tree, keyed by bucket and key, so an object whose listing
+    entry still matches what is on disk does not need to be fetched again.
+    It also keeps the prefixes whose every object was downloaded by a full
+    listing, the only ones whose objects it knows all about.
+
+    The manifest is a SQLite database in WAL mode, so the summaries and
+    activities processes, and the sync workers, can all use the same file.
+    Every process opens its own connection and buffers its changes, which
+    are written in batches in short transactions so no process keeps the
+    database locked for long.
+
+    """
+    def __init__(self, fname, batch_size=1000, flush_interval=5):
+        self.fname = fname
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._pending = []
+        self._last_flush = time.time()
+
+    def _connection(self):
+        # Connections can not be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.fname, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS objects (bucket TEXT NOT NULL, key TEXT NOT NULL, etag TEXT NOT NULL, size INTEGER NOT NULL, last_modified TEXT, PRIMARY KEY (bucket, key)) WITHOUT ROWID')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS listed_prefixes (bucket TEXT NOT NULL, prefix TEXT NOT NULL, PRIMARY KEY (bucket, prefix)) WITHOUT ROWID')
+            self._conn.commit()
+            self._pid = os.getpid()
+            # Changes buffered by the parent process are written by the parent
+            self._pending = []
+        return self._conn
+
+    def is_current(self, bucket, key, etag, size, file_path, getsize=os.path.getsize):
+        # getsize looks the file up, in the local tree by default or in a packed store
+        with self._lock:
+            row = self._connection().execute('SELECT etag, size FROM objects WHERE bucket = ? AND key = ?', (bucket, key)).fetchone()
+        if row is None or row[0] != etag or row[1] != size:
+            return False
+        try:
+            return getsize(file_path) == size
+        except OSError:
+            return False
+
+    def contains(self, bucket, key):
+        with self._lock:
+            return self._connection().execute('SELECT 1 FROM objects WHERE bucket = ? AND key = ?', (bucket, key)).fetchone() is not None
+
+    def count_prefix(self, bucket, prefix):
+        # Keys are sorted, so the keys under a prefix are a range of the primary key
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM objects WHERE bucket = ? AND key >= ? AND key < ?', (bucket, prefix, upper)).fetchone()[0]
+
+    def is_listed(self, bucket, prefix):
+        with self._lock:
+            return self._connection().execute('SELECT 1 FROM listed_prefixes WHERE bucket = ? AND prefix = ?', (bucket, prefix)).fetchone() is not None
+
+    def record_listing(self, bucket, prefix, complete):
+        # A listing that left objects behind undoes what an older one said
+        if complete:
+            self._write('INSERT OR REPLACE INTO listed_prefixes VALUES (?, ?)', (bucket, prefix))
+        else:
+            self._write('DELETE FROM listed_prefixes WHERE bucket = ? AND prefix = ?', (bucket, prefix))
+
+    def record(self, bucket, key, etag, size, last_modified):
+        self._write('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', (bucket, key, etag, size, str(last_modified)))
+
+    def forget(self, bucket, key):
+        self._write('DELETE FROM objects WHERE bucket = ? AND key = ?', (bucket, key))
+
+    def _write(self, statement, params):
+        with self._lock:
+            self._connection()
+            self._pending.append((statement, params))
+            if len(self._pending) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            # The connection context manager commits the whole batch at once
+            with self._conn:
+                for statement, params in self._pending:
+                    self._conn.execute(statement, params)
+            self._pending = []
+        self._last_flush = time.time()
+
+    def commit(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._flush()
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            if self._pid == os.getpid():
+                self._conn.close()
+            self._pid = None
+            self._conn = None
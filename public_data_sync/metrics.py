@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# ============================================================================
+# Metrics registry
+# ============================================================================
+class Metrics(object):
+    """in-process metrics registry
+
+    Counters, latency histograms and gauges, each one identified by its
+    name and labels, rendered in the Prometheus text exposition format.
+    Workers in other processes can collect into their own registry and
+    send back a snapshot to be merged into the main one.
+
+    """
+    def __init__(self, prefix='orcid_sync_'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then the sum and the total count
+                histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name, func, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def total(self, name, **labels):
+        # Sum of a counter over every label set that matches the given labels
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(value for (counter, counter_labels), value in self._counters.items() if counter == name and wanted.issubset(counter_labels))
+
+    def snapshot(self, reset=False):
+        # Workers reset their registry so every snapshot is merged only once
+        with self._lock:
+            snapshot = {'counters': dict(self._counters), 'histograms': dict((key, list(value)) for key, value in self._histograms.items())}
+            if reset:
+                self._counters = {}
+                self._histograms = {}
+            return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, value in snapshot['histograms'].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = list(value)
+                else:
+                    for i in range(len(value)):
+                        histogram[i] += value[i]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+        self._render_family(lines, 'counter', [(name, labels, value) for (name, labels), value in counters])
+        previous = None
+        for (name, labels), histogram in histograms:
+            if name != previous:
+                lines.append('# TYPE ' + self.prefix + name + ' histogram')
+                previous = name
+            cumulative = 0
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += histogram[i]
+                lines.append(self._sample(name + '_bucket', labels + (('le', str(bound)),), cumulative))
+            lines.append(self._sample(name + '_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+            lines.append(self._sample(name + '_sum', labels, histogram[-2]))
+            lines.append(self._sample(name + '_count', labels, histogram[-1]))
+        gauge_values = []
+        for (name, labels), func in gauges:
+            try:
+                gauge_values.append((name, labels, func()))
+            except Exception:
+                # A gauge that can not be read right now is just left out
+                pass
+        self._render_family(lines, 'gauge', gauge_values)
+        return '\n'.join(lines) + '\n'
+
+    def _render_family(self, lines, metric_type, samples):
+        previous = None
+        for name, labels, value in samples:
+            if name != previous:
+                lines.append('# TYPE ' + self.prefix + name + ' ' + metric_type)
+                previous = name
+            lines.append(self._sample(name, labels, value))
+
+    def _sample(self, name, labels, value):
+        if labels:
+            label_text = ','.join(key + '="' + str(label).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, label in labels)
+            return self.prefix + name + '{' + label_text + '} ' + repr(float(value))
+        return self.prefix + name + ' ' + repr(float(value))
+
+# ============================================================================
+# Stats file
+# ============================================================================
+class MetricsFile(object):
+    """periodically rewritten stats file
+
+    Rewrites the file with the current metrics every interval seconds,
+    atomically so a reader never sees it half written. It can be picked up
+    by the node_exporter textfile collector or just read by a human.
+    Objects and bytes per second over the last interval are added as
+    gauges.
+
+    """
+    def __init__(self, metrics, fname, interval=10):
+        self.metrics = metrics
+        self.fname = fname
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._last = (time.time(), 0, 0)
+        self._rates = (0.0, 0.0)
+        metrics.gauge('objects_per_second', lambda: self._rates[0])
+        metrics.gauge('bytes_per_second', lambda: self._rates[1])
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        now = time.time()
+        objects = self.metrics.total('objects_total', result='downloaded')
+        downloaded_bytes = self.metrics.total('bytes_total')
+        elapsed = max(now - self._last[0], 1e-6)
+        self._rates = ((objects - self._last[1]) / elapsed, (downloaded_bytes - self._last[2]) / elapsed)
+        self._last = (now, objects, downloaded_bytes)
+        temp_name = self.fname + '.tmp'
+        with open(temp_name, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(temp_name, self.fname)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()
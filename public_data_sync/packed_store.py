@@ -0,0 +1,376 @@
+import itertools
+import multiprocessing.util
+import os
+import sqlite3
+import struct
+import threading
+import time
+import traceback
+import zlib
+from .processes import per_process
+
+# Record types
+PUT = 1
+DELETE = 2
+
+# Record header: type, key length, data length, time written and CRC32 of the key and data
+HEADER = struct.Struct('>BHIdI')
+
+# Bytes of records buffered by a process before they are written to its segment
+WRITE_BUFFER = 1024 * 1024
+
+# ============================================================================
+# Packed object store
+# ============================================================================
+class PackedStore(object):
+    """packed object store
+
+    Stores many small objects, keyed by their S3 key, in a few large
+    segment files instead of one file per object. Every process writing to
+    the store appends to a segment of its own, a record holding the key and
+    the data of an object, or a tombstone when the object is deleted, so
+    the segments alone say what the store holds. A SQLite index in WAL
+    mode maps every live key to its segment, offset and size, and keeps
+    how many bytes of every segment are dead, overwritten or deleted.
+
+    Like the manifest, every process buffers its index changes and writes
+    them in batches, after its segment is flushed to disk, so the index
+    never points at data that is not there. Changes are seen by readers
+    once they are committed.
+
+    Segments are sealed once they reach segment_size or their process
+    closes the store. Compaction copies the live records of the sealed
+    segments that are mostly dead to the segment of the compacting process
+    and removes them.
+
+    """
+    def __init__(self, directory, segment_size=256 * 1024 * 1024, batch_size=1000, flush_interval=5, compact_threshold=0.5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._owner = os.getpid()
+        self._pid = None
+        self._conn = None
+        self._compactor = None
+        self._stop = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        # The compactor thread may hold the lock when a worker is forked
+        multiprocessing.util.register_after_fork(self, PackedStore._after_fork)
+        with self._lock:
+            conn = self._connection()
+            # No other process writes yet, the segments a killed process left open are sealed
+            with conn:
+                conn.execute('UPDATE segments SET sealed = 1 WHERE sealed = 0')
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._compactor = None
+
+    def _connection(self):
+        # Connections and open segments can not be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.join(self.directory, 'index.db'), timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT NOT NULL PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, size INTEGER NOT NULL) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment, offset)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY AUTOINCREMENT, bytes INTEGER NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0, sealed INTEGER NOT NULL DEFAULT 0)')
+            self._conn.commit()
+            self._pid = os.getpid()
+            # Records waiting in a process forked from a writer are the parent's, they are dropped unwritten
+            self._segment = None
+            self._buffer = bytearray()
+            self._segment_id = None
+            self._segment_bytes = 0
+            self._pending = []
+            self._readers = {}
+            self._last_flush = time.time()
+            per_process(self, self.close, self._owner)
+        return self._conn
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '%08d.seg' % segment)
+
+    #---------------------------------------------------------
+    # Writes, they all run with the lock held
+    #---------------------------------------------------------
+    def _append(self, kind, key, data):
+        if self._segment is not None and self._segment_bytes >= self.segment_size:
+            self._flush()
+            self._seal()
+        if self._segment is None:
+            with self._conn:
+                self._segment_id = self._conn.execute('INSERT INTO segments (sealed) VALUES (0)').lastrowid
+            # Unbuffered, the records are buffered by the store so a forked process never writes its parent's
+            self._segment = open(self.segment_path(self._segment_id), 'ab', buffering=0)
+            self._segment_bytes = 0
+        key_bytes = key.encode('utf-8')
+        offset = self._segment_bytes
+        self._buffer += HEADER.pack(kind, len(key_bytes), len(data), time.time(), zlib.crc32(data, zlib.crc32(key_bytes)))
+        self._buffer += key_bytes
+        self._buffer += data
+        self._segment_bytes += HEADER.size + len(key_bytes) + len(data)
+        if len(self._buffer) >= WRITE_BUFFER:
+            self._write_buffer()
+        return self._segment_id, offset
+
+    def _write_buffer(self):
+        view = memoryview(self._buffer)
+        while view:
+            view = view[self._segment.write(view):]
+        self._buffer = bytearray()
+
+    def _flush(self):
+        if self._segment is not None:
+            # The records reach the disk before the index points at them
+            self._write_buffer()
+            os.fsync(self._segment.fileno())
+            with self._conn:
+                for statement, params in self._pending:
+                    cursor = self._conn.execute(statement[0], params)
+                    # A conditional update that matched nothing leaves a dead copy behind
+                    if statement[1] is not None and cursor.rowcount == 0:
+                        self._conn.execute('UPDATE segments SET dead = dead + ? WHERE id = ?', (statement[1], self._segment_id))
+                self._conn.execute('UPDATE segments SET bytes = ? WHERE id = ?', (self._segment_bytes, self._segment_id))
+            self._pending = []
+        self._last_flush = time.time()
+
+    def _seal(self):
+        self._write_buffer()
+        with self._conn:
+            self._conn.execute('UPDATE segments SET sealed = 1 WHERE id = ?', (self._segment_id,))
+        self._segment.close()
+        self._segment = None
+
+    def _index(self, key, segment, offset, size):
+        # The record replaced, if any, is dead from now on
+        self._pending.append((('UPDATE segments SET dead = dead + (SELECT ? + LENGTH(CAST(key AS BLOB)) + size FROM objects WHERE key = ?) WHERE id = (SELECT segment FROM objects WHERE key = ?)', None), (HEADER.size, key, key)))
+        if segment is None:
+            self._pending.append((('DELETE FROM objects WHERE key = ?', None), (key,)))
+        else:
+            self._pending.append((('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)', None), (key, segment, offset, size)))
+        if len(self._pending) >= 2 * self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def put(self, key, data):
+        with self._lock:
+            self._connection()
+            segment, offset = self._append(PUT, key, data)
+            self._index(key, segment, offset, len(data))
+
+    def delete(self, key):
+        with self._lock:
+            self._connection()
+            # Tombstones stay live, they are not counted as dead bytes
+            self._append(DELETE, key, b'')
+            self._index(key, None, None, None)
+
+    def commit(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._flush()
+
+    def close(self):
+        self.stop_compactor()
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._flush()
+            if self._segment is not None:
+                self._seal()
+            for fd in self._readers.values():
+                os.close(fd)
+            self._conn.close()
+            self._pid = None
+            self._conn = None
+
+    #---------------------------------------------------------
+    # Reads
+    #---------------------------------------------------------
+    def _read(self, segment, offset, key, size):
+        fd = self._readers.get(segment)
+        if fd is None:
+            fd = os.open(self.segment_path(segment), os.O_RDONLY)
+            self._readers[segment] = fd
+        key_bytes = key.encode('utf-8')
+        length = HEADER.size + len(key_bytes) + size
+        record = os.pread(fd, length, offset)
+        if len(record) != length:
+            raise IOError('Record of ' + key + ' cut short in segment ' + str(segment))
+        kind, key_length, data_length, written, crc = HEADER.unpack_from(record)
+        data = record[HEADER.size + key_length:]
+        if kind != PUT or record[HEADER.size:HEADER.size + key_length] != key_bytes or zlib.crc32(data, zlib.crc32(key_bytes)) != crc:
+            raise IOError('Corrupted record of ' + key + ' in segment ' + str(segment))
+        return data
+
+    def get(self, key):
+        """Returns the data of key, None when it is not in the store
+
+        Raises IOError when the segment the index points at is missing or
+        the record is corrupted.
+
+        """
+        missing = None
+        while True:
+            with self._lock:
+                row = self._connection().execute('SELECT segment, offset, size FROM objects WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                if row[0] == missing:
+                    raise IOError('Segment ' + str(missing) + ' holding ' + key + ' is missing')
+                try:
+                    return self._read(row[0], row[1], key, row[2])
+                except FileNotFoundError:
+                    # The segment may have been compacted away after the lookup, then the index has moved on
+                    missing = row[0]
+
+    def getsize(self, key):
+        """Size of the data of key, raises OSError like os.path.getsize when it is missing"""
+        missing = None
+        while True:
+            with self._lock:
+                row = self._connection().execute('SELECT segment, size FROM objects WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    raise FileNotFoundError(key)
+                if row[0] in self._readers or os.path.exists(self.segment_path(row[0])):
+                    return row[1]
+                if row[0] == missing:
+                    raise FileNotFoundError('Segment ' + str(missing) + ' holding ' + key + ' is missing')
+                missing = row[0]
+
+    def keys(self, prefix=''):
+        with self._lock:
+            if prefix:
+                # Keys are sorted, so the keys under a prefix are a range of the primary key
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                rows = self._connection().execute('SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key', (prefix, upper)).fetchall()
+            else:
+                rows = self._connection().execute('SELECT key FROM objects ORDER BY key').fetchall()
+        return [row[0] for row in rows]
+
+    def record(self, orcid):
+        """Returns a dict with the key and data of every object of an ORCID iD"""
+        return dict((key, self.get(key)) for key in self.keys(orcid[-3:] + '/' + orcid + '/'))
+
+    def scan(self, prefix=''):
+        """Yields the key and data of every object under prefix, in the order they are stored
+
+        Segments are read one by one, sequentially, so a full scan reads
+        the disk at its streaming speed. Objects written while scanning may
+        or may not be seen.
+
+        """
+        with self._lock:
+            segments = [row[0] for row in self._connection().execute('SELECT id FROM segments ORDER BY id')]
+        for segment in segments:
+            try:
+                # Opened before the lookup, the rows compaction moves out of it are still in the file
+                fd = os.open(self.segment_path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                with self._lock:
+                    if prefix:
+                        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                        rows = self._connection().execute('SELECT key, offset, size FROM objects WHERE segment = ? AND key >= ? AND key < ? ORDER BY offset', (segment, prefix, upper)).fetchall()
+                    else:
+                        rows = self._connection().execute('SELECT key, offset, size FROM objects WHERE segment = ? ORDER BY offset', (segment,)).fetchall()
+                for key, offset, size in rows:
+                    key_length = len(key.encode('utf-8'))
+                    yield key, os.pread(fd, size, offset + HEADER.size + key_length)
+            finally:
+                os.close(fd)
+
+    #---------------------------------------------------------
+    # Compaction
+    #---------------------------------------------------------
+    def compact(self, batch_size=1000):
+        """Rewrites the sealed segments whose dead bytes reach compact_threshold, returns how many
+
+        The small segments every run leaves behind, one per worker, are
+        merged as well while there are several of them.
+
+        """
+        with self._lock:
+            conn = self._connection()
+            candidates = [row[0] for row in conn.execute('SELECT id FROM segments WHERE sealed = 1 AND bytes > 0 AND dead >= bytes * ? ORDER BY id', (self.compact_threshold,))]
+            small = [row[0] for row in conn.execute('SELECT id FROM segments WHERE sealed = 1 AND dead < bytes * ? AND bytes < ? ORDER BY id', (self.compact_threshold, self.segment_size // 8))]
+            if len(small) > 1:
+                candidates = sorted(candidates + small)
+        for segment in candidates:
+            self._compact_segment(segment, batch_size)
+        return len(candidates)
+
+    def _compact_segment(self, segment, batch_size):
+        records = read_records(self.segment_path(segment))
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            with self._lock:
+                for kind, key, data, offset in batch:
+                    if kind == PUT:
+                        row = self._conn.execute('SELECT segment, offset FROM objects WHERE key = ?', (key,)).fetchone()
+                        if row != (segment, offset):
+                            continue
+                        new_segment, new_offset = self._append(PUT, key, data)
+                        # Only moved if no other process replaced it in the meantime
+                        self._pending.append((('UPDATE objects SET segment = ?, offset = ? WHERE key = ? AND segment = ? AND offset = ?', HEADER.size + len(key.encode('utf-8')) + len(data)), (new_segment, new_offset, key, segment, offset)))
+                    elif self._conn.execute('SELECT 1 FROM objects WHERE key = ?', (key,)).fetchone() is None:
+                        self._append(DELETE, key, b'')
+                self._flush()
+        with self._lock:
+            if self._conn.execute('SELECT COUNT(*) FROM objects WHERE segment = ?', (segment,)).fetchone()[0] == 0:
+                with self._conn:
+                    self._conn.execute('DELETE FROM segments WHERE id = ?', (segment,))
+                fd = self._readers.pop(segment, None)
+                if fd is not None:
+                    os.close(fd)
+                os.remove(self.segment_path(segment))
+
+    def start_compactor(self, logger, interval=60):
+        def run():
+            # The segments left by the previous runs are compacted right away
+            while True:
+                try:
+                    compacted = self.compact()
+                    if compacted:
+                        logger.info('Compacted %s segments of %s', compacted, self.directory)
+                except Exception:
+                    logger.error('Error compacting %s: %s', self.directory, traceback.format_exc())
+                if self._stop.wait(interval):
+                    return
+
+        self._stop.clear()
+        self._compactor = threading.Thread(target=run)
+        self._compactor.daemon = True
+        self._compactor.start()
+        return self
+
+    def stop_compactor(self):
+        if self._compactor is not None and os.getpid() == self._owner:
+            self._stop.set()
+            self._compactor.join()
+            self._compactor = None
+
+#---------------------------------------------------------
+# Reads the records of a segment in order, it stops at the
+# first one cut short or corrupted by a killed process
+#---------------------------------------------------------
+def read_records(segment_path):
+    with open(segment_path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, key_length, data_length, written, crc = HEADER.unpack(header)
+            key_bytes = f.read(key_length)
+            data = f.read(data_length)
+            if len(key_bytes) < key_length or len(data) < data_length or zlib.crc32(data, zlib.crc32(key_bytes)) != crc:
+                return
+            yield kind, key_bytes.decode('utf-8'), data, offset
+            offset += HEADER.size + key_length + data_length
@@ -0,0 +1,35 @@
+# Every ORCID iD ends with a checksum character, 0-9 or X, and the public
+# data files are laid out under the last three characters of the iD
+CHECKSUMS = ['%03d' % i for i in range(1000)] + ['%02dX' % i for i in range(100)]
+
+#---------------------------------------------------------
+# Suffix of the activities bucket holding an ORCID or checksum
+#---------------------------------------------------------
+def activities_bucket_suffix(orcid):
+    last = orcid[-1]  # Get the last character of ORCID
+    if last in '0123':
+        return 'a'
+    elif last in '4567':
+        return 'b'
+    else:
+        return 'c'
+
+#---------------------------------------------------------
+# Listing partitions of the summaries bucket
+#---------------------------------------------------------
+def summaries_partitions(summaries_bucket, checksums=CHECKSUMS):
+    return [(summaries_bucket, checksum + '/') for checksum in checksums]
+
+#---------------------------------------------------------
+# Listing partitions of the activities buckets, a checksum
+# only ever lives in one of the three buckets
+#---------------------------------------------------------
+def activities_partitions(activities_bucket_base, checksums=CHECKSUMS):
+    return [(activities_bucket_base + '-' + activities_bucket_suffix(checksum), checksum + '/') for checksum in checksums]
+
+#---------------------------------------------------------
+# Checksums of one shard out of shards, 1 based, every
+# shard takes a contiguous range of about the same size
+#---------------------------------------------------------
+def shard_checksums(shard, shards, checksums=CHECKSUMS):
+    return checksums[(shard - 1) * len(checksums) // shards:shard * len(checksums) // shards]
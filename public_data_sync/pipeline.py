@@ -0,0 +1,144 @@
+import queue
+import threading
+import traceback
+from collections import deque
+from multiprocessing import Pool
+from .concurrency import ConcurrencyLimiter
+from .transfer import Transfer
+from .transfer import describe_error
+
+# ============================================================================
+# Ordered checkpoints
+# ============================================================================
+class OrderedCheckpoint(object):
+    """ordered checkpoint tracker
+
+    Pages of work are registered in the order they were listed, each one
+    with the checkpoint that becomes valid once it is complete. Items can
+    finish in any order, but the checkpoint only advances once every item
+    of that page and of every page before it is done.
+
+    """
+    def __init__(self, on_advance):
+        self._on_advance = on_advance
+        self._lock = threading.Lock()
+        self._pages = deque()
+
+    def add_page(self, count, checkpoint):
+        page = [count, checkpoint]
+        with self._lock:
+            self._pages.append(page)
+            self._advance()
+        return page
+
+    def done(self, page):
+        with self._lock:
+            page[0] -= 1
+            self._advance()
+
+    def _advance(self):
+        # Runs with the lock held so checkpoints are written in order
+        checkpoint = None
+        advanced = False
+        while self._pages and self._pages[0][0] <= 0:
+            checkpoint = self._pages.popleft()[1]
+            advanced = True
+        if advanced:
+            self._on_advance(checkpoint)
+
+# ============================================================================
+# Pipeline
+# ============================================================================
+class Pipeline(object):
+    """bounded download pipeline
+
+    The lister submits keys one by one while it walks the bucket, they wait
+    in a bounded queue until the concurrency limiter lets them start, so the
+    next page is listed while the current one is still downloading and
+    memory stays flat no matter how big the bucket is. Subclasses start the
+    actual downloads and report back through _complete or _failed.
+
+    """
+    def __init__(self, logger, max_queued, limiter):
+        self._logger = logger
+        self._limiter = limiter
+        self._queue = queue.Queue(max_queued)
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def submit(self, item, page, checkpoint, callback=None):
+        self._queue.put((item, page, checkpoint, callback))
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def in_flight(self):
+        return self._limiter.in_flight
+
+    def limit(self):
+        return int(self._limiter.limit)
+
+    def _dispatch(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            self._limiter.acquire()
+            self._start(entry)
+
+    def _start(self, entry):
+        raise NotImplementedError
+
+    def _complete(self, entry, result):
+        item, page, checkpoint, callback = entry
+        try:
+            if callback is not None:
+                callback(item, result)
+        except Exception as e:
+            self._log_error(item, e)
+        finally:
+            # Transfer results tell the limiter how the request went
+            self._limiter.release(getattr(result, 'latency', None), bool(getattr(result, 'throttled', 0)))
+            checkpoint.done(page)
+
+    def _failed(self, entry, e):
+        self._log_error(entry[0], e)
+        # Reported to the callback like a failed download, so the item is not lost
+        self._complete(entry, Transfer(False, None, 0, 0, describe_error(e)))
+
+    def _log_error(self, item, e):
+        self._logger.error('Unexpected error processing %s: %s', item, ''.join(traceback.format_exception_only(type(e), e)).strip())
+
+    def close(self):
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._limiter.wait_idle()
+        self._shutdown()
+
+    def _shutdown(self):
+        pass
+
+# ============================================================================
+# Worker pipeline
+# ============================================================================
+class WorkerPipeline(Pipeline):
+    """long-lived worker pool fed through a bounded queue
+
+    A single pool serves the whole run, func is called with every
+    submitted item in one of the worker processes.
+
+    """
+    def __init__(self, logger, func, processes, max_queued, limiter=None, initializer=None, initargs=()):
+        self._func = func
+        # The pool forks its workers before the dispatcher thread starts
+        self._pool = Pool(processes=processes, initializer=initializer, initargs=initargs)
+        Pipeline.__init__(self, logger, max_queued, limiter or ConcurrencyLimiter(processes))
+
+    def _start(self, entry):
+        # Callbacks run in the pool's result handler thread, which must never die
+        self._pool.apply_async(self._func, (entry[0],), callback=lambda result: self._complete(entry, result), error_callback=lambda e: self._failed(entry, e))
+
+    def _shutdown(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,98 @@
+import math
+from collections import namedtuple
+
+# A paginated list_objects_v2 walk over bucket/prefix, keeping only the keys of the given ORCIDs
+ListingTask = namedtuple('ListingTask', ['bucket', 'prefix', 'orcids'])
+
+# The work of one sync worker: a listing of activities, or None, the ORCIDs
+# whose summary has to be downloaded and the last modified date of every record
+RecordTask = namedtuple('RecordTask', ['listing', 'summaries', 'last_modified'])
+
+# ============================================================================
+# Listing plan
+# ============================================================================
+class ListingPlan(object):
+    """activities listing plan
+
+    Holds the listing tasks needed to find the activities of a set of
+    records, along with the number of list requests the plan is expected
+    to make and the number one listing per record would have made.
+
+    """
+    def __init__(self):
+        self.tasks = []
+        self.prefix_tasks = 0
+        self.naive_requests = 0
+        self.planned_requests = 0
+
+    @property
+    def saved_requests(self):
+        return self.naive_requests - self.planned_requests
+
+#---------------------------------------------------------
+# Groups the records by bucket and checksum and picks, for
+# each group, the cheapest way of listing its activities
+#---------------------------------------------------------
+def plan_activity_listing(orcids, bucket_name, estimate_prefix_objects, page_size):
+    """Builds a ListingPlan for the activities of the given ORCIDs
+
+    Listing one record costs at least one request, while listing a whole
+    checksum prefix costs one request per page of the objects under it,
+    as estimated by estimate_prefix_objects(bucket, checksum). Each group
+    is listed whole only when that is cheaper than listing its records
+    one by one.
+
+    """
+    groups = {}
+    for orcid in orcids:
+        groups.setdefault((bucket_name(orcid), orcid[-3:]), set()).add(orcid)
+
+    plan = ListingPlan()
+    for (bucket, checksum), group in sorted(groups.items()):
+        prefix_requests = max(1, int(math.ceil(estimate_prefix_objects(bucket, checksum) / float(page_size))))
+        plan.naive_requests += len(group)
+        if prefix_requests < len(group):
+            plan.tasks.append(ListingTask(bucket, checksum + '/', frozenset(group)))
+            plan.prefix_tasks += 1
+            plan.planned_requests += prefix_requests
+        else:
+            for orcid in sorted(group):
+                plan.tasks.append(ListingTask(bucket, checksum + '/' + orcid + '/', frozenset([orcid])))
+            plan.planned_requests += len(group)
+    return plan
+
+#---------------------------------------------------------
+# Splits a batch of records into the tasks of the workers
+#---------------------------------------------------------
+def plan_record_batch(records, bucket_name, estimate_prefix_objects, page_size, summaries_per_task=100):
+    """Returns the ListingPlan and the RecordTasks for a batch of records
+
+    records are (orcid, last_modified, streams) tuples, streams saying
+    which of summaries and activities the record needs. The summaries of
+    the records in an activities listing are downloaded by the same task,
+    so each record is synced as a unit, and the records that only need
+    their summary are grouped summaries_per_task at a time.
+
+    """
+    last_modified = {}
+    activities = []
+    summaries = set()
+    for orcid, modified, streams in records:
+        # A record listed twice is synced once, as of its latest date
+        if orcid not in last_modified or modified > last_modified[orcid]:
+            last_modified[orcid] = modified
+        if 'activities' in streams:
+            activities.append(orcid)
+        if 'summaries' in streams:
+            summaries.add(orcid)
+
+    plan = plan_activity_listing(activities, bucket_name, estimate_prefix_objects, page_size)
+    tasks = []
+    for listing in plan.tasks:
+        tasks.append(RecordTask(listing, sorted(summaries & listing.orcids), dict((orcid, last_modified[orcid]) for orcid in listing.orcids)))
+        summaries -= listing.orcids
+    remaining = sorted(summaries)
+    for i in range(0, len(remaining), summaries_per_task):
+        chunk = remaining[i:i + summaries_per_task]
+        tasks.append(RecordTask(None, chunk, dict((orcid, last_modified[orcid]) for orcid in chunk)))
+    return plan, tasks
@@ -0,0 +1,17 @@
+import multiprocessing.util
+import os
+
+#---------------------------------------------------------
+# Closes what a forked worker opened on its own when the
+# worker exits
+#---------------------------------------------------------
+def per_process(obj, close, owner, exitpriority=50):
+    """Calls close when the current process exits, unless it is owner
+
+    Pool workers exit without running atexit, but they do run the
+    multiprocessing finalizers, highest exitpriority first. The owner
+    process closes obj itself.
+
+    """
+    if os.getpid() != owner:
+        multiprocessing.util.Finalize(obj, close, exitpriority=exitpriority)
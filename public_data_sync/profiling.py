@@ -0,0 +1,391 @@
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from .processes import per_process
+
+# Seconds between two samples of the stacks of every thread
+SAMPLE_INTERVAL = 0.01
+
+# Frames kept by tracemalloc for every allocation, the report only shows the line that allocated
+MEMORY_FRAMES = 1
+
+# Lines of the report for the functions and the allocations
+REPORT_LINES = 25
+
+# The profiler of this process, None unless the run is profiled
+_session = None
+
+# Returned by span when the process is not profiled
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class _Span(object):
+    __slots__ = ('_session', '_name', '_start')
+
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._session.add_span(self._name, time.perf_counter() - self._start)
+        return False
+
+#---------------------------------------------------------
+# The profiler of this process, forked processes only have
+# one once they called start_process
+#---------------------------------------------------------
+def current():
+    session = _session
+    if session is None or session.pid != os.getpid():
+        return None
+    return session
+
+#---------------------------------------------------------
+# Time the block as the given span, nothing is timed
+# unless the process is profiled
+#---------------------------------------------------------
+def span(name):
+    session = current()
+    if session is None:
+        return _NO_SPAN
+    return _Span(session, name)
+
+#---------------------------------------------------------
+# Add a span that was already timed, like the latency of a
+# transfer
+#---------------------------------------------------------
+def record(name, elapsed):
+    session = current()
+    if session is not None:
+        session.add_span(name, elapsed)
+
+#---------------------------------------------------------
+# Profile the calling thread, for the threads started
+# before the profiler was, call it again once in a while
+#---------------------------------------------------------
+def attach_thread():
+    session = current()
+    if session is not None:
+        session.profile_thread()
+    elif sys.getprofile() is not None:
+        # Left behind by a profiled run, report can only stop the profile of its own thread
+        sys.setprofile(None)
+
+#---------------------------------------------------------
+# Start profiling the run from its main process
+#---------------------------------------------------------
+def start(directory, role='main', memory=False):
+    """Starts profiling this process and returns its Profiler
+
+    The processes forked from it are profiled once they call
+    start_process. Call report on the Profiler once every one of them
+    exited.
+
+    """
+    global _session
+    parts_dir = os.path.join(directory, 'processes')
+    if os.path.isdir(parts_dir):
+        shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir)
+    _session = Profiler(directory, role, memory)
+    _session.start()
+    return _session
+
+#---------------------------------------------------------
+# Start profiling a process forked from a profiled one,
+# used as the initializer of the worker pools
+#---------------------------------------------------------
+def start_process(role):
+    global _session
+    parent = _session
+    if parent is None or parent.pid == os.getpid():
+        return
+    # What the parent collected before forking belongs to the parent
+    _session = Profiler(parent.directory, role, parent.memory)
+    _session.start(forked=True)
+    # Stopped after the files of the worker are flushed
+    per_process(_session, _session.stop, parent.pid)
+
+# ============================================================================
+# Profiler
+# ============================================================================
+class Profiler(object):
+    """cross-process profiler
+
+    Profiles a single process: a cProfile profile for each of its threads,
+    including the ones started later, samples of the stacks of every thread
+    taken every SAMPLE_INTERVAL seconds, the count and duration of the
+    spans it timed, like listing a page or creating a folder, and with
+    memory a tracemalloc snapshot. Every process writes what it collected
+    to its own files in the processes folder of directory when it stops,
+    and report, called by the main process once the others exited, merges
+    them into profile.pstats, a cProfile file, profile.collapsed, the
+    stack samples in the collapsed format of flamegraph.pl and speedscope,
+    and report.txt.
+
+    """
+    def __init__(self, directory, role, memory=False):
+        self.directory = directory
+        self.role = role
+        self.memory = memory
+        self.pid = os.getpid()
+        self.parts_dir = os.path.join(directory, 'processes')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        self._spans = {}
+        self._samples = {}
+        self._sampler = None
+        self._sampling = False
+        self._stopped = False
+
+    def start(self, forked=False):
+        import tracemalloc
+        self._started = time.time()
+        self._times = os.times()
+        if self.memory:
+            if tracemalloc.is_tracing():
+                # Forked with the allocations of the parent still traced
+                tracemalloc.clear_traces()
+            else:
+                tracemalloc.start(MEMORY_FRAMES)
+        # The sampler starts before the hook so it is not profiled itself
+        self._sampling = True
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+        threading.setprofile(self._profile_new_thread)
+        if forked:
+            # The profile of the thread that forked the process was copied along with it
+            sys.setprofile(None)
+        self.profile_thread()
+
+    def _profile_new_thread(self, frame, event, arg):
+        # Called on the first event of every thread started from now on
+        self.profile_thread()
+
+    def profile_thread(self):
+        if getattr(self._local, 'profile', None) is not None:
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 a profile sees every thread, the first one enabled covers this one too
+            sys.setprofile(None)
+            profile = False
+        self._local.profile = profile
+        if profile:
+            with self._lock:
+                self._profiles.append(profile)
+
+    def add_span(self, name, elapsed):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                self._spans[name] = [1, elapsed, elapsed]
+            else:
+                span[0] += 1
+                span[1] += elapsed
+                if elapsed > span[2]:
+                    span[2] = elapsed
+
+    def _sample(self):
+        own = threading.get_ident()
+        while self._sampling:
+            time.sleep(SAMPLE_INTERVAL)
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack = tuple(stack)
+                self._samples[stack] = self._samples.get(stack, 0) + 1
+
+    #---------------------------------------------------------
+    # Write what this process collected to its own files
+    #---------------------------------------------------------
+    def stop(self):
+        if self._stopped or self.pid != os.getpid():
+            return
+        self._stopped = True
+        import pstats
+        import tracemalloc
+        threading.setprofile(None)
+        self._sampling = False
+        self._sampler.join()
+        times = os.times()
+        name = os.path.join(self.parts_dir, '%s-%d' % (self.role, self.pid))
+
+        # Taken first, so the memory merging the profiles takes is left out
+        peak_memory = None
+        if self.memory and tracemalloc.is_tracing():
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.take_snapshot().dump(name + '.tracemalloc')
+            tracemalloc.stop()
+
+        stats = None
+        with self._lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            profile.disable()
+            try:
+                thread_stats = pstats.Stats(profile)
+            except TypeError:
+                # A thread that did not call anything
+                continue
+            if stats is None:
+                stats = thread_stats
+            else:
+                stats.add(thread_stats)
+        if stats is not None:
+            stats.dump_stats(name + '.prof')
+
+        samples = {}
+        for stack, count in self._samples.items():
+            folded = ';'.join([self.role] + [frame_name(code) for code in reversed(stack)])
+            samples[folded] = samples.get(folded, 0) + count
+        with self._lock:
+            spans = dict(self._spans)
+        with open(name + '.json', 'w') as f:
+            json.dump({
+                'role': self.role,
+                'pid': self.pid,
+                'wall': time.time() - self._started,
+                'cpu': (times[0] - self._times[0]) + (times[1] - self._times[1]),
+                'peak_memory': peak_memory,
+                'spans': spans,
+                'samples': samples,
+            }, f)
+
+    #---------------------------------------------------------
+    # Merge the files of every process into the report of
+    # the run
+    #---------------------------------------------------------
+    def report(self):
+        """Stops the profiler and merges the files of every process
+
+        Only call it once every other profiled process has exited. Returns
+        the path of report.txt.
+
+        """
+        global _session
+        self.stop()
+        if _session is self:
+            _session = None
+        import pstats
+
+        processes = []
+        samples = {}
+        stats = None
+        snapshots = []
+        for part in sorted(os.listdir(self.parts_dir)):
+            path = os.path.join(self.parts_dir, part)
+            if part.endswith('.json'):
+                with open(path) as f:
+                    process = json.load(f)
+                processes.append(process)
+                for stack, count in process['samples'].items():
+                    samples[stack] = samples.get(stack, 0) + count
+            elif part.endswith('.prof'):
+                if stats is None:
+                    stats = pstats.Stats(path, stream=io.StringIO())
+                else:
+                    stats.add(path)
+            elif part.endswith('.tracemalloc'):
+                snapshots.append(path)
+
+        if stats is not None:
+            stats.dump_stats(os.path.join(self.directory, 'profile.pstats'))
+        with open(os.path.join(self.directory, 'profile.collapsed'), 'w') as f:
+            for stack, count in sorted(samples.items()):
+                f.write(stack + ' ' + str(count) + '\n')
+
+        report_path = os.path.join(self.directory, 'report.txt')
+        with open(report_path, 'w') as f:
+            f.write(process_table(processes))
+            f.write('\n' + span_table(processes))
+            if stats is not None:
+                f.write('\n' + function_table(stats, 'tottime', 'Functions by own time'))
+                f.write('\n' + function_table(stats, 'cumulative', 'Functions by cumulative time'))
+            if snapshots:
+                f.write('\n' + memory_table(snapshots))
+        return report_path
+
+#---------------------------------------------------------
+# Name of a frame in the collapsed stacks
+#---------------------------------------------------------
+def frame_name(code):
+    path = code.co_filename.replace(os.sep, '/').rsplit('/', 2)
+    return '%s (%s:%d)' % (code.co_name, '/'.join(path[-2:]), code.co_firstlineno)
+
+#---------------------------------------------------------
+# Report tables
+#---------------------------------------------------------
+def process_table(processes):
+    roles = {}
+    for process in processes:
+        role = roles.setdefault(process['role'], [0, 0.0, 0.0, None])
+        role[0] += 1
+        role[1] = max(role[1], process['wall'])
+        role[2] += process['cpu']
+        if process['peak_memory'] is not None:
+            role[3] = max(role[3] or 0, process['peak_memory'])
+    lines = ['Processes', '%-20s %9s %10s %10s %14s' % ('role', 'processes', 'wall s', 'cpu s', 'peak memory')]
+    for name, (count, wall, cpu, peak) in sorted(roles.items()):
+        lines.append('%-20s %9d %10.2f %10.2f %14s' % (name, count, wall, cpu, '' if peak is None else '%.1f MB' % (peak / 1024 / 1024)))
+    return '\n'.join(lines) + '\n'
+
+def span_table(processes):
+    spans = {}
+    for process in processes:
+        for name, (count, total, longest) in process['spans'].items():
+            span = spans.setdefault((process['role'], name), [0, 0.0, 0.0])
+            span[0] += count
+            span[1] += total
+            span[2] = max(span[2], longest)
+    lines = ['Spans', '%-20s %-10s %10s %10s %10s %10s' % ('role', 'span', 'count', 'total s', 'mean ms', 'max ms')]
+    for (role, name), (count, total, longest) in sorted(spans.items()):
+        lines.append('%-20s %-10s %10d %10.2f %10.3f %10.3f' % (role, name, count, total, total / count * 1000, longest * 1000))
+    return '\n'.join(lines) + '\n'
+
+def function_table(stats, sort, title):
+    stream = io.StringIO()
+    stats.stream = stream
+    # The file of every process is listed otherwise
+    stats.files = []
+    stats.sort_stats(sort).print_stats(REPORT_LINES)
+    return title + '\n' + stream.getvalue().strip('\n') + '\n'
+
+def memory_table(snapshots):
+    import tracemalloc
+    lines = {}
+    for path in snapshots:
+        # The allocations of the profiler itself are left out
+        snapshot = tracemalloc.Snapshot.load(path).filter_traces([tracemalloc.Filter(False, filename) for filename in (tracemalloc.__file__, __file__, '*/cProfile.py', '*/pstats.py', '<frozen *>', '<unknown>')])
+        for statistic in snapshot.statistics('lineno'):
+            frame = statistic.traceback[0]
+            line = lines.setdefault((frame.filename, frame.lineno), [0, 0])
+            line[0] += statistic.size
+            line[1] += statistic.count
+    table = ['Memory still allocated when the processes stopped, by line', '%12s %10s  %s' % ('size', 'blocks', 'line')]
+    for (filename, lineno), (size, count) in sorted(lines.items(), key=lambda item: -item[1][0])[:REPORT_LINES]:
+        table.append('%9.1f KB %10d  %s:%d' % (size / 1024, count, filename, lineno))
+    return '\n'.join(table) + '\n'
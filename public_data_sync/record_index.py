@@ -0,0 +1,66 @@
+import sqlite3
+import time
+
+# Fixed width, so the stored dates sort and compare as plain strings
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# ============================================================================
+# Per record sync state
+# ============================================================================
+class RecordIndex(object):
+    """per record sync state
+
+    Keeps, for every ORCID iD, the last_modified date from the lambda file
+    of the summary and of the activities that are in the local tree. A
+    record only needs to be synced when the lambda file has a newer date
+    than the one applied, and its date is only updated once it synced
+    successfully, so a failed record is retried by the next run and records
+    already in sync are skipped by overlapping runs.
+
+    The index is a SQLite database only used by the main sync process,
+    changes are buffered and written in batches like the manifest does.
+
+    """
+    STREAMS = ('summaries', 'activities')
+
+    def __init__(self, fname, batch_size=1000, flush_interval=5):
+        self.fname = fname
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(fname, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS records (orcid TEXT NOT NULL PRIMARY KEY, summaries TEXT, activities TEXT) WITHOUT ROWID')
+        self._conn.commit()
+        self._pending = []
+        self._last_flush = time.time()
+
+    def applied(self, stream, orcid):
+        if stream not in self.STREAMS:
+            raise ValueError('Unknown stream ' + stream)
+        row = self._conn.execute('SELECT ' + stream + ' FROM records WHERE orcid = ?', (orcid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def is_current(self, stream, orcid, last_modified):
+        applied = self.applied(stream, orcid)
+        return applied is not None and applied >= last_modified.strftime(DATE_FORMAT)
+
+    def record(self, stream, orcid, last_modified):
+        if stream not in self.STREAMS:
+            raise ValueError('Unknown stream ' + stream)
+        # An older date never replaces a newer one, the lambda file can list a record twice
+        self._pending.append(('INSERT INTO records (orcid, ' + stream + ') VALUES (?, ?) ON CONFLICT (orcid) DO UPDATE SET ' + stream + ' = excluded.' + stream + ' WHERE ' + stream + ' IS NULL OR ' + stream + ' < excluded.' + stream, (orcid, last_modified.strftime(DATE_FORMAT))))
+        if len(self._pending) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+            self.commit()
+
+    def commit(self):
+        if self._pending:
+            with self._conn:
+                for statement, params in self._pending:
+                    self._conn.execute(statement, params)
+            self._pending = []
+        self._last_flush = time.time()
+
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import socket
+from datetime import datetime
+from . import partitions
+
+#---------------------------------------------------------
+# Parses a shard param like 2/8, the second of 8 shards
+#---------------------------------------------------------
+def parse_shard(value):
+    try:
+        shard, shards = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is an invalid shard, please specify it as <shard>/<number of shards>, like 2/8' % value)
+    if shards < 1 or shard < 1 or shard > shards:
+        raise argparse.ArgumentTypeError('%s is an invalid shard, it must be between 1 and the number of shards' % value)
+    if shards > len(partitions.CHECKSUMS):
+        raise argparse.ArgumentTypeError('%s is an invalid shard, there can not be more shards than the %s checksum prefixes' % (value, len(partitions.CHECKSUMS)))
+    return shard, shards
+
+def shard_name(shard, shards):
+    return 'shard-%d-of-%d' % (shard, shards)
+
+#---------------------------------------------------------
+# Completion markers, written to the storage the shards
+# share once a shard finished a stream
+#---------------------------------------------------------
+def marker_path(directory, stream, shard, shards):
+    return os.path.join(directory, stream + '-' + shard_name(shard, shards) + '.done')
+
+def write_marker(directory, stream, shard, shards, started, failed):
+    checksums = partitions.shard_checksums(shard, shards)
+    marker = {
+        'stream': stream,
+        'shard': shard,
+        'shards': shards,
+        'first_checksum': checksums[0],
+        'last_checksum': checksums[-1],
+        'host': socket.gethostname(),
+        'started': str(started),
+        'finished': str(datetime.now()),
+        'failed': failed,
+    }
+    fname = marker_path(directory, stream, shard, shards)
+    # Written aside and renamed, so a marker is never seen half written
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(marker, f, indent=2)
+    os.replace(fname + '.tmp', fname)
+
+def read_marker(directory, stream, shard, shards):
+    try:
+        with open(marker_path(directory, stream, shard, shards), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,805 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing import Pool
+from xml.etree.ElementTree import ParseError
+from . import change_feed
+from . import deltas
+from . import lambda_file
+from . import partitions
+from . import planner
+from . import profiling
+from . import transfer
+from . import transform
+from .archive import ArchiveWriter
+from .change_feed import ChangeFeed
+from .clients import Clients
+from .keylist import KeyList
+from .keylist import read_key_list
+from .manifest import Manifest
+from .metrics import Metrics
+from .metrics import MetricsFile
+from .packed_store import PackedStore
+from .record_index import RecordIndex
+
+logger = logging.getLogger('sync')
+# One message per downloaded file, sampled or rate limited with --log-sample and --log-rate
+file_logger = logging.getLogger('sync.files')
+
+# Outcome of a sync, the number of records synced, the last modified date of
+# the records that failed, the date the next sync starts from, the change
+# feed of the run and, with -t, its delta archive
+SyncResult = namedtuple('SyncResult', ['synced', 'failed', 'next_sync', 'changes', 'delta'])
+
+# The run the sync workers belong to, set before they are forked
+_run = None
+
+#---------------------------------------------------------
+# Validates an integer is positive
+#---------------------------------------------------------
+def integer_param_validator(value):
+    if int(value) <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid, please specify a positive value greater than 0" % value)
+    return int(value)
+
+#---------------------------------------------------------
+# Command line flags, their defaults are the defaults of
+# the configuration
+#---------------------------------------------------------
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--path', help='Path to place the public data files', default='./')
+    parser.add_argument('-s', '--summaries', help='Download summaries', action='store_true')
+    parser.add_argument('-a', '--activities', help='Download activities', action='store_true')
+    parser.add_argument('-t', '--tar', help='Write the files synced by this run, and the list of the files it deleted, to a delta archive named after its start time', action='store_true')
+    parser.add_argument('-r', '--recovery', help='Kept for compatibility, every run skips the records the index says are already in sync', action='store_true')
+    parser.add_argument('-d', '--days', help='Days to sync', type=integer_param_validator)
+    parser.add_argument('-l', '--log', help='Set the logging level, DEBUG by default', default='DEBUG')
+    parser.add_argument('--log-format', help='The format of the log file: text, or json for one JSON object per line', choices=['text', 'json'], default='text')
+    parser.add_argument('--log-sample', help='Only log one out of every N downloaded files', type=int, default=1)
+    parser.add_argument('--log-rate', help='Log at most N downloaded files per second in each process', type=int)
+    parser.add_argument('-max', '--max_threads', help='Maximum number of threads', type=integer_param_validator, default=10)
+    parser.add_argument('-n', '--page-size', help='The number of s3 items to list in one page', default=1000)
+    parser.add_argument('-f', '--force', help='Sync every modified record and download every activity, even the ones the index and the manifest say are already up to date', action='store_true')
+    parser.add_argument('--manifest', help='The manifest file that keeps track of the downloaded files', default='manifest.db')
+    parser.add_argument('--dead-letter', help='The file every key that failed to download is written to, with its bucket and error, it can be fed to download.py --fetch-list', default='sync_dead_letter.tsv')
+    parser.add_argument('--index', help='The index file that keeps track of the last modified date synced for every record', default='sync_index.db')
+    parser.add_argument('--batch-size', help='The number of records planned at once, the activities of the records of a batch that share a checksum prefix can be listed together', type=integer_param_validator, default=100000)
+    parser.add_argument('--prefix-size', help='The estimated number of activities under one checksum prefix, used to plan the listing when the manifest does not know it', type=integer_param_validator, default=300000)
+    parser.add_argument('--store', help='Where the activities are kept: files, one file per activity in the local tree, or packed, in the packed store of download.py --store packed, updated in place and compacted in the background', choices=['files', 'packed'], default='files')
+    parser.add_argument('--transform', help='Also write every synced file, parsed, as one JSON object per line to gzip compressed NDJSON delta shards in the delta folder of the given directory, along with the deleted activities')
+    parser.add_argument('--transform-fields', help='A JSON file mapping the fields to write with --transform to their element paths, like {"family_name": "person/name/family-name"}, the whole documents are written by default')
+    parser.add_argument('--transform-shard-size', help='The size in MB at which the NDJSON shards are rotated', type=integer_param_validator, default=256)
+    parser.add_argument('--changes-dir', help='The directory where every run writes its change feed, one JSON object per line for every file it added, updated or deleted', default='changes')
+    parser.add_argument('--metrics-dir', help='The directory where the stats file with the throughput, latency and error metrics is written', default='./')
+    parser.add_argument('--metrics-interval', help='The number of seconds between two updates of the stats file', default=10)
+    parser.add_argument('--profile', help='Profile every process of the run into the given directory: CPU profiles, stack samples and the time spent listing, downloading, writing files, creating folders, cleaning up and logging, merged into profile.pstats, profile.collapsed and report.txt once the run ends')
+    parser.add_argument('--profile-memory', help='With --profile, also trace the memory allocations of every process and add the lines still holding the most memory to the report', action='store_true')
+    parser.add_argument('--endpoint-url', help='The URL of an S3 compatible endpoint to use instead of AWS S3 (to override for testing and benchmarks)')
+    parser.add_argument('-x', '--summaries-bucket', help='The name of the summaries bucket (to override for testing)', default='v3.0-summaries')
+    parser.add_argument('-y', '--activities-bucket-base', help='The base name of the activities bucket (to override for testing)', default='v3.0-activities')
+    parser.add_argument('-z', '--lambda-bucket', help='The name of the bucket containing the lambda file (to override for testing', default='orcid-lambda-file')
+    return parser
+
+#---------------------------------------------------------
+# Configuration of a sync, the defaults of the flags with
+# the given options
+#---------------------------------------------------------
+def config(**options):
+    """Returns the configuration of a sync
+
+    Options are named after the long form of the command line flags, with
+    underscores, like config(path='/data', summaries=True, days=1).
+
+    """
+    values = create_parser().parse_args([])
+    for name, value in options.items():
+        if not hasattr(values, name):
+            raise TypeError('Unknown sync option ' + name)
+        setattr(values, name, value)
+    return values
+
+#---------------------------------------------------------
+# Finds the records a sync has to download
+#---------------------------------------------------------
+def plan_sync(config, clients=None, wait=True):
+    """Reads the lambda file and returns the SyncPlan of a sync
+
+    Nothing is downloaded, the plan can be looked at and then given to
+    sync, or just closed. With wait=False the lambda file is only read
+    once the plan's batches are asked for, and while they are synced.
+
+    """
+    clients = clients or Clients(config.endpoint_url)
+    start_time = datetime.now()
+
+    # Look for the config file
+    last_sync = None
+    if config.days is not None:
+        last_sync = (datetime.now() - timedelta(days=config.days))
+    elif os.path.isfile('last_ran.config'):
+        f = open('last_ran.config', 'r')
+        date_string = f.readline()
+        f.close()
+        last_sync = lambda_file.parse_last_modified(date_string.strip())
+    else:
+        last_sync = (datetime.now() - timedelta(days=30))
+
+    logger.info('Sync records modified after %s', str(last_sync))
+    plan = SyncPlan(config, start_time, last_sync, clients)
+    if wait:
+        plan.read()
+        plan.wait()
+    return plan
+
+#---------------------------------------------------------
+# Syncs the records modified since the last run
+#---------------------------------------------------------
+def sync(config, clients=None, plan=None):
+    """Runs a sync and returns a SyncResult
+
+    clients is a Clients, created from the endpoint_url of the
+    configuration when it is not given, pass the same one to every run so
+    its S3 clients are reused. The records to sync are read from the
+    lambda file unless the SyncPlan of plan_sync is given. Only one sync
+    runs at a time in a process, the records are synced by forked worker
+    processes. Nothing is logged unless the sync logger, or the root
+    logger, has a handler.
+
+    """
+    global _run
+    # Reading the lambda file is part of the run
+    profiler = profiling.start(config.profile, 'main', config.profile_memory) if config.profile else None
+    try:
+        clients = clients or Clients(config.endpoint_url)
+        # The first records download while the rest of the lambda file is read
+        plan = plan or plan_sync(config, clients, wait=False)
+        _run = Sync(config, clients)
+        try:
+            return _run.run(plan)
+        finally:
+            _run = None
+            plan.close()
+    finally:
+        if profiler is not None:
+            logger.info('The profile of this run is in ' + profiler.report())
+
+#---------------------------------------------------------
+# Worker functions, they run the methods of the sync they
+# were forked from
+#---------------------------------------------------------
+def sync_records(task):
+    return _run.sync_records(task)
+
+def start_worker():
+    _run.start_worker()
+
+# ============================================================================
+# Sync plan
+# ============================================================================
+class SyncPlan(object):
+    """records to sync
+
+    The records the lambda file says were modified after last_sync and
+    the index says are not in sync yet, along with the number of records
+    read and the number already in sync for every stream. The lambda file
+    is read by a thread that spools the records to disk, so memory stays
+    flat however many there are. batches follows the spool while it is
+    written, batch_size records at a time, with the listing plan of their
+    activities, so the first records are synced while the rest of the
+    file is read.
+
+    """
+    def __init__(self, config, start_time, last_sync, clients=None):
+        self.config = config
+        self.start_time = start_time
+        self.last_sync = last_sync
+        self.clients = clients
+        self.records_read = 0
+        self.records_to_sync = 0
+        self.current = {'summaries': 0, 'activities': 0}
+        self.spool = tempfile.TemporaryFile('w+b')
+        self._manifest = Manifest(config.manifest)
+        self._condition = threading.Condition()
+        self._spooled = 0
+        self._reader = None
+        self._reading = False
+        self._closed = False
+        self._error = None
+
+    def read(self):
+        """Starts reading the lambda file, unless it was already"""
+        if self._reader is None:
+            self._reading = True
+            self._reader = threading.Thread(target=self._read)
+            self._reader.daemon = True
+            self._reader.start()
+
+    def wait(self):
+        """Waits until the whole lambda file is read"""
+        self._reader.join()
+        if self._error is not None:
+            raise self._error
+
+    def _read(self):
+        # Stream the lambda file, it stops reading once it reaches records older than last_sync
+        logger.info('Reading the lambda file')
+        config = self.config
+        index = RecordIndex(config.index)
+        streams = [stream for stream, enabled in (('summaries', config.summaries), ('activities', config.activities)) if enabled]
+        lines = []
+        try:
+            for orcid, last_modified_date in lambda_file.iter_modified_records(self.clients.s3client, config.lambda_bucket, self.last_sync):
+                if self._closed:
+                    return
+                self.records_read += 1
+                # Records whose last modified date is already applied locally are skipped
+                needed = [stream for stream in streams if config.force or not index.is_current(stream, orcid, last_modified_date)]
+                for stream in streams:
+                    if stream not in needed:
+                        self.current[stream] += 1
+                if needed:
+                    lines.append(orcid + ',' + str(last_modified_date) + ',' + '+'.join(needed) + '\n')
+                    self.records_to_sync += 1
+                if len(lines) >= 1000:
+                    self._spool(lines)
+                    lines = []
+                if self.records_read % 100000 == 0:
+                    logger.info('Records read from the lambda file so far: %s', self.records_read)
+            self._spool(lines)
+            logger.info('Records modified: %s, records to sync: %s', self.records_read, self.records_to_sync)
+        except Exception as e:
+            self._error = e
+        finally:
+            index.close()
+            with self._condition:
+                self._reading = False
+                self._condition.notify_all()
+
+    def _spool(self, lines):
+        data = ''.join(lines).encode('utf-8')
+        with self._condition:
+            self.spool.seek(self._spooled)
+            self.spool.write(data)
+            self._spooled += len(data)
+            self._condition.notify_all()
+
+    def batches(self):
+        """Yields a (batch, ListingPlan, tasks) tuple for every batch of records
+
+        While the lambda file is being read, a batch is also cut once it
+        holds every record spooled so far.
+
+        """
+        self.read()
+        batch = []
+        for record in self._spooled_records():
+            if record is not None:
+                batch.append(record)
+            if len(batch) >= self.config.batch_size or (record is None and batch):
+                plan, tasks = planner.plan_record_batch(batch, self.bucket_name, self.estimate_prefix_objects, int(self.config.page_size))
+                yield batch, plan, tasks
+                batch = []
+        if batch:
+            plan, tasks = planner.plan_record_batch(batch, self.bucket_name, self.estimate_prefix_objects, int(self.config.page_size))
+            yield batch, plan, tasks
+
+    def _spooled_records(self):
+        # Yields None every time it caught up with the records spooled so far
+        position = 0
+        while True:
+            with self._condition:
+                ready = self._spooled - position
+                reading = self._reading
+                if ready:
+                    self.spool.seek(position)
+                    data = self.spool.read(min(ready, 1024 * 1024))
+                    # Only whole lines
+                    data = data[:data.rindex(b'\n') + 1]
+                    position += len(data)
+            if ready:
+                for line in data.decode('utf-8').splitlines():
+                    orcid, last_modified_date, needed = line.split(',')
+                    yield orcid, lambda_file.parse_last_modified(last_modified_date), needed.split('+')
+            elif reading:
+                yield None
+                with self._condition:
+                    while position == self._spooled and self._reading:
+                        self._condition.wait()
+            elif self._error is not None:
+                raise self._error
+            else:
+                return
+
+    #---------------------------------------------------------
+    # Estimated number of activities under a checksum prefix
+    #---------------------------------------------------------
+    def estimate_prefix_objects(self, bucket, checksum):
+        count = self._manifest.count_prefix(bucket, checksum + '/')
+        if self._manifest.is_listed(bucket, checksum + '/'):
+            return count
+        # A prefix only partly downloaded holds more activities than the manifest knows about
+        return max(count, self.config.prefix_size)
+
+    def bucket_name(self, orcid):
+        return self.config.activities_bucket_base + '-' + partitions.activities_bucket_suffix(orcid)
+
+    def close(self):
+        self._closed = True
+        if self._reader is not None:
+            self._reader.join()
+        self.spool.close()
+        self._manifest.close()
+
+#---------------------------------------------------------
+# The date the next run starts from and the records that
+# failed for good, which do not hold it back
+#---------------------------------------------------------
+def next_sync_date(start_time, failed, dead_letters):
+    """Returns the next last_sync and the ORCIDs that failed for good
+
+    failed maps the ORCIDs that failed to their last modified date and
+    dead_letters are the KeyEntry of the files that failed. A record
+    whose every file failed with a permanent error, like a 404, would
+    fail again in every run, so only the other ones, including the
+    records that failed without a file to show for it, like a listing
+    error, keep the next run from starting after them.
+
+    """
+    permanent = set()
+    transient = set()
+    for entry in dead_letters:
+        # <checksum>/<orcid>.xml for a summary, <checksum>/<orcid>/<type>/<name> for an activity
+        orcid = entry.key.split('/')[1]
+        if orcid.endswith('.xml'):
+            orcid = orcid[:-4]
+        (permanent if transfer.is_permanent_error(entry.reason) else transient).add(orcid)
+    lost = permanent - transient
+    held = [last_modified for orcid, last_modified in failed.items() if orcid not in lost]
+    return (min(held) if held else start_time), sorted(lost & set(failed))
+
+# ============================================================================
+# Sync run
+# ============================================================================
+class Sync(object):
+    """sync run
+
+    Holds the configuration and the state of a single sync: the clients,
+    the manifest, the metrics and the dead-letter file, change feed,
+    packed store and NDJSON shards the main process opens before the
+    workers are forked.
+
+    """
+    def __init__(self, config, clients):
+        self.config = config
+        self.s3client = clients.s3client
+        self.download_client = clients.download_client
+
+        path = config.path if config.path.endswith('/') else (config.path + '/')
+        self.path = path + 'ORCID_public_data_files/'
+        self.download_summaries = config.summaries
+        self.download_activities = config.activities
+        self.max_threads = config.max_threads
+        self.force = config.force
+        self.page_size = int(config.page_size)
+        self.summaries_bucket = config.summaries_bucket
+        self.projection = transform.load_projection(config.transform_fields) if config.transform_fields else None
+        self.metrics_dir = config.metrics_dir
+        self.metrics_interval = float(config.metrics_interval)
+
+        # ETag, size and last modified date of the files already downloaded
+        self.manifest = Manifest(config.manifest)
+
+        # Every worker collects into its own copy, sent back to the main process with its results
+        self.metrics = Metrics()
+
+        self.executor = None
+        self.executor_pid = None
+
+        # Keys that failed to download, opened by the main process before the workers start
+        self.dead_letters = None
+
+        # Files added, updated and deleted by this run, opened by the main process before the workers start
+        self.changes = None
+
+        # With --store packed, the store of the activities, opened by the main process before the workers start
+        self.store = None
+
+        # With --transform, the NDJSON delta shards of the run, opened by the main process before the workers start
+        self.ndjson = None
+
+        # With -t, the delta archive of the run, opened by the main process before the workers start
+        self.archive = None
+
+    #---------------------------------------------------------
+    # Main process
+    #---------------------------------------------------------
+    def run(self, plan):
+        config = self.config
+        start_time = plan.start_time
+        index = RecordIndex(config.index)
+        stats = MetricsFile(self.metrics, os.path.join(self.metrics_dir, 'sync.prom'), self.metrics_interval).start()
+
+        # Summaries and activities share the same workers, each task covers whole records
+        # The next run retries the records that failed, so the file only lists the failures of this run
+        open(config.dead_letter, 'w').close()
+        self.dead_letters = KeyList(config.dead_letter)
+        # Every run writes its own change feed, named after its start time
+        os.makedirs(config.changes_dir, exist_ok=True)
+        self.changes = ChangeFeed(os.path.join(config.changes_dir, 'sync-' + start_time.strftime('%Y%m%d%H%M%S') + '.ndjson'))
+        if self.download_activities and config.store == 'packed':
+            self.store = PackedStore(self.path + 'activities.pack')
+        if config.transform:
+            # Every run writes its own delta shards, named after its start time
+            self.ndjson = transform.NdjsonWriter(os.path.join(config.transform, 'delta'), 'delta-' + start_time.strftime('%Y%m%d%H%M%S'), True, config.transform_shard_size * 1024 * 1024)
+        delta_path = deltas.delta_name(start_time)
+        if config.tar:
+            self.open_delta(plan)
+        pool = Pool(processes=self.max_threads, initializer=start_worker)
+        if self.store is not None:
+            # Updated in place by the workers, the segments they leave mostly dead are compacted meanwhile
+            self.store.start_compactor(logger)
+        results = queue.Queue()
+        in_flight = 0
+        failed = {}
+        synced = 0
+        for batch, listing_plan, tasks in plan.batches():
+            logger.info('Syncing %s records in %s tasks', len(batch), len(tasks))
+            logger.info('Listing %s checksum prefixes whole and %s records one by one', listing_plan.prefix_tasks, len(listing_plan.tasks) - listing_plan.prefix_tasks)
+            logger.info('Planned %s list requests instead of %s, %s saved', listing_plan.planned_requests, listing_plan.naive_requests, listing_plan.saved_requests)
+            for task in tasks:
+                # Only a few tasks wait for a worker at any time
+                while in_flight >= 2 * self.max_threads:
+                    synced += self.collect(index, failed, *results.get())
+                    in_flight -= 1
+                pool.apply_async(sync_records, (task,), callback=lambda result, task=task: results.put((task, result)), error_callback=lambda e, task=task: results.put((task, e)))
+                in_flight += 1
+        while in_flight:
+            synced += self.collect(index, failed, *results.get())
+            in_flight -= 1
+        # Counted once the whole lambda file was read
+        for stream, current in sorted(plan.current.items()):
+            if current:
+                self.metrics.inc('records_total', current, stream=stream, result='current')
+        self.metrics.inc('lambda_records_total', plan.records_read)
+
+        pool.close()
+        pool.join()
+        self.dead_letters.close()
+        self.changes.close()
+        logger.info('The changes of this run are in ' + self.changes.fname)
+        if self.store is not None:
+            self.store.close()
+        if self.ndjson is not None:
+            self.ndjson.close()
+        self.manifest.close()
+        index.close()
+        stats.stop()
+
+        # The next run starts from the oldest record that failed, everything before it is in sync
+        next_sync, lost = next_sync_date(start_time, failed, read_key_list(config.dead_letter))
+        if lost:
+            logger.warning('%s records failed with errors a retry would get again, like a missing file, the next run will not retry them, the files that failed are listed in %s', len(lost), config.dead_letter)
+        if len(failed) > len(lost):
+            logger.warning('%s records failed to sync, the next run will retry them starting from %s, the files that failed are listed in %s', len(failed) - len(lost), str(next_sync), config.dead_letter)
+        elif not failed:
+            logger.info('All files are in sync now')
+        if self.archive is not None:
+            self.close_delta(delta_path, plan, next_sync)
+
+        # keep track of the point the next run has to start from
+        file = open('last_ran.config', 'w')
+        file.write(str(next_sync))
+        file.close()
+        logger.info('last_ran.config is ready')
+        logger.info('End of script')
+        return SyncResult(synced, failed, next_sync, self.changes.fname, delta_path if self.archive is not None else None)
+
+    #---------------------------------------------------------
+    # Open the shards of the delta, a run that was killed left
+    # the files it synced there, and the records it synced are
+    # in the index, so the next run carries on with them
+    #---------------------------------------------------------
+    def open_delta(self, plan):
+        if os.path.isdir(deltas.WORKSPACE + '.parts'):
+            logger.warning('Resuming the delta of a sync that was killed, its files and deletions are added to the delta of the records modified after %s', str(plan.last_sync))
+        # Every worker compresses the files it syncs to its own shard
+        self.archive = ArchiveWriter(deltas.WORKSPACE + '.parts', True)
+        with open(deltas.WORKSPACE + '.feeds', 'a') as feeds:
+            feeds.write(self.changes.fname + '\n')
+
+    #---------------------------------------------------------
+    # Add the deletions, read back from the change feeds of
+    # every run that wrote the delta, and the metadata to the
+    # delta archive and assemble it
+    #---------------------------------------------------------
+    def close_delta(self, delta_path, plan, next_sync):
+        with open(deltas.WORKSPACE + '.feeds') as feeds:
+            files, deleted = deltas.read_changes([line[:-1] for line in feeds if line.endswith('\n')])
+        self.archive.add(deltas.DELETIONS_MEMBER, ''.join(name + '\n' for name in deleted).encode('utf-8'))
+        self.archive.add(deltas.METADATA_MEMBER, json.dumps(deltas.metadata(plan.start_time, plan.last_sync, next_sync, files, len(deleted))).encode('utf-8'))
+        logger.info('Assembling ' + delta_path)
+        shards = self.archive.assemble(delta_path)
+        os.remove(deltas.WORKSPACE + '.feeds')
+        logger.info('%s written from %s shards, %s files and %s deletions', delta_path, shards, files, len(deleted))
+
+    def collect(self, index, failed, task, result):
+        task_failed = self.finish_task(index, task, result)
+        failed.update(task_failed)
+        return len(task.last_modified) - len(task_failed)
+
+    #---------------------------------------------------------
+    # Syncs the summaries and the activities of the records of
+    # a task, returns the (stream, orcid) pairs in sync
+    #---------------------------------------------------------
+    def sync_records(self, task):
+        # Summaries download while the activities are listed
+        summaries = [(orcid, self.get_executor().submit(self.sync_summaries, orcid, task.last_modified[orcid])) for orcid in task.summaries]
+        synced = []
+        if task.listing is not None:
+            synced.extend(('activities', orcid) for orcid in self.process_activities(task.listing, task.last_modified))
+        for orcid, future in summaries:
+            if future.result():
+                synced.append(('summaries', orcid))
+        self.manifest.commit()
+        if self.store is not None:
+            # The index only records the records whose activities are in the store
+            self.store.commit()
+        # Nor the records whose files are still buffered, a killed run would leave them out of the delta
+        if self.archive is not None:
+            self.archive.flush()
+        if self.ndjson is not None:
+            self.ndjson.flush()
+        return synced, self.metrics.snapshot(reset=True)
+
+    #---------------------------------------------------------
+    # Workers only send back their own metrics, not the ones
+    # the main process had collected when it forked them
+    #---------------------------------------------------------
+    def start_worker(self):
+        self.metrics.snapshot(reset=True)
+        profiling.start_process('worker')
+
+    #---------------------------------------------------------
+    # Download threads of the worker process, kept for the
+    # whole run and shared by summaries and activities
+    #---------------------------------------------------------
+    def get_executor(self):
+        if self.executor_pid != os.getpid():
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads)
+            self.executor_pid = os.getpid()
+        return self.executor
+
+    def sync_summaries(self, orcid_to_sync, last_modified):
+        suffix = orcid_to_sync[-3:]
+        prefix = suffix + '/' + orcid_to_sync + '.xml'
+        file_path = self.path + 'summaries/' + suffix + '/'
+        file_name = orcid_to_sync + '.xml'
+        try:
+            with profiling.span('mkdir'):
+                if not os.path.exists(file_path):
+                    os.makedirs(file_path)
+        except:
+            pass
+        file_logger.debug('Downloading %s to %s', file_name, file_path)
+        # Summaries are not listed, so neither the manifest nor the change feed get their ETag
+        operation = change_feed.UPDATE if os.path.exists(file_path + file_name) else change_feed.ADD
+
+        # Downloading the file, throttled requests are retried
+        result = transfer.download(self.download_client, self.summaries_bucket, prefix, file_path + file_name)
+        transfer.record_metrics(self.metrics, self.summaries_bucket, os.path.getsize(file_path + file_name) if result.downloaded else 0, result)
+        if result.downloaded:
+            self.changes.add(orcid_to_sync, 'summaries/' + prefix, operation, os.path.getsize(file_path + file_name), None, last_modified)
+            self.keep_file('summaries/', prefix, file_path + file_name)
+        if not result.downloaded:
+            logger.error('Error fetching ' + orcid_to_sync + ': ' + result.error)
+            self.dead_letters.add(self.summaries_bucket, prefix, transfer.error_class(result.error))
+        return result.downloaded
+
+    def sync_activities(self, element):
+        activities_bucket = element[0]
+        file_to_download = element[1]
+        components = file_to_download.split('/')
+        # Checksum
+        checksum = components[0]
+        # ORCID
+        orcid = components[1]
+        # Activity type
+        type = components[2]
+        # File name
+        name = components[3]
+
+        if self.store is not None:
+            # Downloading the file into the packed store, throttled requests are retried
+            file_logger.debug('Downloading %s to the packed store', file_to_download)
+            result, data = transfer.fetch(self.download_client, activities_bucket, file_to_download)
+            if result.downloaded:
+                with profiling.span('write'):
+                    self.store.put(file_to_download, data)
+                self.keep('activities/', file_to_download, data)
+            transfer.record_metrics(self.metrics, activities_bucket, len(data) if result.downloaded else 0, result)
+            if not result.downloaded:
+                logger.error('Error fetching ' + file_to_download + ': ' + result.error)
+                self.dead_letters.add(activities_bucket, file_to_download, transfer.error_class(result.error))
+            return result.downloaded
+
+        file_path = self.path + 'activities/' + checksum + '/' + orcid + '/' + type + '/'
+        file_logger.debug('Downloading %s to %s', name, file_path)
+        try:
+            with profiling.span('mkdir'):
+                if not os.path.exists(file_path):
+                    os.makedirs(file_path)
+        except:
+            pass
+        # Downloading the file, throttled requests are retried
+        result = transfer.download(self.download_client, activities_bucket, file_to_download, file_path + name)
+        transfer.record_metrics(self.metrics, activities_bucket, os.path.getsize(file_path + name) if result.downloaded else 0, result)
+        if result.downloaded:
+            self.keep_file('activities/', file_to_download, file_path + name)
+        if not result.downloaded:
+            logger.error('Error fetching ' + file_to_download + ': ' + result.error)
+            self.dead_letters.add(activities_bucket, file_to_download, transfer.error_class(result.error))
+        return result.downloaded
+
+    #---------------------------------------------------------
+    # Deletes the local activities of a record that are not
+    # in S3 anymore, along with the folders left empty
+    #---------------------------------------------------------
+    def reconcile_activities(self, orcid_to_sync, activities_bucket, listed, last_modified):
+        activities_dir = self.path + 'activities/'
+        checksum_dir = activities_dir + orcid_to_sync[-3:]
+        remote_keys = set(element['Key'] for element in listed)
+        deleted = []
+        if self.store is not None:
+            # The activities just downloaded are committed before the record's keys are read back
+            self.store.commit()
+            for key in self.store.keys(orcid_to_sync[-3:] + '/' + orcid_to_sync + '/'):
+                if key not in remote_keys:
+                    logger.info('Deleting %s from the packed store because it is not in S3 anymore', key)
+                    self.changes.add(orcid_to_sync, 'activities/' + key, change_feed.DELETE, self.store.getsize(key), None, last_modified)
+                    self.store.delete(key)
+                    if self.ndjson is not None:
+                        self.ndjson.write(transform.deletion(key))
+                    self.manifest.forget(activities_bucket, key)
+                    self.metrics.inc('objects_total', bucket=activities_bucket, result='deleted')
+                    deleted.append(key)
+            return deleted
+        # Walk bottom up so every folder is visited after its content
+        for root, dirs, files in os.walk(checksum_dir + '/' + orcid_to_sync, topdown=False):
+            for name in files:
+                key = os.path.relpath(os.path.join(root, name), activities_dir).replace(os.sep, '/')
+                if key not in remote_keys:
+                    logger.info('Deleting %s because it is not in S3 anymore', activities_dir + key)
+                    self.changes.add(orcid_to_sync, 'activities/' + key, change_feed.DELETE, os.path.getsize(activities_dir + key), None, last_modified)
+                    os.remove(activities_dir + key)
+                    if self.ndjson is not None:
+                        self.ndjson.write(transform.deletion(key))
+                    self.manifest.forget(activities_bucket, key)
+                    self.metrics.inc('objects_total', bucket=activities_bucket, result='deleted')
+                    deleted.append(key)
+            self.delete_if_empty(root)
+        # The checksum folder is shared with other records being synced at the same time
+        self.delete_if_empty(checksum_dir)
+        return deleted
+
+    def delete_if_empty(self, directory):
+        try:
+            # rmdir is atomic and fails unless the folder is empty
+            os.rmdir(directory)
+            logger.info('Deleting %s because it is empty', directory)
+        except OSError:
+            pass
+
+    def process_activities(self, task, last_modified):
+        paginator = self.s3client.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(Bucket=task.bucket, Prefix=task.prefix, PaginationConfig={'PageSize': self.page_size})
+
+        # Listing a whole checksum prefix also returns records we don't need to sync
+        listed = dict((orcid, []) for orcid in task.orcids)
+        page_count = 1
+        list_start = time.time()
+        for page in page_iterator:
+            elapsed = time.time() - list_start
+            self.metrics.inc('list_requests_total', bucket=task.bucket)
+            self.metrics.inc('list_seconds_total', elapsed, bucket=task.bucket)
+            self.metrics.observe('request_seconds', elapsed, bucket=task.bucket, operation='list')
+            profiling.record('list', elapsed)
+            logger.info('Activities page count: ' + str(page_count) + ' for ' + task.bucket + '/' + task.prefix)
+            page_count += 1
+            for element in page.get('Contents', []):
+                orcid = element['Key'].split('/')[1]
+                if orcid in listed:
+                    listed[orcid].append(element)
+            list_start = time.time()
+
+        # The records whose activities are all in sync
+        synced = []
+        for orcid in sorted(listed):
+            if self.sync_record_activities(orcid, task.bucket, listed[orcid], last_modified[orcid]):
+                synced.append(orcid)
+        return synced
+
+    def sync_record_activities(self, orcid_to_sync, activities_bucket, listed, last_modified):
+        if not listed:
+            logger.warn('Unable to find activities for %s', orcid_to_sync)
+        elements = []
+        for element in listed:
+            if self.store is not None:
+                current = self.manifest.is_current(activities_bucket, element['Key'], element['ETag'], element['Size'], element['Key'], self.store.getsize)
+            else:
+                current = self.manifest.is_current(activities_bucket, element['Key'], element['ETag'], element['Size'], self.path + 'activities/' + element['Key'])
+            if self.force or not current:
+                elements.append(element)
+        self.metrics.inc('objects_total', len(listed) - len(elements), bucket=activities_bucket, result='skipped')
+
+        synced = True
+        results = self.get_executor().map(self.sync_activities, [[activities_bucket, element['Key']] for element in elements])
+        for element, downloaded in zip(elements, results):
+            if downloaded:
+                # An update when the manifest already knows the file, checked before it records the new version
+                operation = change_feed.UPDATE if self.manifest.contains(activities_bucket, element['Key']) else change_feed.ADD
+                self.changes.add(orcid_to_sync, 'activities/' + element['Key'], operation, element['Size'], element['ETag'], last_modified)
+                self.manifest.record(activities_bucket, element['Key'], element['ETag'], element['Size'], element['LastModified'])
+            else:
+                synced = False
+
+        # One pass over the local tree once every activity of the record is in place
+        with profiling.span('cleanup'):
+            self.reconcile_activities(orcid_to_sync, activities_bucket, listed, last_modified)
+        return synced
+
+    #---------------------------------------------------------
+    # Adds a synced file to the delta archive and writes its
+    # NDJSON entry
+    #---------------------------------------------------------
+    def keep_file(self, directory_name, key, file_path):
+        if self.archive is not None or self.ndjson is not None:
+            with open(file_path, 'rb') as f:
+                self.keep(directory_name, key, f.read())
+
+    def keep(self, directory_name, key, data):
+        if self.archive is not None:
+            self.archive.add(directory_name + key, data)
+        if self.ndjson is not None:
+            self.transform_object(key, data)
+
+    def transform_object(self, key, data):
+        try:
+            self.ndjson.write(transform.entry(key, data, self.projection))
+        except ParseError as e:
+            logger.error('Error transforming %s: %s', key, transfer.describe_error(e))
+            self.metrics.inc('transform_errors_total')
+
+    #---------------------------------------------------------
+    # Records the outcome of a task in the index, returns the
+    # last modified date of the records that failed
+    #---------------------------------------------------------
+    def finish_task(self, index, task, result):
+        synced = set()
+        if isinstance(result, Exception):
+            logger.error('Unexpected error syncing %s: %s', ', '.join(sorted(task.last_modified)), transfer.describe_error(result))
+        else:
+            pairs, snapshot = result
+            self.metrics.merge(snapshot)
+            synced.update(pairs)
+        expected = [('summaries', orcid) for orcid in task.summaries]
+        if task.listing is not None:
+            expected.extend(('activities', orcid) for orcid in sorted(task.listing.orcids))
+        failed = {}
+        for stream, orcid in expected:
+            if (stream, orcid) in synced:
+                index.record(stream, orcid, task.last_modified[orcid])
+                self.metrics.inc('records_total', stream=stream, result='synced')
+            else:
+                failed[orcid] = task.last_modified[orcid]
+                self.metrics.inc('records_total', stream=stream, result='failed')
+        return failed
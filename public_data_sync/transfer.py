@@ -0,0 +1,142 @@
+import io
+import os
+import random
+import time
+from collections import namedtuple
+from . import profiling
+
+# Error codes S3 answers with when it wants clients to slow down
+THROTTLING_ERROR_CODES = set(['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'ServiceUnavailable', 'RequestTimeout', 'InternalError', '500', '503'])
+
+# Error codes that will not go away by retrying, the object is gone or can not be read
+PERMANENT_ERROR_CODES = set(['404', '403', 'NoSuchKey', 'NotFound', 'AccessDenied', 'Forbidden'])
+
+# Result of a download, latency covers every attempt and error describes the last failure
+Transfer = namedtuple('Transfer', ['downloaded', 'latency', 'retries', 'throttled', 'error'])
+
+#---------------------------------------------------------
+# Whether an error means we are going too fast, or the
+# connection timed out, and the request can be retried
+#---------------------------------------------------------
+def is_throttling_error(e):
+    # Imported on first use, so importing this module does not load botocore
+    from botocore.exceptions import ClientError
+    from botocore.exceptions import ConnectionError
+    from botocore.exceptions import HTTPClientError
+    from s3transfer.exceptions import RetriesExceededError
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in THROTTLING_ERROR_CODES or status in (500, 503)
+    # Timeouts, resets and other connection errors, s3transfer gives up on a broken stream after a few attempts
+    return isinstance(e, (ConnectionError, HTTPClientError, RetriesExceededError))
+
+#---------------------------------------------------------
+# Error description that can be sent across processes
+#---------------------------------------------------------
+def describe_error(e):
+    return type(e).__name__ + ': ' + str(e)
+
+#---------------------------------------------------------
+# Short error class, as written to the dead-letter files
+#---------------------------------------------------------
+def error_class(error):
+    name, _, message = error.partition(':')
+    # The code of a ClientError, like 404 or AccessDenied, says more than its class
+    if name == 'ClientError' and '(' in message and ')' in message:
+        return name + ' ' + message[message.index('('):message.index(')') + 1]
+    return name
+
+#---------------------------------------------------------
+# Whether an error class, as returned by error_class, is
+# one a later run would get again
+#---------------------------------------------------------
+def is_permanent_error(error):
+    name, _, code = error.partition(' ')
+    return name == 'ClientError' and code.strip('()') in PERMANENT_ERROR_CODES
+
+#---------------------------------------------------------
+# Exponential backoff with full jitter
+#---------------------------------------------------------
+def backoff_delay(attempt, base=0.1, cap=20):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+#---------------------------------------------------------
+# Download a file, retrying throttled requests
+#---------------------------------------------------------
+def download(s3client, bucket, key, file_path, max_retries=5):
+    """Downloads bucket/key to file_path and returns a Transfer
+
+    Throttling errors and timeouts are retried up to max_retries times
+    with jittered exponential backoff, any other error is given up on
+    straight away. The client should have its own retries disabled so
+    throttling is seen, and reported, here.
+
+    """
+    if profiling.current() is None:
+        return with_retries(lambda: s3client.download_file(bucket, key, file_path), max_retries)
+    # Profiled, the object is fetched into memory first so writing it is timed on its own
+    result, data = fetch(s3client, bucket, key, max_retries)
+    if not result.downloaded:
+        return result
+    try:
+        with profiling.span('write'):
+            # Write to a temporary file so a failed write never leaves a truncated file behind
+            with open(file_path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(file_path + '.part', file_path)
+    except OSError as e:
+        return result._replace(downloaded=False, error=describe_error(e))
+    return result
+
+#---------------------------------------------------------
+# Download an object into memory, retrying throttled requests
+#---------------------------------------------------------
+def fetch(s3client, bucket, key, max_retries=5):
+    """Returns the Transfer of bucket/key and its content, None when it failed"""
+    buffers = []
+
+    def get():
+        # Every attempt starts from an empty buffer
+        buffers[:] = [io.BytesIO()]
+        s3client.download_fileobj(bucket, key, buffers[0])
+
+    result = with_retries(get, max_retries)
+    return result, buffers[0].getvalue() if result.downloaded else None
+
+def with_retries(request, max_retries):
+    start = time.time()
+    throttled = 0
+    attempt = 0
+    while True:
+        try:
+            request()
+            return Transfer(True, time.time() - start, attempt, throttled, None)
+        except Exception as e:
+            # Any error, even an unexpected one, is reported instead of killing the worker
+            if not is_throttling_error(e):
+                return Transfer(False, time.time() - start, attempt, throttled, describe_error(e))
+            throttled += 1
+            if attempt >= max_retries:
+                return Transfer(False, time.time() - start, attempt, throttled, describe_error(e))
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+#---------------------------------------------------------
+# Throughput, latency and error metrics of a download
+#---------------------------------------------------------
+def record_metrics(metrics, bucket, size, result):
+    metrics.inc('objects_total', bucket=bucket, result='downloaded' if result.downloaded else 'failed')
+    # Workers that crashed did not time anything
+    if result.latency is not None:
+        metrics.inc('download_seconds_total', result.latency, bucket=bucket)
+        metrics.observe('request_seconds', result.latency, bucket=bucket, operation='get')
+        profiling.record('get', result.latency)
+    if result.downloaded:
+        metrics.inc('bytes_total', size, bucket=bucket)
+    else:
+        metrics.inc('errors_total', bucket=bucket, error=error_class(result.error))
+    if result.retries:
+        metrics.inc('retries_total', result.retries, bucket=bucket)
+    if result.throttled:
+        metrics.inc('throttled_total', result.throttled, bucket=bucket)
@@ -0,0 +1,211 @@
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import zlib
+from .processes import per_process
+
+#---------------------------------------------------------
+# Tag or attribute name without its namespace
+#---------------------------------------------------------
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+#---------------------------------------------------------
+# JSON value of an element: its text when it is a plain
+# leaf, otherwise a dict of its attributes and children
+#---------------------------------------------------------
+def element_value(element):
+    children = list(element)
+    text = (element.text or '').strip()
+    if not children and not element.attrib:
+        return text or None
+    value = {}
+    for name, attribute in element.attrib.items():
+        value['@' + local_name(name)] = attribute
+    for child in children:
+        add_value(value, local_name(child.tag), element_value(child))
+    if text:
+        value['#text'] = text
+    return value
+
+def add_value(values, name, value):
+    # Repeated elements become lists
+    if name not in values:
+        values[name] = value
+    elif isinstance(values[name], list):
+        values[name].append(value)
+    else:
+        values[name] = [values[name], value]
+
+#---------------------------------------------------------
+# ORCID iD and type of an object from its key, summaries
+# are <checksum>/<orcid>.xml and activities are
+# <checksum>/<orcid>/<type>/<name>
+#---------------------------------------------------------
+def describe_key(key):
+    components = key.split('/')
+    if len(components) == 2:
+        return components[1][:-len('.xml')], 'summary'
+    return components[1], components[2]
+
+#---------------------------------------------------------
+# Parses an ORCID XML document into a dict
+#---------------------------------------------------------
+def transform(data, projection=None):
+    """Returns the content of the XML document in data as a dict
+
+    Without a projection, the dict holds the whole document under the
+    local name of its root element. A projection maps output field names
+    to element paths, local names separated by / from the root element
+    down, like person/name/family-name, and only the elements at those
+    paths are kept. The document is parsed incrementally and every element
+    outside the projection is dropped as soon as it is parsed.
+
+    """
+    fields = {}
+    for name, field_path in (projection or {}).items():
+        fields.setdefault(field_path.strip('/'), []).append(name)
+
+    result = {}
+    stack = []
+    for event, element in ElementTree.iterparse(io.BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            stack.append(local_name(element.tag))
+            continue
+        element_path = '/'.join(stack[1:])
+        if projection is None:
+            if len(stack) == 1:
+                result[stack[0]] = element_value(element)
+        else:
+            if element_path in fields:
+                value = element_value(element)
+                for name in fields[element_path]:
+                    add_value(result, name, value)
+            # Its children already ended, only the content of projected elements is still needed
+            if not any(element_path.startswith(field_path + '/') for field_path in fields):
+                element.clear()
+        stack.pop()
+    return result
+
+#---------------------------------------------------------
+# Reads the projection of a JSON file
+#---------------------------------------------------------
+def load_projection(fname):
+    with open(fname, 'r') as f:
+        projection = json.load(f)
+    if not isinstance(projection, dict) or not all(isinstance(value, str) for value in projection.values()):
+        raise ValueError(fname + ' must hold a JSON object mapping field names to element paths')
+    return projection
+
+#---------------------------------------------------------
+# NDJSON entry of an object
+#---------------------------------------------------------
+def entry(key, data, projection=None):
+    orcid, object_type = describe_key(key)
+    values = {'key': key, 'orcid': orcid, 'type': object_type}
+    values.update(transform(data, projection))
+    return values
+
+def deletion(key):
+    orcid, object_type = describe_key(key)
+    return {'key': key, 'orcid': orcid, 'type': object_type, 'deleted': True}
+
+# ============================================================================
+# Sharded NDJSON writer
+# ============================================================================
+class NdjsonWriter(object):
+    """sharded NDJSON writer
+
+    Every process writing entries, like the download workers, writes its
+    own gzip compressed shards in directory, named after prefix, the
+    process and a sequence number. A shard is named .part while it is
+    written and is renamed to .ndjson.gz once it reaches max_bytes, and a
+    new one is started, or its process closes the writer, so readers only
+    ever pick up complete shards.
+
+    Unless resume is given, the complete shards with the same prefix left
+    by a previous run are removed. With resume, the .part shards left by a
+    run that was killed are completed with the lines they hold, everything
+    written before the last flush is there.
+
+    """
+    def __init__(self, directory, prefix, resume=False, max_bytes=256 * 1024 * 1024, compresslevel=6):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self._owner = os.getpid()
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if not name.startswith(prefix + '-'):
+                continue
+            if not resume and name.endswith('.ndjson.gz'):
+                os.remove(os.path.join(directory, name))
+            elif resume and name.endswith('.ndjson.gz.part'):
+                recover_shard(os.path.join(directory, name))
+
+    def _open_shard(self):
+        # Runs with the lock held
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._name = '%s-%d-%d' % (self.prefix, self._pid, int(time.time() * 1000))
+            self._sequence = 0
+            per_process(self, self.close, self._owner)
+        self._sequence += 1
+        self._shard_path = os.path.join(self.directory, '%s-%04d.ndjson.gz' % (self._name, self._sequence))
+        # A process of a resumed run can start in the same millisecond, with the same pid, as one of the run it resumes
+        while os.path.exists(self._shard_path) or os.path.exists(self._shard_path + '.part'):
+            self._sequence += 1
+            self._shard_path = os.path.join(self.directory, '%s-%04d.ndjson.gz' % (self._name, self._sequence))
+        self._raw = open(self._shard_path + '.part', 'wb')
+        self._shard = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=self.compresslevel)
+
+    def write(self, values):
+        line = (json.dumps(values, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open_shard()
+            self._shard.write(line)
+            # Only counts what the compressor wrote out so far
+            if self._raw.tell() >= self.max_bytes:
+                self._close_shard()
+                self._open_shard()
+
+    def flush(self):
+        """Writes the lines written by this process so far to its shard"""
+        with self._lock:
+            if self._pid == os.getpid():
+                self._shard.flush()
+                self._raw.flush()
+
+    def _close_shard(self):
+        self._shard.close()
+        self._raw.close()
+        os.replace(self._shard_path + '.part', self._shard_path)
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._close_shard()
+                self._pid = None
+
+#---------------------------------------------------------
+# Complete a shard left by a killed process with the lines
+# it holds, a gzip stream cut short
+#---------------------------------------------------------
+def recover_shard(part_path):
+    with open(part_path, 'rb') as f:
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(f.read())
+    # The last line may be cut short too
+    data = data[:data.rfind(b'\n') + 1]
+    shard_path = part_path[:-len('.part')]
+    with gzip.open(shard_path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(shard_path + '.tmp', shard_path)
+    os.remove(part_path)
@@ -0,0 +1,57 @@
+import hashlib
+import os
+
+# Reasons a file is listed in the verify report
+MISSING = 'missing'
+TRUNCATED = 'truncated'
+CORRUPTED = 'corrupted'
+ORPHANED = 'orphaned'
+
+#---------------------------------------------------------
+# MD5 of an object, when its ETag is one
+#---------------------------------------------------------
+def single_part_md5(etag):
+    # The ETag of a multipart upload is not the MD5 of the object, it ends with -<parts>
+    etag = etag.strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag.lower()
+    return None
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # hashlib releases the GIL on large buffers, so threads hash in parallel
+            md5.update(chunk)
+    return md5.hexdigest()
+
+#---------------------------------------------------------
+# Checks a local file against the size of its object
+#---------------------------------------------------------
+def check_size(file_path, size, getsize=os.path.getsize):
+    try:
+        local_size = getsize(file_path)
+    except OSError:
+        return MISSING
+    if local_size < size:
+        return TRUNCATED
+    if local_size > size:
+        return CORRUPTED
+    return None
+
+def check_md5(file_path, md5, md5_of=file_md5):
+    try:
+        return None if md5_of(file_path) == md5 else CORRUPTED
+    except OSError:
+        return MISSING
+
+#---------------------------------------------------------
+# Keys of the local files under a prefix
+#---------------------------------------------------------
+def local_keys(directory, prefix):
+    for root, dirs, files in os.walk(os.path.join(directory, prefix)):
+        for name in files:
+            yield os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
@@ -0,0 +1,65 @@
+import io
+import os
+import socket
+import tarfile
+import pytest
+
+SUMMARIES_BUCKET = 'v3.0-summaries'
+ACTIVITIES_BUCKET_BASE = 'v3.0-activities'
+LAMBDA_BUCKET = 'orcid-lambda-file'
+
+def summary_body(orcid):
+    return ('<record:record xmlns:record="http://www.orcid.org/ns/record"><common:orcid-identifier xmlns:common="http://www.orcid.org/ns/common">'
+            '<common:path>%s</common:path></common:orcid-identifier></record:record>' % orcid).encode('utf-8')
+
+#---------------------------------------------------------
+# A local S3 stand-in with the summaries, activities and
+# lambda file of a few hundred records
+#---------------------------------------------------------
+@pytest.fixture(scope='session')
+def s3_endpoint():
+    """Endpoint URL of a moto server holding 240 records
+
+    Every record has a summary, two works and an employment, in the
+    buckets and under the keys of the public data files, and is listed in
+    the lambda file. The tests using it are skipped when moto is not
+    installed.
+
+    """
+    server = pytest.importorskip('moto.server')
+    boto3 = pytest.importorskip('boto3')
+    from public_data_sync import lambda_file
+    from public_data_sync import partitions
+    # The stand-in does not check credentials, but boto3 refuses to sign without them
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    moto_server = server.ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    moto_server.start()
+    endpoint_url = 'http://127.0.0.1:%d' % port
+    s3client = boto3.client('s3', endpoint_url=endpoint_url)
+    for bucket in [SUMMARIES_BUCKET, LAMBDA_BUCKET] + [ACTIVITIES_BUCKET_BASE + '-' + suffix for suffix in 'abc']:
+        s3client.create_bucket(Bucket=bucket)
+    lines = []
+    for i in range(240):
+        orcid = '0000-0002-%04d-%04d' % (i // 10, i * 7 % 10000)
+        checksum = orcid[-3:]
+        s3client.put_object(Bucket=SUMMARIES_BUCKET, Key=checksum + '/' + orcid + '.xml', Body=summary_body(orcid))
+        activities_bucket = ACTIVITIES_BUCKET_BASE + '-' + partitions.activities_bucket_suffix(orcid)
+        for activity_type, count in (('works', 2), ('employments', 1)):
+            for j in range(count):
+                key = '%s/%s/%s/%s_%s_%d.xml' % (checksum, orcid, activity_type, orcid, activity_type, j)
+                s3client.put_object(Bucket=activities_bucket, Key=key, Body=b'<activity>%d</activity>' % j)
+        lines.append('%s,x,x,2026-10-%02d 10:00:00.%06d' % (orcid, 17 - i // 30, 999999 - i))
+    data = ('orcid,created,claimed,last_modified\n' + '\n'.join(lines) + '\n').encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        member = tarfile.TarInfo(lambda_file.LAMBDA_FILE_MEMBER)
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    s3client.put_object(Bucket=LAMBDA_BUCKET, Key=lambda_file.LAMBDA_FILE_KEY, Body=buf.getvalue())
+    yield endpoint_url
+    moto_server.stop()
@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import tarfile
+from public_data_sync import archive
+from public_data_sync.archive import ArchiveWriter
+
+fork = multiprocessing.get_context('fork')
+
+def members(archive_path):
+    with tarfile.open(archive_path, 'r:gz') as tar:
+        return dict((member.name, tar.extractfile(member).read()) for member in tar)
+
+def run(target, *args):
+    process = fork.Process(target=target, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+def test_assemble_worker_shards(tmp_path):
+    parts_dir = str(tmp_path / 'archive.parts')
+    writer = ArchiveWriter(parts_dir, batch_size=100)
+    writer.add('main.xml', b'main')
+    run(add_files, writer, 'worker-a', 50, True)
+    run(add_files, writer, 'worker-b', 50, True)
+    assert writer.assemble(str(tmp_path / 'archive.tar.gz')) == 3
+    files = members(str(tmp_path / 'archive.tar.gz'))
+    assert len(files) == 101
+    assert files['worker-b/7.xml'] == b'worker-b 7' * 20
+    assert not os.path.exists(parts_dir)
+
+def add_files(writer, prefix, count, close, flushed=None):
+    for i in range(count):
+        writer.add('%s/%d.xml' % (prefix, i), b'%s %d' % (prefix.encode('utf-8'), i) * 20)
+        if flushed is not None and i < flushed:
+            writer.flush()
+    if close:
+        writer.close()
+    else:
+        # Killed, what is still buffered is lost
+        os._exit(0)
+
+def test_resume_the_shards_of_a_killed_run(tmp_path):
+    parts_dir = str(tmp_path / 'archive.parts')
+    writer = ArchiveWriter(parts_dir, batch_size=1024 * 1024)
+    # Every file flushed before the worker reports it is in the archive
+    run(add_files, writer, 'killed', 30, False, 20)
+    with open(os.path.join(parts_dir, os.listdir(parts_dir)[0]), 'ab') as f:
+        # A member cut short by the kill
+        f.write(b'\x1f\x8b\x08\x00 cut short')
+
+    writer = ArchiveWriter(parts_dir, resume=True, batch_size=100)
+    assert not writer.is_empty()
+    run(add_files, writer, 'resumed', 10, True)
+    writer.assemble(str(tmp_path / 'archive.tar.gz'))
+    files = members(str(tmp_path / 'archive.tar.gz'))
+    assert sorted(files) == sorted(['killed/%d.xml' % i for i in range(20)] + ['resumed/%d.xml' % i for i in range(10)])
+
+def test_shard_names_are_never_reused(tmp_path, monkeypatch):
+    # Every process of the runs starts in the same millisecond with the same pid
+    monkeypatch.setattr(archive.time, 'time', lambda: 1792338731.354)
+    parts_dir = str(tmp_path / 'archive.parts')
+    for run_number in range(3):
+        writer = ArchiveWriter(parts_dir, resume=True)
+        writer.add('run-%d.xml' % run_number, b'data')
+        writer.close()
+    assert len(os.listdir(parts_dir)) == 3
+    writer.assemble(str(tmp_path / 'archive.tar.gz'))
+    assert sorted(members(str(tmp_path / 'archive.tar.gz'))) == ['run-0.xml', 'run-1.xml', 'run-2.xml']
+
+def test_empty_archive(tmp_path):
+    parts_dir = str(tmp_path / 'archive.parts')
+    writer = ArchiveWriter(parts_dir)
+    assert writer.is_empty()
+    run(add_files, writer, 'killed', 5, False)
+    # Nothing was flushed by the killed worker
+    writer = ArchiveWriter(parts_dir, resume=True)
+    assert writer.is_empty()
+    writer.discard()
+    assert not os.path.exists(parts_dir)
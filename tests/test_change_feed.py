@@ -0,0 +1,44 @@
+import json
+import multiprocessing
+import os
+from datetime import datetime
+from public_data_sync import change_feed
+from public_data_sync.change_feed import ChangeFeed
+
+fork = multiprocessing.get_context('fork')
+
+def read_feed(fname):
+    with open(fname) as f:
+        return [json.loads(line) for line in f]
+
+def test_feed_is_part_until_closed(tmp_path):
+    fname = str(tmp_path / 'download-20261018000000.ndjson')
+    feed = ChangeFeed(fname)
+    feed.add('0000-0001-0000-0001', 'summaries/001/0000-0001-0000-0001.xml', change_feed.ADD, 42, '"etag"', datetime(2026, 10, 1, 12))
+    feed.add('0000-0001-0000-0001', 'activities/001/0000-0001-0000-0001/works/1.xml', change_feed.DELETE)
+    assert feed.count == 2
+    # A run killed now leaves a .part feed, never mistaken for a complete one
+    assert not os.path.exists(fname)
+    assert len(read_feed(fname + '.part')) == 2
+    feed.close()
+    assert not os.path.exists(fname + '.part')
+    assert read_feed(fname) == [
+        {'orcid': '0000-0001-0000-0001', 'path': 'summaries/001/0000-0001-0000-0001.xml', 'op': 'add', 'size': 42, 'etag': 'etag', 'last_modified': '2026-10-01 12:00:00'},
+        {'orcid': '0000-0001-0000-0001', 'path': 'activities/001/0000-0001-0000-0001/works/1.xml', 'op': 'delete', 'size': None, 'etag': None, 'last_modified': None},
+    ]
+
+def add_changes(feed, worker):
+    for i in range(300):
+        feed.add('0000-0001-0000-%04d' % worker, 'activities/%d/%d.xml' % (worker, i), change_feed.UPDATE, i)
+
+def test_workers_add_to_the_same_feed(tmp_path):
+    fname = str(tmp_path / 'sync-20261018000000.ndjson')
+    feed = ChangeFeed(fname, sync_every=10)
+    workers = [fork.Process(target=add_changes, args=(feed, worker)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+    feed.close()
+    assert sorted(line['path'] for line in read_feed(fname)) == sorted('activities/%d/%d.xml' % (worker, i) for worker in range(4) for i in range(300))
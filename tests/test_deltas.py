@@ -0,0 +1,99 @@
+import json
+import os
+import tarfile
+from datetime import datetime
+import pytest
+from public_data_sync import change_feed
+from public_data_sync import deltas
+from public_data_sync.archive import ArchiveWriter
+
+def write_delta(path, files, deletions, started, modified_after, next_sync):
+    # Written like sync.py does, every batch of files is flushed to a member of its own
+    writer = ArchiveWriter(path + '.parts')
+    for batch in files:
+        for name, data in batch:
+            writer.add(name, data)
+        writer.flush()
+    writer.add(deltas.DELETIONS_MEMBER, ''.join(name + '\n' for name in deletions).encode('utf-8'))
+    writer.add(deltas.METADATA_MEMBER, json.dumps(deltas.metadata(started, modified_after, next_sync, len(files), len(deletions))).encode('utf-8'))
+    writer.assemble(path)
+    return path
+
+@pytest.fixture
+def chain(tmp_path):
+    first = write_delta(str(tmp_path / 'first.tar.gz'),
+                        [[('summaries/000/a.xml', b'a1'), ('activities/000/a/works/1.xml', b'w1')]],
+                        ['activities/000/a/works/old.xml'],
+                        datetime(2026, 10, 2), datetime(2026, 10, 1), datetime(2026, 10, 2))
+    # Resumed after a killed run, b.xml is there twice and the last copy is the newest
+    second = write_delta(str(tmp_path / 'second.tar.gz'),
+                         [[('summaries/000/b.xml', b'b1')], [('summaries/000/b.xml', b'b2'), ('summaries/000/a.xml', b'a2')]],
+                         ['activities/000/a/works/1.xml'],
+                         datetime(2026, 10, 3), datetime(2026, 10, 2), datetime(2026, 10, 3))
+    return first, second
+
+def tree_files(tree):
+    files = {}
+    for directory, _, names in os.walk(tree):
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[os.path.relpath(os.path.join(directory, name), tree)] = f.read()
+    return files
+
+def test_read_delta(chain):
+    delta = deltas.read_delta(chain[0])
+    assert delta.files == set(['summaries/000/a.xml', 'activities/000/a/works/1.xml'])
+    assert delta.deletions == ['activities/000/a/works/old.xml']
+    assert delta.metadata['modified_after'] == '2026-10-01 00:00:00'
+
+def test_read_chain_orders_by_start(chain):
+    assert [delta.path for delta in deltas.read_chain([chain[1], chain[0]])] == list(chain)
+
+def test_read_chain_rejects_gap(chain, tmp_path):
+    gap = write_delta(str(tmp_path / 'gap.tar.gz'), [], [], datetime(2026, 10, 6), datetime(2026, 10, 5), datetime(2026, 10, 6))
+    with pytest.raises(ValueError):
+        deltas.read_chain(list(chain) + [gap])
+
+def test_apply_to_tree(chain, tmp_path):
+    tree = str(tmp_path / 'ORCID_public_data_files')
+    os.makedirs(os.path.join(tree, 'activities/000/a/works'))
+    with open(os.path.join(tree, 'activities/000/a/works/old.xml'), 'wb') as f:
+        f.write(b'old')
+    deltas.apply_to_tree(tree + '/', list(chain))
+    assert tree_files(tree) == {
+        'summaries/000/a.xml': b'a2',
+        'summaries/000/b.xml': b'b2',
+    }
+
+def test_apply_to_archive(chain, tmp_path):
+    base = str(tmp_path / 'base.tar.gz')
+    writer = ArchiveWriter(base + '.parts')
+    writer.add('summaries/000/a.xml', b'a0')
+    writer.add('summaries/000/c.xml', b'c0')
+    writer.assemble(base)
+    output = str(tmp_path / 'output.tar.gz')
+    assert deltas.apply_to_archive(base, output, list(chain), 1) == 3
+    with tarfile.open(output, 'r:gz') as tar:
+        files = dict((member.name, tar.extractfile(member).read()) for member in tar if member.isfile())
+    # The activities are in another dump, only the summaries are added
+    assert files == {
+        'summaries/000/a.xml': b'a2',
+        'summaries/000/b.xml': b'b2',
+        'summaries/000/c.xml': b'c0',
+    }
+
+def test_read_changes(tmp_path):
+    killed = str(tmp_path / 'sync-1.ndjson')
+    feed = change_feed.ChangeFeed(killed)
+    feed.add('a', 'summaries/000/a.xml', change_feed.ADD)
+    feed.add('a', 'activities/000/a/works/1.xml', change_feed.DELETE)
+    feed.add('a', 'activities/000/a/works/2.xml', change_feed.ADD)
+    # Killed while writing a line, its feed is still named .part
+    with open(killed + '.part', 'a') as f:
+        f.write('{"orcid":"a","path":"activities/000/a/works/3.xml","op":"del')
+    finished = str(tmp_path / 'sync-2.ndjson')
+    feed = change_feed.ChangeFeed(finished)
+    feed.add('a', 'activities/000/a/works/1.xml', change_feed.ADD)
+    feed.add('a', 'activities/000/a/works/2.xml', change_feed.DELETE)
+    feed.close()
+    assert deltas.read_changes([killed, finished]) == (2, ['activities/000/a/works/2.xml'])
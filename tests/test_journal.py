@@ -0,0 +1,61 @@
+import os
+from public_data_sync.journal import ProgressJournal
+
+def test_resume_from_the_last_token(tmp_path):
+    fname = str(tmp_path / 'journal')
+    journal = ProgressJournal(fname)
+    journal.start()
+    journal.key_done('summaries-0', 'a')
+    journal.key_done('summaries-0', 'b')
+    journal.checkpoint('summaries-0', 'token-1', 'b')
+    journal.key_done('summaries-0', 'd')
+    journal.key_done('summaries-1', 'x')
+    journal.checkpoint('summaries-1', None, 'x')
+    # Killed without closing, every record was handed to the OS already
+    journal = ProgressJournal(fname)
+    journal.resume()
+    assert journal.continuation_token('summaries-0') == 'token-1'
+    # The keys up to the token are forgotten
+    assert journal.completed_keys('summaries-0') == set(['d'])
+    assert not journal.is_done('summaries-0')
+    assert journal.is_done('summaries-1')
+    assert journal.continuation_token('summaries-1') is None
+    assert journal.completed_keys('summaries-1') == set()
+    assert journal.completed_keys('activities-0') == set()
+    journal.close()
+
+def test_cut_short_record_is_ignored(tmp_path):
+    fname = str(tmp_path / 'journal')
+    journal = ProgressJournal(fname)
+    journal.start()
+    journal.key_done('summaries-0', 'a')
+    journal.close()
+    with open(fname, 'a') as f:
+        f.write('K\tsummaries-0\tb')
+    journal = ProgressJournal(fname)
+    journal.resume()
+    assert journal.completed_keys('summaries-0') == set(['a'])
+    journal.key_done('summaries-0', 'c')
+    journal.close()
+    journal = ProgressJournal(fname)
+    journal.resume()
+    assert journal.completed_keys('summaries-0') == set(['a', 'c'])
+    journal.close()
+
+def test_compaction(tmp_path):
+    fname = str(tmp_path / 'journal')
+    journal = ProgressJournal(fname, sync_every=10, compact_size=4096)
+    journal.start()
+    for page in range(100):
+        for i in range(10):
+            journal.key_done('activities-0', '%04d-%d' % (page, i))
+        journal.checkpoint('activities-0', 'token-%d' % page, '%04d-9' % page)
+    journal.key_done('activities-0', 'zzzz')
+    journal.close()
+    # Only what is needed to resume is left
+    assert os.path.getsize(fname) < 4096 + 200
+    journal = ProgressJournal(fname)
+    journal.resume()
+    assert journal.continuation_token('activities-0') == 'token-99'
+    assert journal.completed_keys('activities-0') == set(['zzzz'])
+    journal.close()
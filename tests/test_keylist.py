@@ -0,0 +1,44 @@
+import multiprocessing
+from datetime import datetime
+from public_data_sync.keylist import KeyEntry
+from public_data_sync.keylist import KeyList
+from public_data_sync.keylist import read_key_list
+
+fork = multiprocessing.get_context('fork')
+
+def test_write_and_read_back(tmp_path):
+    fname = str(tmp_path / 'dead_letter.tsv')
+    keys = KeyList(fname)
+    keys.add('summaries', '001/0000-0001-0000-0001.xml', 'ClientError (404)')
+    element = {'ETag': '"etag"', 'Size': 42, 'LastModified': datetime(2026, 10, 1, 12)}
+    keys.add('activities-a', '001/0000-0001-0000-0001/works/1.xml', 'ConnectionClosedError\twith a\nmessage', element)
+    assert keys.count == 2
+    keys.close()
+    assert list(read_key_list(fname)) == [
+        KeyEntry('summaries', '001/0000-0001-0000-0001.xml', 'ClientError (404)', None, None, None),
+        # An error message can not break the format
+        KeyEntry('activities-a', '001/0000-0001-0000-0001/works/1.xml', 'ConnectionClosedError with a message', '"etag"', 42, '2026-10-01 12:00:00'),
+    ]
+
+def test_cut_short_lines_are_ignored(tmp_path):
+    fname = str(tmp_path / 'dead_letter.tsv')
+    with open(fname, 'w') as f:
+        f.write('summaries\t001/a.xml\tmissing\n\nsummaries\t001\nsummaries\t001/b.xml\tmiss')
+    assert [entry.key for entry in read_key_list(fname)] == ['001/a.xml']
+
+def add_keys(keys, worker):
+    for i in range(500):
+        keys.add('bucket', '%d/%d' % (worker, i), 'failed')
+    keys.close()
+
+def test_processes_append_whole_lines(tmp_path):
+    fname = str(tmp_path / 'dead_letter.tsv')
+    keys = KeyList(fname, sync_every=7)
+    workers = [fork.Process(target=add_keys, args=(keys, worker)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+    keys.close()
+    assert sorted(entry.key for entry in read_key_list(fname)) == sorted('%d/%d' % (worker, i) for worker in range(4) for i in range(500))
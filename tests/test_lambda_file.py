@@ -0,0 +1,59 @@
+import io
+import tarfile
+from datetime import datetime
+from public_data_sync import lambda_file
+
+class Body(object):
+    # A streaming body, which can not seek, like the one botocore returns
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.closed = False
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.closed = True
+
+class S3Client(object):
+    def __init__(self, data):
+        self.body = Body(data)
+
+    def get_object(self, Bucket, Key):
+        assert Key == lambda_file.LAMBDA_FILE_KEY
+        return {'Body': self.body}
+
+def lambda_tar(lines, mode='w:gz'):
+    data = '\n'.join(['orcid,created,claimed,last_modified'] + lines).encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        member = tarfile.TarInfo('output/' + lambda_file.LAMBDA_FILE_MEMBER)
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    return buf.getvalue()
+
+def test_parse_last_modified():
+    assert lambda_file.parse_last_modified('2026-10-01 12:30:05.123456') == datetime(2026, 10, 1, 12, 30, 5, 123456)
+    assert lambda_file.parse_last_modified('2026-10-01 12:30:05') == datetime(2026, 10, 1, 12, 30, 5)
+
+def test_iter_lines_across_chunks():
+    lines = ['line %d' % i for i in range(100)]
+    assert list(lambda_file.iter_lines(io.BytesIO('\n'.join(lines).encode('utf-8')), chunk_size=7)) == lines
+    assert list(lambda_file.iter_lines(io.BytesIO(b'a\r\nb\n'), chunk_size=1)) == ['a\r', 'b']
+
+def test_stop_at_the_last_sync_cutoff():
+    newer = ['0000-0001-0000-%04d,x,x,2026-10-%02d 10:00:00.000' % (day, day) for day in range(20, 10, -1)]
+    older = ['0000-0002-0000-%04d,x,x,2026-09-01 10:00:00.000' % i for i in range(100000)]
+    s3client = S3Client(lambda_tar(newer + older, mode='w'))
+    records = list(lambda_file.iter_modified_records(s3client, 'bucket', datetime(2026, 10, 15)))
+    assert records == [('0000-0001-0000-%04d' % day, datetime(2026, 10, day, 10)) for day in range(20, 14, -1)]
+    # Only the head of the file is read and the download is abandoned
+    assert s3client.body.stream.tell() < len(s3client.body.stream.getvalue()) / 2
+    assert s3client.body.closed
+
+def test_compressed_file_with_windows_line_ends():
+    lines = ['0000-0001-0000-0001,x,x,2026-10-02 10:00:00\r', '0000-0001-0000-0002,x,x,2026-10-01 10:00:00.5\r']
+    s3client = S3Client(lambda_tar(lines))
+    records = list(lambda_file.iter_modified_records(s3client, 'bucket', datetime(2026, 9, 1)))
+    assert records == [('0000-0001-0000-0001', datetime(2026, 10, 2, 10)), ('0000-0001-0000-0002', datetime(2026, 10, 1, 10, 0, 0, 500000))]
+    assert s3client.body.closed
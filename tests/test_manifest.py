@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+from public_data_sync.manifest import Manifest
+
+fork = multiprocessing.get_context('fork')
+
+def local_file(tmp_path, data):
+    path = str(tmp_path / 'file.xml')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def test_skip_only_unchanged_objects(tmp_path):
+    path = local_file(tmp_path, b'12345')
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    assert not manifest.is_current('bucket', '000/key', '"etag"', 5, path)
+    manifest.record('bucket', '000/key', '"etag"', 5, '2026-10-01 00:00:00')
+    manifest.commit()
+    assert manifest.is_current('bucket', '000/key', '"etag"', 5, path)
+    # A new version in S3, or a local copy that is missing or cut short, is downloaded again
+    assert not manifest.is_current('bucket', '000/key', '"other"', 5, path)
+    assert not manifest.is_current('bucket', '000/key', '"etag"', 6, path)
+    assert not manifest.is_current('other-bucket', '000/key', '"etag"', 5, path)
+    local_file(tmp_path, b'123')
+    assert not manifest.is_current('bucket', '000/key', '"etag"', 5, path)
+    os.remove(path)
+    assert not manifest.is_current('bucket', '000/key', '"etag"', 5, path)
+    # The size is looked up where the file is kept, like a packed store
+    assert manifest.is_current('bucket', '000/key', '"etag"', 5, '000/key', lambda key: 5)
+    manifest.forget('bucket', '000/key')
+    manifest.commit()
+    assert not manifest.contains('bucket', '000/key')
+    manifest.close()
+
+def test_changes_are_seen_once_committed(tmp_path):
+    fname = str(tmp_path / 'manifest.db')
+    writer = Manifest(fname, batch_size=1000, flush_interval=3600)
+    reader = Manifest(fname)
+    writer.record('bucket', '000/key', '"etag"', 5, None)
+    assert writer.contains('bucket', '000/key') is False
+    writer.commit()
+    assert reader.contains('bucket', '000/key')
+    writer.close()
+    reader.close()
+
+def record_keys(manifest, worker):
+    for i in range(100):
+        manifest.record('bucket', '%03d/%d-%d' % (i % 3, worker, i), '"etag"', i, None)
+    manifest.close()
+
+def test_forked_writers(tmp_path):
+    manifest = Manifest(str(tmp_path / 'manifest.db'), flush_interval=3600)
+    # Buffered by the parent when the workers are forked, only the parent writes it
+    manifest.record('bucket', '000/parent', '"etag"', 1, None)
+    workers = [fork.Process(target=record_keys, args=(manifest, worker)) for worker in range(3)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+    manifest.commit()
+    assert manifest.count_prefix('bucket', '000/') == 3 * 34 + 1
+    assert manifest.count_prefix('bucket', '001/') == 3 * 33
+    manifest.close()
+
+def test_listed_prefixes(tmp_path):
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    assert not manifest.is_listed('bucket', '000/')
+    manifest.record_listing('bucket', '000/', True)
+    manifest.commit()
+    assert manifest.is_listed('bucket', '000/')
+    # A listing that left files behind undoes it
+    manifest.record_listing('bucket', '000/', False)
+    manifest.commit()
+    assert not manifest.is_listed('bucket', '000/')
+    manifest.close()
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import sqlite3
+from public_data_sync import packed_store
+from public_data_sync.packed_store import PackedStore
+
+# The store is shared with workers forked from the process that opened it
+fork = multiprocessing.get_context('fork')
+
+def segments(directory):
+    with sqlite3.connect(os.path.join(directory, 'index.db')) as conn:
+        return conn.execute('SELECT id, bytes, dead, sealed FROM segments ORDER BY id').fetchall()
+
+def run(target, *args):
+    process = fork.Process(target=target, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+def test_put_get_delete(tmp_path):
+    store = PackedStore(str(tmp_path))
+    store.put('000/0000-0001-0000-0000/works/a.xml', b'first')
+    store.put('000/0000-0001-0000-0000/works/b.xml', b'second')
+    store.put('000/0000-0001-0000-0000/works/a.xml', b'replaced')
+    store.delete('000/0000-0001-0000-0000/works/b.xml')
+    store.close()
+
+    store = PackedStore(str(tmp_path))
+    assert store.get('000/0000-0001-0000-0000/works/a.xml') == b'replaced'
+    assert store.get('000/0000-0001-0000-0000/works/b.xml') is None
+    assert store.getsize('000/0000-0001-0000-0000/works/a.xml') == len(b'replaced')
+    assert store.keys('000/') == ['000/0000-0001-0000-0000/works/a.xml']
+    assert store.record('0000-0001-0000-0000') == {'000/0000-0001-0000-0000/works/a.xml': b'replaced'}
+    store.close()
+
+def write_and_die(directory):
+    store = PackedStore(directory)
+    for i in range(100):
+        store.put('committed/%03d' % i, b'data %d' % i)
+    store.commit()
+    for i in range(50):
+        store.put('pending/%03d' % i, b'data %d' % i)
+    # Killed, neither the pending records nor the index changes are written
+    os._exit(0)
+
+def test_killed_writer(tmp_path):
+    directory = str(tmp_path)
+    PackedStore(directory).close()
+    run(write_and_die, directory)
+    assert [sealed for segment, size, dead, sealed in segments(directory)] == [0]
+
+    store = PackedStore(directory)
+    # The segment the killed process left open is sealed, the committed records are all there
+    assert [sealed for segment, size, dead, sealed in segments(directory)] == [1]
+    assert len(store.keys('committed/')) == 100
+    assert store.get('committed/042') == b'data 42'
+    assert store.keys('pending/') == []
+    store.close()
+
+def test_segment_cut_short(tmp_path):
+    store = PackedStore(str(tmp_path))
+    for i in range(10):
+        store.put('key/%d' % i, b'x' * 100)
+    store.close()
+    segment_path = store.segment_path(segments(str(tmp_path))[0][0])
+    with open(segment_path, 'r+b') as f:
+        f.truncate(os.path.getsize(segment_path) - 10)
+    # Reading stops at the record cut short, the ones before it are intact
+    assert [key for kind, key, data, offset in packed_store.read_records(segment_path)] == ['key/%d' % i for i in range(9)]
+
+    store = PackedStore(str(tmp_path))
+    assert store.get('key/8') == b'x' * 100
+    try:
+        store.get('key/9')
+        assert False, 'get should fail on a record cut short'
+    except IOError:
+        pass
+    store.close()
+
+def test_missing_segment(tmp_path):
+    store = PackedStore(str(tmp_path))
+    store.put('key', b'data')
+    store.close()
+    os.remove(store.segment_path(segments(str(tmp_path))[0][0]))
+
+    store = PackedStore(str(tmp_path))
+    try:
+        store.get('key')
+        assert False, 'get should fail when the segment is gone'
+    except IOError:
+        pass
+    store.close()
+
+def test_compaction(tmp_path):
+    store = PackedStore(str(tmp_path))
+    for i in range(100):
+        store.put('key/%03d' % i, b'old %d' % i)
+    store.close()
+    store = PackedStore(str(tmp_path))
+    for i in range(80):
+        store.put('key/%03d' % i, b'new %d' % i)
+    for i in range(80, 90):
+        store.delete('key/%03d' % i)
+    store.close()
+    before = segments(str(tmp_path))
+    assert before[0][2] >= before[0][1] * store.compact_threshold
+
+    store = PackedStore(str(tmp_path))
+    assert store.compact() >= 1
+    store.close()
+    # The mostly dead segment is gone and every key still reads its last version
+    assert not os.path.exists(store.segment_path(before[0][0]))
+    store = PackedStore(str(tmp_path))
+    assert len(store.keys()) == 90
+    for i in range(80):
+        assert store.get('key/%03d' % i) == b'new %d' % i
+    for i in range(80, 90):
+        assert store.get('key/%03d' % i) is None
+    for i in range(90, 100):
+        assert store.get('key/%03d' % i) == b'old %d' % i
+    store.close()
+
+def write_worker(store, worker):
+    for i in range(200):
+        store.put('worker-%d/%03d' % (worker, i), b'%d-%d' % (worker, i) * 50)
+    store.put('shared', b'from %d' % worker)
+    store.close()
+
+def test_concurrent_writers(tmp_path):
+    store = PackedStore(str(tmp_path))
+    # Buffered by the parent when the workers are forked, only the parent writes it
+    store.put('parent', b'parent data')
+    workers = [fork.Process(target=write_worker, args=(store, worker)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+    store.close()
+
+    store = PackedStore(str(tmp_path))
+    for worker in range(4):
+        for i in range(200):
+            assert store.get('worker-%d/%03d' % (worker, i)) == b'%d-%d' % (worker, i) * 50
+    assert store.get('shared') in [b'from %d' % worker for worker in range(4)]
+    assert store.get('parent') == b'parent data'
+    written = [key for segment, size, dead, sealed in segments(str(tmp_path)) for kind, key, data, offset in packed_store.read_records(store.segment_path(segment))]
+    assert written.count('parent') == 1
+    store.close()
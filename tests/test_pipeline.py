@@ -0,0 +1,46 @@
+import logging
+import threading
+from public_data_sync.pipeline import OrderedCheckpoint, WorkerPipeline
+
+def test_checkpoint_waits_for_earlier_pages():
+    advanced = []
+    checkpoint = OrderedCheckpoint(advanced.append)
+    first = checkpoint.add_page(2, 'token-1')
+    second = checkpoint.add_page(1, 'token-2')
+    # The second page finishes first, its checkpoint waits for the first one
+    checkpoint.done(second)
+    checkpoint.done(first)
+    assert advanced == []
+    checkpoint.done(first)
+    # Both pages are done, only the latest checkpoint is written
+    assert advanced == ['token-2']
+    # A page without any item is done as soon as it is added
+    checkpoint.add_page(0, 'token-3')
+    assert advanced == ['token-2', 'token-3']
+
+def square(item):
+    if item == 13:
+        raise ValueError('unlucky')
+    return item * item
+
+def test_worker_pipeline():
+    results = {}
+    advanced = []
+    lock = threading.Lock()
+    def callback(item, result):
+        with lock:
+            results[item] = result
+    checkpoint = OrderedCheckpoint(advanced.append)
+    pipeline = WorkerPipeline(logging.getLogger('test'), square, 2, 4)
+    for page_number in range(5):
+        items = list(range(page_number * 10, page_number * 10 + 10))
+        page = checkpoint.add_page(len(items), page_number)
+        for item in items:
+            pipeline.submit(item, page, checkpoint, callback)
+    pipeline.close()
+    assert advanced[-1] == 4
+    assert advanced == sorted(advanced)
+    assert dict((item, result) for item, result in results.items() if item != 13) == dict((item, item * item) for item in range(50) if item != 13)
+    # A worker error is reported as a failed transfer, the item is not lost
+    assert not results[13].downloaded
+    assert 'unlucky' in results[13].error
@@ -0,0 +1,71 @@
+from datetime import datetime
+from public_data_sync import planner
+
+def bucket_name(orcid):
+    return 'activities-' + orcid[-1]
+
+def orcids(checksum, count):
+    return ['0000-0001-%04d-%s' % (i, checksum) for i in range(count)]
+
+def test_list_prefix_when_cheaper():
+    sizes = {'001': 5000, '002': 5000}
+    plan = planner.plan_activity_listing(orcids('001', 10) + orcids('002', 3), bucket_name, lambda bucket, checksum: sizes[checksum], 1000)
+    # 5 pages for the 10 records of 001, 3 single record listings for 002
+    assert plan.tasks[0] == planner.ListingTask('activities-1', '001/', frozenset(orcids('001', 10)))
+    assert [task.prefix for task in plan.tasks[1:]] == ['002/' + orcid + '/' for orcid in orcids('002', 3)]
+    assert plan.prefix_tasks == 1
+    assert plan.naive_requests == 13
+    assert plan.planned_requests == 8
+    assert plan.saved_requests == 5
+
+def test_empty_prefix_costs_one_request():
+    plan = planner.plan_activity_listing(orcids('001', 2), bucket_name, lambda bucket, checksum: 0, 1000)
+    assert plan.prefix_tasks == 1
+    assert plan.planned_requests == 1
+
+def test_group_by_bucket():
+    calls = []
+    def estimate(bucket, checksum):
+        calls.append((bucket, checksum))
+        return 0
+    records = ['0000-0001-0000-0001', '0000-0001-0001-0001', '0000-0001-0000-0002']
+    plan = planner.plan_activity_listing(records, bucket_name, estimate, 1000)
+    assert sorted(calls) == [('activities-1', '001'), ('activities-2', '002')]
+    assert len(plan.tasks) == 2
+
+def test_record_batch():
+    old, new = datetime(2026, 10, 1), datetime(2026, 10, 2)
+    both = orcids('001', 10)
+    only_summaries = orcids('002', 250)
+    records = [(orcid, old, ['summaries', 'activities']) for orcid in both]
+    records += [(orcid, new, ['summaries']) for orcid in only_summaries]
+    # A record listed twice is synced once, as of its latest date
+    records.append((both[0], new, ['summaries', 'activities']))
+    plan, tasks = planner.plan_record_batch(records, bucket_name, lambda bucket, checksum: 0, 1000, summaries_per_task=100)
+    assert plan.prefix_tasks == 1
+    # The summaries of the listed records are downloaded by the listing task
+    assert tasks[0].listing.prefix == '001/'
+    assert tasks[0].summaries == sorted(both)
+    assert tasks[0].last_modified[both[0]] == new
+    assert tasks[0].last_modified[both[1]] == old
+    assert [task.listing for task in tasks[1:]] == [None] * 3
+    assert [len(task.summaries) for task in tasks[1:]] == [100, 100, 50]
+    assert sorted(orcid for task in tasks[1:] for orcid in task.summaries) == sorted(only_summaries)
+
+def test_trust_manifest_count_of_prefixes_listed_whole(tmp_path):
+    from types import SimpleNamespace
+    from public_data_sync.manifest import Manifest
+    from public_data_sync.syncer import SyncPlan
+    fname = str(tmp_path / 'manifest.db')
+    manifest = Manifest(fname)
+    for i in range(10):
+        manifest.record('bucket', '001/0000-0001-0000-0001/works/%d.xml' % i, '"etag"', 1, None)
+        manifest.record('bucket', '002/0000-0001-0000-0002/works/%d.xml' % i, '"etag"', 1, None)
+    manifest.record_listing('bucket', '001/', True)
+    manifest.close()
+    config = SimpleNamespace(manifest=fname, prefix_size=5000)
+    plan = SyncPlan(config, datetime(2026, 10, 2), datetime(2026, 10, 1))
+    assert plan.estimate_prefix_objects('bucket', '001') == 10
+    # Only some of the activities under 002 were downloaded, one record at a time
+    assert plan.estimate_prefix_objects('bucket', '002') == 5000
+    plan.close()
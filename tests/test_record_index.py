@@ -0,0 +1,37 @@
+from datetime import datetime
+from public_data_sync.record_index import RecordIndex
+
+def test_records_are_current_up_to_their_synced_date(tmp_path):
+    index = RecordIndex(str(tmp_path / 'index.db'))
+    orcid = '0000-0001-0000-0001'
+    assert not index.is_current('summaries', orcid, datetime(2026, 10, 1))
+    index.record('summaries', orcid, datetime(2026, 10, 2, 10, 0, 0, 5))
+    index.commit()
+    assert index.is_current('summaries', orcid, datetime(2026, 10, 1))
+    assert index.is_current('summaries', orcid, datetime(2026, 10, 2, 10, 0, 0, 5))
+    assert not index.is_current('summaries', orcid, datetime(2026, 10, 2, 10, 0, 0, 6))
+    # Each stream is synced on its own
+    assert not index.is_current('activities', orcid, datetime(2026, 10, 1))
+    index.close()
+
+def test_older_date_never_replaces_a_newer_one(tmp_path):
+    fname = str(tmp_path / 'index.db')
+    index = RecordIndex(fname)
+    orcid = '0000-0001-0000-0001'
+    index.record('activities', orcid, datetime(2026, 10, 2))
+    index.record('activities', orcid, datetime(2026, 10, 1))
+    index.record('summaries', orcid, datetime(2026, 9, 1))
+    index.close()
+    index = RecordIndex(fname)
+    assert index.applied('activities', orcid) == '2026-10-02 00:00:00.000000'
+    assert index.applied('summaries', orcid) == '2026-09-01 00:00:00.000000'
+    index.close()
+
+def test_unknown_stream(tmp_path):
+    index = RecordIndex(str(tmp_path / 'index.db'))
+    try:
+        index.record('works', '0000-0001-0000-0001', datetime(2026, 10, 1))
+        assert False, 'record should refuse an unknown stream'
+    except ValueError:
+        pass
+    index.close()
@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import time
+from public_data_sync import deltas
+from .conftest import ACTIVITIES_BUCKET_BASE
+from .conftest import SUMMARIES_BUCKET
+from .conftest import summary_body
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start_download(endpoint_url, work_dir, *args):
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, 'download.py'), '-p', work_dir, '--endpoint-url', endpoint_url, '-x', SUMMARIES_BUCKET, '-s', '-max', '2', '-n', '10'] + list(args)
+    # A session of its own, so the workers are killed along with it
+    return subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def journaled_keys(work_dir):
+    fname = os.path.join(work_dir, 'summary.journal')
+    if not os.path.exists(fname):
+        return 0
+    with open(fname) as f:
+        return sum(1 for line in f if line.startswith('K\t'))
+
+def kill_midway(process, work_dir, keys=60, count=journaled_keys):
+    while process.poll() is None:
+        if count(work_dir) >= keys:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            return
+        time.sleep(0.02)
+    raise AssertionError('The download ended before it could be killed')
+
+def start_sync(endpoint_url, work_dir, *args):
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, 'sync.py'), '-p', work_dir, '--endpoint-url', endpoint_url, '-x', SUMMARIES_BUCKET, '-y', ACTIVITIES_BUCKET_BASE, '-s', '-a', '-max', '2'] + list(args)
+    return subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def indexed_records(work_dir):
+    fname = os.path.join(work_dir, 'sync_index.db')
+    if not os.path.exists(fname):
+        return 0
+    try:
+        with sqlite3.connect(fname) as conn:
+            return conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+    except sqlite3.OperationalError:
+        # Not created yet, or locked by the run
+        return 0
+
+def summaries_dump(work_dir):
+    names = [name for name in os.listdir(work_dir) if name.startswith('ORCID-API-3.0_xml_') and name.endswith('.tar.gz')]
+    assert len(names) == 1
+    return os.path.join(work_dir, names[0])
+
+def test_killed_archive_download_resumes(s3_endpoint, tmp_path):
+    work_dir = str(tmp_path)
+    kill_midway(start_download(s3_endpoint, work_dir, '-t'), work_dir)
+    assert start_download(s3_endpoint, work_dir, '-t', '-r').wait() == 0
+
+    # Every summary is in the archive, a file flushed by a worker the moment it was killed can be there twice
+    dump = summaries_dump(work_dir)
+    with tarfile.open(dump, 'r:gz') as tar:
+        files = dict((member.name, tar.extractfile(member).read()) for member in tar)
+    assert len(files) == 240
+    for name, data in files.items():
+        assert data == summary_body(name.split('/')[-1][:-4])
+
+    # Resuming the run once it is done keeps its archive
+    with open(dump, 'rb') as f:
+        before = f.read()
+    assert start_download(s3_endpoint, work_dir, '-t', '-r').wait() == 0
+    with open(summaries_dump(work_dir), 'rb') as f:
+        assert f.read() == before
+
+def test_killed_transform_resumes(s3_endpoint, tmp_path):
+    work_dir = str(tmp_path)
+    transform_dir = os.path.join(work_dir, 'ndjson')
+    kill_midway(start_download(s3_endpoint, work_dir, '--transform', transform_dir), work_dir)
+    assert start_download(s3_endpoint, work_dir, '--transform', transform_dir, '-r').wait() == 0
+
+    directory = os.path.join(transform_dir, 'summaries')
+    assert not [name for name in os.listdir(directory) if name.endswith('.part')]
+    keys = set()
+    for name in os.listdir(directory):
+        with gzip.open(os.path.join(directory, name)) as f:
+            keys.update(json.loads(line)['key'] for line in f)
+    assert len(keys) == 240
+
+def test_killed_sync_delta_resumes(s3_endpoint, tmp_path):
+    work_dir = str(tmp_path)
+    # Killed once the index says some records are synced, the next run skips them
+    kill_midway(start_sync(s3_endpoint, work_dir, '-t', '-d', '3650'), work_dir, 1, indexed_records)
+    # Syncing the records modified after another date still carries on with the files of the killed run
+    assert start_sync(s3_endpoint, work_dir, '-t', '-d', '3000').wait() == 0
+
+    assert not [name for name in os.listdir(work_dir) if name.startswith(deltas.WORKSPACE + '.')]
+    names = [name for name in os.listdir(work_dir) if name.startswith('ORCID-API-3.0_delta_') and name.endswith('.tar.gz')]
+    assert len(names) == 1
+    delta = deltas.read_delta(os.path.join(work_dir, names[0]))
+    # Every record has a summary, two works and an employment
+    assert len(delta.files) == 4 * 240
+    assert delta.metadata['files'] == 4 * 240
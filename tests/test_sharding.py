@@ -0,0 +1,36 @@
+import argparse
+import pytest
+from public_data_sync import partitions
+from public_data_sync import sharding
+
+@pytest.mark.parametrize('shards', [1, 3, 8, 7, 1100])
+def test_slices_cover_every_checksum_once(shards):
+    slices = [partitions.shard_checksums(shard, shards) for shard in range(1, shards + 1)]
+    assert all(slices)
+    # Contiguous slices of about the same size, in order
+    assert sum(slices, []) == partitions.CHECKSUMS
+    assert max(len(checksums) for checksums in slices) - min(len(checksums) for checksums in slices) <= 1
+
+def test_parse_shard():
+    assert sharding.parse_shard('2/8') == (2, 8)
+    assert sharding.parse_shard('1100/1100') == (1100, 1100)
+
+@pytest.mark.parametrize('value', ['0/8', '9/8', '1/0', '1/1101', '2', 'a/b', '1/2/3'])
+def test_parse_shard_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        sharding.parse_shard(value)
+
+def test_markers(tmp_path):
+    directory = str(tmp_path)
+    assert sharding.read_marker(directory, 'activities', 2, 8) is None
+    sharding.write_marker(directory, 'activities', 2, 8, '2026-10-01 00:00:00', 3)
+    marker = sharding.read_marker(directory, 'activities', 2, 8)
+    checksums = partitions.shard_checksums(2, 8)
+    assert marker['stream'] == 'activities'
+    assert (marker['shard'], marker['shards']) == (2, 8)
+    assert (marker['first_checksum'], marker['last_checksum']) == (checksums[0], checksums[-1])
+    assert marker['started'] == '2026-10-01 00:00:00'
+    assert marker['failed'] == 3
+    # Every stream and shard has its own marker
+    assert sharding.read_marker(directory, 'summaries', 2, 8) is None
+    assert sharding.read_marker(directory, 'activities', 3, 8) is None
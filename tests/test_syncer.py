@@ -0,0 +1,92 @@
+import io
+import tarfile
+import threading
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+from public_data_sync import lambda_file
+from public_data_sync.keylist import KeyEntry
+from public_data_sync.syncer import SyncPlan
+from public_data_sync.syncer import next_sync_date
+
+start_time = datetime(2026, 10, 10)
+
+def dead_letter(key, reason):
+    return KeyEntry('bucket', key, reason, None, None, None)
+
+def test_next_sync_without_failures():
+    assert next_sync_date(start_time, {}, []) == (start_time, [])
+
+def test_next_sync_starts_from_the_oldest_failure():
+    failed = {'0000-0001-0000-0001': datetime(2026, 10, 5), '0000-0001-0000-0002': datetime(2026, 10, 3)}
+    dead_letters = [dead_letter('001/0000-0001-0000-0001.xml', 'ClientError (SlowDown)')]
+    # The second record failed without a dead letter, like a listing error
+    assert next_sync_date(start_time, failed, dead_letters) == (datetime(2026, 10, 3), [])
+
+def test_permanent_errors_do_not_hold_the_next_sync():
+    failed = {
+        '0000-0001-0000-0001': datetime(2026, 10, 1),
+        '0000-0001-0000-0002': datetime(2026, 10, 2),
+        '0000-0001-0000-0003': datetime(2026, 10, 6),
+        '0000-0001-0000-0004': datetime(2026, 10, 4),
+    }
+    dead_letters = [
+        dead_letter('001/0000-0001-0000-0001.xml', 'ClientError (404)'),
+        dead_letter('002/0000-0001-0000-0002/works/1.xml', 'ClientError (AccessDenied)'),
+        dead_letter('002/0000-0001-0000-0002/works/2.xml', 'ClientError (403)'),
+        dead_letter('003/0000-0001-0000-0003/works/1.xml', 'ClientError (NoSuchKey)'),
+        # A record with a file that could sync next time is retried
+        dead_letter('004/0000-0001-0000-0004.xml', 'ClientError (404)'),
+        dead_letter('004/0000-0001-0000-0004/works/1.xml', 'ConnectionClosedError'),
+    ]
+    next_sync, lost = next_sync_date(start_time, failed, dead_letters)
+    assert next_sync == datetime(2026, 10, 4)
+    assert lost == ['0000-0001-0000-0001', '0000-0001-0000-0002', '0000-0001-0000-0003']
+    # With every failure permanent the next run starts from this one
+    del failed['0000-0001-0000-0004']
+    assert next_sync_date(start_time, failed, dead_letters[:4])[0] == start_time
+
+class BlockingBody(object):
+    # A lambda file download that stalls halfway until released
+    def __init__(self, data, stall_at):
+        self.stream = io.BytesIO(data)
+        self.stall_at = stall_at
+        self.release = threading.Event()
+
+    def read(self, size=-1):
+        if self.stream.tell() >= self.stall_at:
+            assert self.release.wait(30)
+        elif size < 0 or self.stream.tell() + size > self.stall_at:
+            size = self.stall_at - self.stream.tell()
+        return self.stream.read(size)
+
+    def close(self):
+        pass
+
+def lambda_tar(lines):
+    data = '\n'.join(['orcid,created,claimed,last_modified'] + lines).encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        member = tarfile.TarInfo(lambda_file.LAMBDA_FILE_MEMBER)
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    return buf.getvalue()
+
+def test_batches_follow_the_lambda_file(tmp_path):
+    lines = ['0000-0001-%04d-%04d,x,x,%s' % (i // 10000, i % 10000, datetime(2026, 10, 9) - timedelta(seconds=i)) for i in range(60000)]
+    body = BlockingBody(lambda_tar(lines), 1536 * 1024)
+    clients = SimpleNamespace(s3client=SimpleNamespace(get_object=lambda Bucket, Key: {'Body': body}))
+    config = SimpleNamespace(index=str(tmp_path / 'index.db'), manifest=str(tmp_path / 'manifest.db'), summaries=True, activities=False, force=False,
+                             lambda_bucket='lambda', batch_size=100000, page_size=1000, prefix_size=300000, activities_bucket_base='activities')
+    plan = SyncPlan(config, start_time, datetime(2026, 10, 1), clients)
+    batches = plan.batches()
+    # The first records are planned while the rest of the file is still to be downloaded
+    batch, listing_plan, tasks = next(batches)
+    assert 0 < len(batch) < 60000
+    assert plan.records_read < 60000
+    body.release.set()
+    orcids = [orcid for batch, listing_plan, tasks in batches for task in tasks for orcid in task.summaries]
+    orcids.extend(orcid for task in tasks for orcid in task.summaries)
+    assert sorted(orcids) == sorted(line.split(',')[0] for line in lines)
+    assert plan.records_to_sync == 60000
+    plan.close()
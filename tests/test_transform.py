@@ -0,0 +1,115 @@
+import gzip
+import json
+import multiprocessing
+import os
+import pytest
+from public_data_sync import transform
+
+RECORD = b'''<?xml version="1.0" encoding="UTF-8"?>
+<record:record xmlns:record="http://www.orcid.org/ns/record" xmlns:person="http://www.orcid.org/ns/person" xmlns:common="http://www.orcid.org/ns/common" path="/0000-0001-0000-0000">
+  <person:person>
+    <person:name visibility="public">
+      <person:given-names>Ada</person:given-names>
+      <person:family-name>Lovelace</person:family-name>
+    </person:name>
+    <person:emails>
+      <person:email><person:email>ada@example.org</person:email></person:email>
+      <person:email><person:email>ada@example.com</person:email></person:email>
+    </person:emails>
+  </person:person>
+  <common:last-modified-date>2026-10-01T00:00:00.000Z</common:last-modified-date>
+</record:record>
+'''
+
+def test_whole_document():
+    document = transform.transform(RECORD)
+    record = document['record']
+    assert record['@path'] == '/0000-0001-0000-0000'
+    name = record['person']['name']
+    # Namespaces are dropped, attributes are kept with an @
+    assert name == {'@visibility': 'public', 'given-names': 'Ada', 'family-name': 'Lovelace'}
+    # Repeated elements become lists
+    assert record['person']['emails']['email'] == [{'email': 'ada@example.org'}, {'email': 'ada@example.com'}]
+    assert record['last-modified-date'] == '2026-10-01T00:00:00.000Z'
+
+def test_projection():
+    projection = {
+        'given_names': 'person/name/given-names',
+        'family_name': '/person/name/family-name',
+        'emails': 'person/emails/email/email',
+        'name': 'person/name',
+        'missing': 'person/biography/content',
+    }
+    assert transform.transform(RECORD, projection) == {
+        'given_names': 'Ada',
+        'family_name': 'Lovelace',
+        'emails': ['ada@example.org', 'ada@example.com'],
+        'name': {'@visibility': 'public', 'given-names': 'Ada', 'family-name': 'Lovelace'},
+    }
+
+def test_load_projection(tmp_path):
+    fname = str(tmp_path / 'fields.json')
+    with open(fname, 'w') as f:
+        json.dump({'family_name': 'person/name/family-name'}, f)
+    assert transform.load_projection(fname) == {'family_name': 'person/name/family-name'}
+    with open(fname, 'w') as f:
+        json.dump(['person/name/family-name'], f)
+    with pytest.raises(ValueError):
+        transform.load_projection(fname)
+
+def test_entries():
+    assert transform.describe_key('000/0000-0001-0000-0000.xml') == ('0000-0001-0000-0000', 'summary')
+    assert transform.describe_key('000/0000-0001-0000-0000/works/0000-0001-0000-0000_works_1.xml') == ('0000-0001-0000-0000', 'works')
+    entry = transform.entry('000/0000-0001-0000-0000.xml', RECORD, {'family_name': 'person/name/family-name'})
+    assert entry == {'key': '000/0000-0001-0000-0000.xml', 'orcid': '0000-0001-0000-0000', 'type': 'summary', 'family_name': 'Lovelace'}
+    assert transform.deletion('000/0000-0001-0000-0000/works/1.xml')['deleted'] is True
+
+def read_shards(directory):
+    lines = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.ndjson.gz'):
+            with gzip.open(os.path.join(directory, name)) as f:
+                lines.extend(json.loads(line) for line in f)
+    return lines
+
+def write_and_die(writer, first, count):
+    for i in range(first, first + count):
+        writer.write({'key': str(i)})
+    writer.flush()
+    # Killed before closing, written after the flush
+    writer.write({'key': 'lost'})
+    os._exit(0)
+
+def test_ndjson_writer_recovers_killed_shards(tmp_path, monkeypatch):
+    # The resumed writer starts in the same millisecond, with the same pid, as the killed one
+    monkeypatch.setattr(transform.time, 'time', lambda: 1792338731.354)
+    directory = str(tmp_path)
+    writer = transform.NdjsonWriter(directory, 'summaries')
+    for i in range(10):
+        writer.write({'key': str(i)})
+    writer.flush()
+    # Killed before closing, the shard is still .part and readers skip it
+    assert read_shards(directory) == []
+
+    resumed = transform.NdjsonWriter(directory, 'summaries', True)
+    resumed.write({'key': '10'})
+    resumed.close()
+    assert sorted(int(line['key']) for line in read_shards(directory)) == list(range(11))
+    assert not [name for name in os.listdir(directory) if name.endswith('.part')]
+
+    # A full run replaces the shards of the previous one
+    transform.NdjsonWriter(directory, 'summaries').close()
+    assert read_shards(directory) == []
+
+def test_ndjson_writer_recovers_killed_workers(tmp_path):
+    directory = str(tmp_path)
+    writer = transform.NdjsonWriter(directory, 'summaries')
+    fork = multiprocessing.get_context('fork')
+    for worker in range(3):
+        process = fork.Process(target=write_and_die, args=(writer, worker * 100, 50))
+        process.start()
+        process.join()
+    resumed = transform.NdjsonWriter(directory, 'summaries', True)
+    resumed.close()
+    # Every line flushed by a worker is in the shards, not the ones after the last flush
+    assert sorted(int(line['key']) for line in read_shards(directory)) == [worker * 100 + i for worker in range(3) for i in range(50)]